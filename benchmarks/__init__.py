@@ -0,0 +1,5 @@
+"""
+Throughput benchmarks of sng_parser, run with `python -m benchmarks`.
+
+Not part of the installed package.
+"""
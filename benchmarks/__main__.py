@@ -0,0 +1,301 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from importlib import metadata
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from sng_parser import decode_sng, encode_sng
+from sng_parser.common import MASK_BACKENDS, mask
+from sng_parser.decode import read_sng_tables
+
+from .corpus import CorpusSpec, make_corpus
+
+logger = logging.getLogger("benchmarks")
+
+
+class Result(NamedTuple):
+    """
+    Best run of one benchmark.
+    """
+
+    name: str
+    seconds: float
+    bytes: int
+    files: int
+    mb_per_s: float
+    files_per_s: float
+    repeat: int
+
+
+def _tree_size(paths: List[str]) -> int:
+    size = 0
+    for path in paths:
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+            continue
+        for dirpath, _, filenames in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+    return size
+
+
+def _time(
+    name: str,
+    run: Callable[[], None],
+    *,
+    nbytes: int,
+    files: int,
+    repeat: int,
+    setup: Optional[Callable[[], None]] = None,
+) -> Result:
+    """
+    Runs a benchmark `repeat` times, keeping the fastest run. `setup` runs untimed before each run.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    result = Result(
+        name, best, nbytes, files, nbytes / best / 1e6, files / best, repeat
+    )
+    logger.info(
+        "%-24s %10.1f MB/s %10.1f files/s (%.3fs)",
+        name,
+        result.mb_per_s,
+        result.files_per_s,
+        best,
+    )
+    return result
+
+
+def _fresh_dir(path: str) -> Callable[[], None]:
+    def setup():
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    return setup
+
+
+def bench_mask(spec: CorpusSpec, workdir: str, repeat: int) -> List[Result]:
+    data = bytearray(os.urandom(64 * 1024 * 1024))
+    xor_mask = bytes(range(16))
+    return [
+        _time(
+            "mask[%s]" % backend,
+            lambda: mask(data, xor_mask, backend=backend),
+            nbytes=len(data),
+            files=1,
+            repeat=repeat,
+        )
+        for backend in MASK_BACKENDS
+    ]
+
+
+def bench_tables(spec: CorpusSpec, workdir: str, repeat: int) -> List[Result]:
+    _, sng_files = make_corpus(os.path.join(workdir, "corpus"), spec)
+
+    def run():
+        for sng_file in sng_files:
+            with open(sng_file, "rb") as f:
+                read_sng_tables(f)
+
+    # bytes of the parsed sections only, not the file contents
+    nbytes = 0
+    for sng_file in sng_files:
+        with open(sng_file, "rb") as f:
+            read_sng_tables(f)
+            nbytes += f.tell()
+    return [_time("tables", run, nbytes=nbytes, files=len(sng_files), repeat=repeat)]
+
+
+def bench_decode(spec: CorpusSpec, workdir: str, repeat: int) -> List[Result]:
+    _, sng_files = make_corpus(os.path.join(workdir, "corpus"), spec)
+    outdir = os.path.join(workdir, "decoded")
+    results = []
+    for workers in sorted({1, os.cpu_count() or 1}):
+
+        def run():
+            for i, sng_file in enumerate(sng_files):
+                decode_sng(
+                    sng_file, outdir=Path(outdir), sng_dir="song_%04d" % i, workers=workers
+                )
+
+        results.append(
+            _time(
+                "decode[workers=%d]" % workers,
+                run,
+                nbytes=_tree_size(sng_files),
+                files=len(sng_files) * spec.members,
+                repeat=repeat,
+                setup=_fresh_dir(outdir),
+            )
+        )
+    return results
+
+
+def _bench_encode(
+    name: str, spec: CorpusSpec, workdir: str, repeat: int, encode_audio: bool
+) -> List[Result]:
+    song_dirs, _ = make_corpus(os.path.join(workdir, "corpus"), spec)
+    outdir = os.path.join(workdir, "encoded")
+
+    def run():
+        for song_dir in song_dirs:
+            encode_sng(
+                song_dir,
+                output_filename=os.path.join(outdir, os.path.basename(song_dir)),
+                xor_mask=bytes(16),
+                encode_audio=encode_audio,
+                transcode_cache=None,
+            )
+
+    return [
+        _time(
+            name,
+            run,
+            nbytes=_tree_size(song_dirs),
+            files=len(song_dirs) * spec.members,
+            repeat=repeat,
+            setup=_fresh_dir(outdir),
+        )
+    ]
+
+
+def bench_encode(spec: CorpusSpec, workdir: str, repeat: int) -> List[Result]:
+    return _bench_encode("encode", spec, workdir, repeat, encode_audio=False)
+
+
+def bench_encode_audio(spec: CorpusSpec, workdir: str, repeat: int) -> List[Result]:
+    if not spec.audio_seconds:
+        spec = spec._replace(audio_seconds=30.0)
+        workdir = os.path.join(workdir, "audio")
+    return _bench_encode("encode[audio]", spec, workdir, repeat, encode_audio=True)
+
+
+def bench_cli(spec: CorpusSpec, workdir: str, repeat: int) -> List[Result]:
+    _, sng_files = make_corpus(os.path.join(workdir, "corpus"), spec)
+    outdir = os.path.join(workdir, "cli")
+    workers = os.cpu_count() or 1
+    command = [
+        sys.executable, "-m", "sng_parser", "-t", str(workers), "decode", "-o", outdir, *sng_files
+    ]
+    return [
+        _time(
+            "cli_decode[processes=%d]" % workers,
+            lambda: subprocess.run(command, check=True, capture_output=True),
+            nbytes=_tree_size(sng_files),
+            files=len(sng_files),
+            repeat=repeat,
+            setup=_fresh_dir(outdir),
+        )
+    ]
+
+
+BENCHMARKS: Dict[str, Callable[[CorpusSpec, str, int], List[Result]]] = {
+    "mask": bench_mask,
+    "tables": bench_tables,
+    "decode": bench_decode,
+    "encode": bench_encode,
+    "encode_audio": bench_encode_audio,
+    "cli": bench_cli,
+}
+
+
+def _spec_dir(root: str, spec: CorpusSpec) -> str:
+    """
+    Working directory of a spec, so corpora of different specs are never mixed up.
+    """
+    return os.path.join(root, hashlib.md5(repr(spec).encode()).hexdigest()[:12])
+
+
+def _version() -> str:
+    try:
+        return metadata.version("sng_parser")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def create_args() -> argparse.ArgumentParser:
+    defaults = CorpusSpec()
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Measure sng_parser throughput"
+    )
+    parser.add_argument(
+        "-o", "--output", default="bench_results.json", help="JSON results file. Default: %(default)s"
+    )
+    parser.add_argument(
+        "-b",
+        "--bench",
+        action="append",
+        choices=list(BENCHMARKS),
+        help="Benchmark to run, can be repeated. Default: all",
+    )
+    parser.add_argument(
+        "--workdir", help="Where corpora are generated and kept between runs. Default: a temporary directory"
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per benchmark, the fastest is kept. Default: %(default)s")
+    parser.add_argument("--songs", type=int, default=defaults.songs)
+    parser.add_argument("--members", type=int, default=defaults.members)
+    parser.add_argument("--member-size", type=int, default=defaults.member_size)
+    parser.add_argument("--metadata-keys", type=int, default=defaults.metadata_keys)
+    parser.add_argument("--audio-seconds", type=float, default=defaults.audio_seconds)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    return parser
+
+
+def main() -> int:
+    args = create_args().parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    spec = CorpusSpec(
+        songs=args.songs,
+        members=args.members,
+        member_size=args.member_size,
+        metadata_keys=args.metadata_keys,
+        audio_seconds=args.audio_seconds,
+        seed=args.seed,
+    )
+    # keep the sng_parser logs out of the results
+    logging.getLogger("sng_parser").setLevel(logging.WARNING)
+
+    tmp = None
+    root = args.workdir
+    if root is None:
+        tmp = root = tempfile.mkdtemp(prefix="sng_bench_")
+    try:
+        workdir = _spec_dir(root, spec)
+        results: List[Result] = []
+        for name in args.bench or BENCHMARKS:
+            results += BENCHMARKS[name](spec, workdir, args.repeat)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        "sng_parser": _version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "spec": spec._asdict(),
+        "results": [result._asdict() for result in results],
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote results to %s", args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
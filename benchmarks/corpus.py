@@ -0,0 +1,144 @@
+import configparser
+import os
+import random
+
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+import soundfile as sf
+
+from sng_parser import encode_sng
+from sng_parser.common import (
+    SNG_AUDIO_EXT,
+    SNG_AUDIO_FILES,
+    SNG_IMG_EXT,
+    SNG_IMG_FILES,
+    SNG_NOTES_FILES,
+    SNG_VIDEO_EXT,
+    SNG_VIDEO_FILES,
+)
+
+__all__ = ["CorpusSpec", "member_names", "make_song_dir", "make_corpus"]
+
+# Sample rate of generated audio, one opus accepts
+AUDIO_SAMPLERATE = 48000
+
+
+class CorpusSpec(NamedTuple):
+    """
+    Shape of a synthetic corpus. The same spec always generates the same bytes.
+    """
+
+    songs: int = 8
+    members: int = 8
+    member_size: int = 4 * 1024 * 1024
+    metadata_keys: int = 16
+    # seconds of generated wav audio per song, 0 for none
+    audio_seconds: float = 0.0
+    seed: int = 0
+
+
+def member_names() -> List[str]:
+    """
+    Every filename allowed by the sng standard, notes first, then audio, images and video,
+    each group sorted so the order is stable.
+    """
+    names = sorted(SNG_NOTES_FILES)
+    for stems, exts in (
+        (SNG_AUDIO_FILES, SNG_AUDIO_EXT),
+        (SNG_IMG_FILES, SNG_IMG_EXT),
+        (SNG_VIDEO_FILES, SNG_VIDEO_EXT),
+    ):
+        names += sorted("%s.%s" % (stem, ext) for stem in stems for ext in exts)
+    return names
+
+
+def _write_wav(path: str, seconds: float, rng: random.Random) -> None:
+    frames = int(seconds * AUDIO_SAMPLERATE)
+    t = np.arange(frames) / AUDIO_SAMPLERATE
+    freq = rng.uniform(110, 880)
+    noise = np.random.default_rng(rng.getrandbits(32)).normal(0, 0.02, frames)
+    channel = (0.3 * np.sin(2 * np.pi * freq * t) + noise).astype(np.float32)
+    sf.write(path, np.stack([channel, channel], axis=1), AUDIO_SAMPLERATE, subtype="PCM_16")
+
+
+def make_song_dir(
+    path: str,
+    *,
+    members: int,
+    member_size: int,
+    metadata_keys: int,
+    audio_seconds: float,
+    rng: random.Random,
+) -> None:
+    """
+    Writes a song folder: a song.ini with `metadata_keys` entries and `members` files of
+    `member_size` random bytes. With `audio_seconds`, the first audio stems are wav files
+    of that length instead.
+    """
+    names = member_names()
+    if members > len(names):
+        raise ValueError("At most %d members are allowed, got %d" % (len(names), members))
+    os.makedirs(path, exist_ok=True)
+
+    cfg = configparser.ConfigParser()
+    cfg["Song"] = {
+        "name": "Song %d" % rng.getrandbits(16),
+        "artist": "Artist %d" % rng.getrandbits(16),
+        "charter": "Charter",
+        **{"key_%03d" % i: "%032x" % rng.getrandbits(128) for i in range(metadata_keys)},
+    }
+    with open(os.path.join(path, "song.ini"), "w") as f:
+        cfg.write(f)
+
+    audio = [name for name in names if name.endswith(".wav")]
+    if audio_seconds:
+        # wav stems first, so the song has audio whatever the member count
+        names = audio + [name for name in names if name not in audio]
+    for name in names[:members]:
+        filepath = os.path.join(path, name)
+        if audio_seconds and name.endswith(".wav"):
+            _write_wav(filepath, audio_seconds, rng)
+        else:
+            with open(filepath, "wb") as f:
+                f.write(rng.randbytes(member_size))
+
+
+def make_corpus(root: str, spec: CorpusSpec) -> Tuple[List[str], List[str]]:
+    """
+    Generates `spec.songs` song folders under `root/songs` and their sng files,
+    encoded with a mask from the seed, under `root/sng`. Existing output is reused.
+
+    Returns:
+        Tuple[List[str], List[str]]: The song folders and the sng files.
+    """
+    rng = random.Random(spec.seed)
+    song_dirs, sng_files = [], []
+    os.makedirs(os.path.join(root, "sng"), exist_ok=True)
+    for i in range(spec.songs):
+        song_dir = os.path.join(root, "songs", "song_%04d" % i)
+        sng_file = os.path.join(root, "sng", "song_%04d.sng" % i)
+        xor_mask = rng.randbytes(16)
+        if not os.path.isdir(song_dir):
+            make_song_dir(
+                song_dir,
+                members=spec.members,
+                member_size=spec.member_size,
+                metadata_keys=spec.metadata_keys,
+                audio_seconds=spec.audio_seconds,
+                rng=random.Random(rng.getrandbits(64)),
+            )
+        else:
+            # keep the stream of seeds the same when the folder is reused
+            rng.getrandbits(64)
+        if not os.path.exists(sng_file):
+            encode_sng(
+                song_dir,
+                output_filename=sng_file,
+                xor_mask=xor_mask,
+                encode_audio=False,
+                transcode_cache=None,
+            )
+        song_dirs.append(song_dir)
+        sng_files.append(sng_file)
+    return song_dirs, sng_files
@@ -1,11 +1,30 @@
 from .common import SngFileMetadata, SngMetadataInfo, SngHeader
+from .aio import async_decode_sng, async_encode_sng
+from .archive import SngArchive, decode_sng_to_mapping
+from .cache import TABLE_CACHE, SngTableCache
 from .decode import decode_sng
-from .encode import encode_sng
+from .encode import encode_sng, encode_sng_from_members
+from .index import index_library
+from .stats import SngStats
+from .update import update_sng
+from .verify import verify_sng, verify_sng_files
 
 
 __all__ = [
     "encode_sng",
+    "encode_sng_from_members",
     "decode_sng",
+    "decode_sng_to_mapping",
+    "async_encode_sng",
+    "async_decode_sng",
+    "index_library",
+    "update_sng",
+    "verify_sng",
+    "verify_sng_files",
+    "SngArchive",
+    "SngTableCache",
+    "SngStats",
+    "TABLE_CACHE",
     "SngFileMetadata",
     "SngHeader",
     "SngMetadataInfo",
@@ -1,30 +1,46 @@
 import argparse
 
+import hashlib
+import json
 import os
 import logging
 
 import sys
+import time
 
+from functools import partial
 from pathlib import Path
-from queue import Queue, Empty
-from threading import Thread
-from typing import Callable, NoReturn
+from typing import Callable, List, NoReturn, Tuple
 
 
-from . import decode_sng, encode_sng
+from . import decode_sng, encode_sng, index_library
+from .convert import PACK_FORMATS, pack_to_sng, sng_to_pack
+from .audio import TRANSCODE_CACHE, TranscodeCache
+from .batch import BatchResult, _run_item, run_batch
+from .stats import SngStats
+from .verify import verify_sng_files
 
 
-def main():
+def main() -> int:
     parser = create_args()
     args = parse_args(parser)
-    args.func(args)
+    return args.func(args)
 
 
 logger = logging.getLogger(__package__)
 
+# Output path meaning the sng file is written to stdout
+STDOUT_PATH = Path("-")
+
+LOG_FORMAT = "[%(asctime)s - %(name)s:%(module)s:%(lineno)d] %(levelname)s: %(message)s"
+
 
 def _int_range(*,min_val: int | None=None, max_val: int | None=None) -> Callable[[int], int | NoReturn]:
-    def _check(val: int) -> int:
+    def _check(val: str) -> int:
+        try:
+            val = int(val)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Value {val} is not an integer.")
         if min_val is not None and val < min_val:
             raise argparse.ArgumentTypeError(f"Value {val} is less than minimum {min_val}.")
         if max_val is not None and val > max_val:
@@ -35,12 +51,14 @@ def _int_range(*,min_val: int | None=None, max_val: int | None=None) -> Callable
 def parse_args(parser: argparse.ArgumentParser) -> argparse.Namespace:
     args = parser.parse_args()
     log_levels = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
-    log_level = min(args.log_level, max(args.log_level, len(log_levels) - 1))
+    log_level = min(args.log_level, len(log_levels) - 1)
     log_level: int = log_levels[log_level]
+    # keep stdout clean when the sng file itself is written to it
+    writes_stdout = STDOUT_PATH in (getattr(args, "out_file", None), getattr(args, "report", None))
     logging.basicConfig(
-        stream=sys.stdout,
+        stream=sys.stderr if writes_stdout else sys.stdout,
         level=log_level,
-        format="[%(asctime)s - %(name)s:%(module)s:%(lineno)d] %(levelname)s: %(message)s",
+        format=LOG_FORMAT,
     )
     logger.info("Initialized logging to %s", logging.getLevelName(log_level))
     return args
@@ -60,15 +78,15 @@ def create_args() -> argparse.ArgumentParser:
         "--threads",
         type=_int_range(min_val=1),
         default=1,
-        help="Number of threads to use for encoding/decoding. Default: %(default)s",
+        help="Number of processes to use for encoding/decoding multiple sng files. Default: %(default)s",
         metavar="num_threads",
         dest="num_threads",
     )
 
     subparser = parser.add_subparsers(
         title="action",
-        metavar="{encode|decode}",
-        description="Encode to or decode from an sng file. For futher usage, run %(prog)s {encode|decode} -h",
+        metavar="{encode|decode|convert|index|verify}",
+        description="Encode to or decode from an sng file, convert between sng files and zip or tar packs, index a library of sng files, or verify sng files. For futher usage, run %(prog)s {encode|decode|convert|index|verify} -h",
         required=True,
     )
 
@@ -84,7 +102,7 @@ def create_args() -> argparse.ArgumentParser:
         "-o",
         "--out-file",
         type=Path,
-        help="The output path of the SNG file. Defaults to the md5 sum of the containing files of the target dir.",
+        help="The output path of the SNG file, or `-` to write it to stdout. Defaults to the md5 sum of the containing files of the target dir.",
         default=None,
         metavar="path/to/encoded.sng",
         dest="out_file",
@@ -122,6 +140,22 @@ def create_args() -> argparse.ArgumentParser:
         default=False,
         dest="encode_audio",
     )
+    encode.add_argument(
+        "--transcode-cache",
+        type=Path,
+        metavar="path/to/cache",
+        help="Directory caching opus transcodes. The cache is used unless --no-transcode-cache is passed. Default: $SNG_PARSER_CACHE_DIR or ~/.cache/sng_parser/opus",
+        default=None,
+        dest="transcode_cache",
+    )
+    encode.add_argument(
+        "--no-transcode-cache",
+        action="store_true",
+        help="Always transcode audio files, without caching. Default: %(default)s.",
+        default=False,
+        dest="no_transcode_cache",
+    )
+    _add_stats_arg(encode)
     encode.set_defaults(func=run_encode)
 
     decode = subparser.add_parser("decode")
@@ -166,86 +200,376 @@ def create_args() -> argparse.ArgumentParser:
         default=False,
         dest="force",
     )
+    decode.add_argument(
+        "--only",
+        action="append",
+        metavar="pattern",
+        help="Only decode files matching the glob pattern, e.g. `notes.*`. Can be repeated.",
+        default=None,
+        dest="include",
+    )
+    decode.add_argument(
+        "--exclude",
+        action="append",
+        metavar="pattern",
+        help="Skip files matching the glob pattern. Can be repeated.",
+        default=None,
+        dest="exclude",
+    )
+    decode.add_argument(
+        "--metadata-only",
+        action="store_true",
+        help="Only write song.ini. Default: %(default)s",
+        default=False,
+        dest="metadata_only",
+    )
+    _add_stats_arg(decode)
 
     decode.set_defaults(func=run_decode)
+
+    convert = subparser.add_parser("convert")
+    convert.add_argument(
+        "src",
+        type=Path,
+        nargs="+",
+        metavar="path/to/src",
+        help="sng files to convert to a pack, or zip/tar packs to convert to sng files",
+    )
+    convert.add_argument(
+        "-o",
+        "--out",
+        type=Path,
+        metavar="path/to/out",
+        help="The pack to write when converting sng files, or the output directory of the sng files when converting packs. Default: %(default)s (current working dir)",
+        default=Path(os.path.abspath(os.path.curdir)),
+        dest="out",
+    )
+    convert.add_argument(
+        "--format",
+        choices=list(PACK_FORMATS),
+        help="Format of the packs. Default: guessed from their extension",
+        default=None,
+        dest="format",
+    )
+    convert.add_argument(
+        "-i",
+        "--ignore-nonsng-files",
+        action="store_false",
+        help="Allow converting files not allowed by the sng standard. Default: %(default)s",
+        default=True,
+        dest="ignore_nonsng_files",
+    )
+    convert.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Overwrite existing sng files. Default: %(default)s",
+        default=False,
+        dest="force",
+    )
+    convert.set_defaults(func=run_convert)
+
+    index = subparser.add_parser("index")
+    index.add_argument(
+        "library_dir",
+        type=Path,
+        metavar="path/to/library",
+        help="Directory to scan recursively for sng files",
+    )
+    index.add_argument(
+        "-o",
+        "--index-file",
+        type=Path,
+        metavar="path/to/index.db",
+        help="SQLite database to store the index in. Created if missing. Default: %(default)s",
+        default=Path("sng_index.db"),
+        dest="index_file",
+    )
+    index.add_argument(
+        "-w",
+        "--workers",
+        type=_int_range(min_val=1),
+        metavar="num_workers",
+        help="Number of processes parsing sng files. Default: cpu count",
+        default=None,
+        dest="workers",
+    )
+    index.set_defaults(func=run_index)
+
+    verify = subparser.add_parser("verify")
+    verify.add_argument(
+        "sng_file",
+        type=Path,
+        nargs="+",
+        metavar="path/to/sng",
+        help="SNG file(s) to verify, or directories searched recursively for sng files",
+    )
+    verify.add_argument(
+        "-o",
+        "--report",
+        type=Path,
+        metavar="path/to/report.json",
+        help="File to write the JSON report to, `-` for stdout. Default: %(default)s",
+        default=STDOUT_PATH,
+        dest="report",
+    )
+    verify.add_argument(
+        "-w",
+        "--workers",
+        type=_int_range(min_val=1),
+        metavar="num_workers",
+        help="Number of processes verifying sng files. Default: cpu count",
+        default=None,
+        dest="workers",
+    )
+    verify.add_argument(
+        "--hash",
+        choices=sorted(hashlib.algorithms_guaranteed),
+        metavar="algorithm",
+        help="Also hash the unmasked contents of every file with the hashlib algorithm, e.g. sha256. Default: no hashing",
+        default=None,
+        dest="hash",
+    )
+    verify.set_defaults(func=run_verify)
     parser.usage = (
-        "\n  " + encode.format_usage()[7:] + "  " + decode.format_usage()[7:] + "\n"
+        "\n  "
+        + encode.format_usage()[7:]
+        + "  "
+        + decode.format_usage()[7:]
+        + "  "
+        + convert.format_usage()[7:]
+        + "  "
+        + index.format_usage()[7:]
+        + "  "
+        + verify.format_usage()[7:]
+        + "\n"
     )
     return parser
 
 
-def run_encode(args: argparse.Namespace) -> None:
-    task_queue: Queue[Path] = Queue()
-
-    def worker():
-        while True:
-            try:
-                sng_dir: Path = task_queue.get(block=False)
-            except Empty:
-                logger.debug("No more tasks in the queue, exiting worker thread.")
-                break
-            try:
-                logger.info("Encoding %s...", sng_dir)
-                encode_sng(
-                    dir_to_encode=sng_dir,
-                    output_filename=args.out_file if len(args.sng_dir) == 1 else None,
-                    version=args.version,
-                    overwrite=args.force,
-                    allow_nonsng_files=not args.ignore_nonsng_files,
-                    encode_audio=args.encode_audio,
-                )
-                logger.info("Encoded %s successfully.", sng_dir)
-            except (FileExistsError, ValueError, RuntimeError) as err:
-                logger.error("Failed to encode %s. Error: %s", sng_dir, err)
-                logger.debug("Stack trace:", exc_info=sys.exc_info())
-                
-                break
-        task_queue.task_done()
-    for sng_dir in args.sng_dir:
-        if not sng_dir.is_dir():
-            logger.error("The provided path %s is not a directory.", sng_dir)
-            continue
-        task_queue.put(sng_dir)
-    for idx in range(min(len(args.sng_dir), args.num_threads)):
-        thread = Thread(target=worker, name=f"Encoder-{idx}")
-        thread.start()
-
-
-def run_decode(args: argparse.Namespace) -> None:
-    task_queue: Queue[Path] = Queue()
-
-    def worker():
-        while True:
-            try:
-                sng_file: Path = task_queue.get(block=False)
-            except Empty:
-                logger.debug("No more tasks in the queue, exiting worker thread.")
-                break
-            try:
-                logger.info("Encoding %s...", sng_file)
-                decode_sng(
-                    sng_file=sng_file,
-                    outdir=args.out_dir,
-                    allow_nonsng_files=not args.ignore_nonsng_files,
-                    sng_dir=args.sng_dir,
-                    overwrite=args.force,
-                )
-                logger.info("Encoded %s successfully.", sng_file)
-            except (FileExistsError, ValueError, RuntimeError) as err:
-                logger.error("Failed to encode %s. Error: %s", sng_file, err)
-                logger.debug("Stack trace:", exc_info=sys.exc_info())
-                
-                break
-        task_queue.task_done()
-    for sng_file in args.sng_file:
-        if not sng_file.is_file():
-            logger.error("The provided path %s is not a directory.", sng_file)
+def _add_stats_arg(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--stats",
+        type=Path,
+        metavar="path/to/stats.json",
+        help="Write the time and bytes spent in each phase, per sng file and in total, to a JSON file.",
+        default=None,
+        dest="stats",
+    )
+
+
+def _write_stats(path: Path, results: List[BatchResult]) -> None:
+    """
+    Writes the stats of each item of a batch, and their sum, as JSON.
+    """
+    total = SngStats()
+    items = {}
+    for result in results:
+        if result.stats is None:
             continue
-        task_queue.put(sng_file)
-    for idx in range(min(len(args.sng_file), args.num_threads)):
-        thread = Thread(target=worker, name=f"Encoder-{idx}")
-        thread.start()
+        total.merge(result.stats)
+        items[result.item] = {
+            "ok": result.ok,
+            "seconds": result.seconds,
+            **result.stats.as_dict(),
+        }
+    report = {
+        "seconds": sum(result.seconds for result in results),
+        **total.as_dict(),
+        "items": items,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote stats to %s", path)
+
+
+def _report(action: str, results: List[BatchResult]) -> int:
+    """
+    Prints a summary of a batch run and returns the exit code, non-zero if anything failed.
+    """
+    failed = [result for result in results if not result.ok]
+    print(
+        "%s %d of %d (failed: %d)"
+        % (action, len(results) - len(failed), len(results), len(failed)),
+        file=sys.stderr,
+    )
+    for result in failed:
+        print("  %s: %s" % (result.item, result.error), file=sys.stderr)
+    return 1 if failed else 0
+
+
+def _split_valid(
+    paths: List[Path], is_valid: Callable[[Path], bool], message: str
+) -> Tuple[List[Path], List[BatchResult]]:
+    """
+    Splits paths into valid ones and failed results for the invalid ones.
+    """
+    valid, invalid = [], []
+    for path in paths:
+        if is_valid(path):
+            valid.append(path)
+        else:
+            logger.error(message, path)
+            invalid.append(BatchResult(str(path), False, message % path, 0.0))
+    return valid, invalid
+
+
+def _transcode_cache(args: argparse.Namespace) -> TranscodeCache | None:
+    if args.no_transcode_cache:
+        return None
+    if args.transcode_cache is not None:
+        return TranscodeCache(args.transcode_cache)
+    return TRANSCODE_CACHE
+
+
+def run_encode(args: argparse.Namespace) -> int:
+    if args.out_file == STDOUT_PATH:
+        if len(args.sng_dir) != 1:
+            logger.error("Only a single directory can be encoded to stdout.")
+            return 1
+        stats = SngStats() if args.stats is not None else None
+        start = time.perf_counter()
+        encode_sng(
+            dir_to_encode=args.sng_dir[0],
+            output_filename=sys.stdout.buffer,
+            version=args.version,
+            allow_nonsng_files=not args.ignore_nonsng_files,
+            encode_audio=args.encode_audio,
+            transcode_cache=_transcode_cache(args),
+            stats=stats,
+        )
+        sys.stdout.buffer.flush()
+        if stats is not None:
+            seconds = time.perf_counter() - start
+            _write_stats(
+                args.stats, [BatchResult(str(args.sng_dir[0]), True, None, seconds, stats)]
+            )
+        return 0
+    sng_dirs, results = _split_valid(
+        args.sng_dir, Path.is_dir, "The provided path %s is not a directory."
+    )
+    encode = partial(
+        encode_sng,
+        output_filename=args.out_file if len(args.sng_dir) == 1 else None,
+        version=args.version,
+        overwrite=args.force,
+        allow_nonsng_files=not args.ignore_nonsng_files,
+        encode_audio=args.encode_audio,
+        transcode_cache=_transcode_cache(args),
+    )
+    results += run_batch(
+        encode,
+        sng_dirs,
+        workers=args.num_threads,
+        log_format=LOG_FORMAT,
+        collect_stats=args.stats is not None,
+    )
+    if args.stats is not None:
+        _write_stats(args.stats, results)
+    return _report("Encoded", results)
+
+
+def run_decode(args: argparse.Namespace) -> int:
+    sng_files, results = _split_valid(
+        args.sng_file, Path.is_file, "The provided path %s is not a file."
+    )
+    decode = partial(
+        decode_sng,
+        outdir=args.out_dir,
+        allow_nonsng_files=not args.ignore_nonsng_files,
+        sng_dir=args.sng_dir,
+        overwrite=args.force,
+        include=args.include,
+        exclude=args.exclude,
+        metadata_only=args.metadata_only,
+    )
+    results += run_batch(
+        decode,
+        sng_files,
+        workers=args.num_threads,
+        log_format=LOG_FORMAT,
+        collect_stats=args.stats is not None,
+    )
+    if args.stats is not None:
+        _write_stats(args.stats, results)
+    return _report("Decoded", results)
+
+
+def run_convert(args: argparse.Namespace) -> int:
+    sng_files = [path for path in args.src if path.suffix == ".sng"]
+    if sng_files and len(sng_files) != len(args.src):
+        logger.error("Either convert sng files to a pack, or packs to sng files, not both.")
+        return 1
+    if sng_files:
+        sng_files, results = _split_valid(
+            sng_files, Path.is_file, "The provided path %s is not a file."
+        )
+        if results:
+            return _report("Converted", results)
+        if args.out.is_dir():
+            logger.error("The pack to write, %s, is a directory.", args.out)
+            return 1
+        if args.out.exists() and not args.force:
+            logger.error("The pack %s already exists.", args.out)
+            return 1
+        convert = partial(
+            sng_to_pack,
+            sng_files,
+            format=args.format,
+            allow_nonsng_files=not args.ignore_nonsng_files,
+        )
+        result = _run_item(convert, str(args.out))
+        if not result.ok:
+            logger.error("Failed to write the pack %s. Error: %s", result.item, result.error)
+        return _report("Converted", [result])
+    packs, results = _split_valid(
+        args.src, Path.is_file, "The provided path %s is not a file."
+    )
+    convert = partial(
+        pack_to_sng,
+        outdir=args.out,
+        format=args.format,
+        overwrite=args.force,
+        allow_nonsng_files=not args.ignore_nonsng_files,
+    )
+    results += run_batch(
+        convert, packs, workers=args.num_threads, log_format=LOG_FORMAT
+    )
+    return _report("Converted", results)
+
+
+def run_index(args: argparse.Namespace) -> int:
+    summary = index_library(
+        args.library_dir, args.index_file, workers=args.workers
+    )
+    print(
+        "Indexed %d sng files (updated: %d, unchanged: %d, removed: %d, failed: %d)"
+        % summary
+    )
+    return 0
+
+
+def run_verify(args: argparse.Namespace) -> int:
+    results = verify_sng_files(
+        args.sng_file, workers=args.workers, hash_algorithm=args.hash
+    )
+    report = {
+        "verified": len(results),
+        "failed": sum(not result.ok for result in results),
+        "files": [result._asdict() for result in results],
+    }
+    if args.report == STDOUT_PATH:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info("Wrote the verify report to %s", args.report)
+    for result in results:
+        if not result.ok:
+            logger.error("%s failed verification: %s", result.path, "; ".join(result.errors))
+    return 1 if report["failed"] else 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,542 @@
+import asyncio
+import concurrent.futures
+import inspect
+import io
+import logging
+import os
+import threading
+import weakref
+
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Tuple
+
+from .common import (
+    HEADER,
+    MIN_CHUNK_SIZE,
+    U64,
+    SngFileMetadata,
+    SngHeader,
+    SngMetadataInfo,
+    _chunk_size_for,
+    _readinto_full,
+    mask_into,
+)
+from .decode import (
+    _as_path_obj,
+    _base_outdir,
+    _check_written,
+    _create_song_dir,
+    _members_to_extract,
+    _validate_path,
+    decode_metadata,
+    read_file_data_len,
+    read_sng_header,
+    read_sng_tables,
+)
+from .audio import TranscodeCache
+from .encode import _encode_args, _output_path, _write_tables_forward
+
+__all__ = [
+    "async_decode_sng",
+    "async_encode_sng",
+    "archive_semaphore",
+    "set_archive_limit",
+    "get_executor",
+]
+
+logger = logging.getLogger(__package__)
+
+# Default number of archives encoded or decoded at once on one event loop
+DEFAULT_ARCHIVE_LIMIT = 4
+# Threads of the shared executor running the blocking file I/O and masking
+DEFAULT_EXECUTOR_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_archive_limit = DEFAULT_ARCHIVE_LIMIT
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
+_Run = Callable[..., Awaitable[Any]]
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Returns the executor shared by the coroutines of this module, creating it on first use.
+
+    Returns:
+        ThreadPoolExecutor: A thread pool of `DEFAULT_EXECUTOR_WORKERS` threads.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                DEFAULT_EXECUTOR_WORKERS, thread_name_prefix="SngAsync"
+            )
+        return _executor
+
+
+def set_archive_limit(limit: int) -> None:
+    """
+    Sets how many archives may be encoded or decoded at once on each event loop.
+    Loops that already started an archive keep their limit.
+
+    Args:
+        limit (int): The maximum number of archives in flight per loop.
+    """
+    global _archive_limit
+    if limit < 1:
+        raise ValueError("Archive limit should be at least 1, got %d" % limit)
+    _archive_limit = limit
+
+
+def archive_semaphore() -> asyncio.Semaphore:
+    """
+    Returns the semaphore limiting the archives in flight on the running event loop,
+    creating it with the limit from `set_archive_limit` on first use.
+
+    Returns:
+        asyncio.Semaphore: The semaphore of the running loop.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(_archive_limit)
+    return semaphore
+
+
+def _runner(executor: Optional[Executor]) -> _Run:
+    loop = asyncio.get_running_loop()
+    executor = executor or get_executor()
+
+    def run(func, *args, **kwargs):
+        return loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+    return run
+
+
+def _is_async(method: Callable) -> bool:
+    return inspect.iscoroutinefunction(method)
+
+
+class _Reader:
+    """
+    Sequential reader over a blocking file, read on the executor, or an async byte stream
+    with an awaitable `read`, such as `asyncio.StreamReader`.
+    """
+
+    def __init__(self, stream, run: _Run, *, owned: bool = False) -> None:
+        self.stream = stream
+        self.run = run
+        self.owned = owned
+        self.is_async = _is_async(stream.read)
+        self.position = 0
+
+    async def readinto(self, view: memoryview) -> int:
+        """
+        Fills `view`, short only at the end of the stream.
+        """
+        if not self.is_async:
+            read = await self.run(_readinto_full, self.stream, view)
+        else:
+            read = 0
+            while read < len(view):
+                data = await self.stream.read(len(view) - read)
+                if not data:
+                    break
+                view[read : read + len(data)] = data
+                read += len(data)
+        self.position += read
+        return read
+
+    async def read_exactly(self, size: int, section: str) -> bytearray:
+        buf = bytearray(size)
+        read = await self.readinto(memoryview(buf))
+        if read != size:
+            raise RuntimeError(
+                "%s read mismatch. Expected %d, read %d" % (section, size, read)
+            )
+        return buf
+
+    async def seek(self, position: int) -> None:
+        """
+        Moves forward to `position`, reading and dropping the bytes in between on streams.
+        Blocking files that can seek may also move backwards.
+        """
+        if position == self.position:
+            return
+        if not self.is_async and self.stream.seekable():
+            await self.run(self.stream.seek, position)
+            self.position = position
+            return
+        if position < self.position:
+            raise RuntimeError(
+                "Cannot seek back to %d on a stream at %d" % (position, self.position)
+            )
+        skip = bytearray(min(MIN_CHUNK_SIZE, position - self.position))
+        while self.position < position:
+            view = memoryview(skip)[: position - self.position]
+            if not await self.readinto(view):
+                raise RuntimeError("Stream ended at %d, before %d" % (self.position, position))
+
+    async def aclose(self) -> None:
+        if self.owned:
+            await self.run(self.stream.close)
+
+
+class _Writer:
+    """
+    Writer over a blocking file, written on the executor, or an async byte stream with
+    either an awaitable `write` or a `drain`, such as `asyncio.StreamWriter`.
+    """
+
+    def __init__(self, stream, run: _Run, *, owned: bool = False) -> None:
+        self.stream = stream
+        self.run = run
+        self.owned = owned
+        self.is_async = _is_async(stream.write) or hasattr(stream, "drain")
+
+    async def write(self, data: memoryview) -> None:
+        if not self.is_async:
+            await self.run(_write_full, self.stream, data)
+            return
+        # async streams may hold on to the buffer, which is reused for the next chunk
+        data = bytes(data)
+        if _is_async(self.stream.write):
+            await self.stream.write(data)
+        else:
+            self.stream.write(data)
+            await self.stream.drain()
+
+    async def aclose(self) -> None:
+        if self.owned:
+            await self.run(self.stream.close)
+
+
+def _write_full(file: io.BufferedWriter, view: memoryview) -> None:
+    written = 0
+    while written < len(view):
+        written += file.write(view[written:])
+
+
+def _copy_chunk(
+    src: io.BufferedReader, dst: io.BufferedWriter, view: memoryview, xor_mask: bytes, offset: int
+) -> int:
+    """
+    Reads, masks and writes one chunk between blocking files, in one trip to the executor.
+    """
+    read = _readinto_full(src, view)
+    mask_into(view[:read], xor_mask, offset)
+    _write_full(dst, view[:read])
+    return read
+
+
+async def _copy_masked(
+    reader: _Reader,
+    writer: _Writer,
+    *,
+    xor_mask: bytes,
+    size: int,
+    chunk_size: int,
+) -> int:
+    """
+    Copies `size` bytes from `reader` to `writer`, masking them on the way.
+
+    Every chunk is awaited, so a cancelled task stops within one chunk of where it was,
+    even in the middle of a member.
+
+    Returns:
+        int: The number of bytes copied.
+    """
+    run = reader.run
+    buf = bytearray(min(chunk_size, size))
+    view = memoryview(buf)
+    copied = 0
+    both_blocking = not reader.is_async and not writer.is_async
+    while copied < size:
+        chunk = view[: min(chunk_size, size - copied)]
+        if both_blocking:
+            read = await run(_copy_chunk, reader.stream, writer.stream, chunk, xor_mask, copied)
+            reader.position += read
+        else:
+            read = await reader.readinto(chunk)
+            await run(mask_into, chunk[:read], xor_mask, copied)
+            await writer.write(chunk[:read])
+        if not read:
+            break
+        copied += read
+    return copied
+
+
+async def _read_tables(
+    reader: _Reader, run: _Run, *, metadata_only: bool = False
+) -> Tuple[SngHeader, SngMetadataInfo, List[SngFileMetadata]]:
+    """
+    Reads the header, metadata, file table and data section length in order, then parses them.
+    With `metadata_only`, stops after the metadata and returns an empty file table.
+    """
+    head = await reader.read_exactly(HEADER.size + U64.size, "Header")
+    metadata_len = U64.unpack_from(head, HEADER.size)[0]
+    if metadata_only:
+        metadata = await reader.read_exactly(metadata_len, "Metadata")
+        tables = io.BytesIO(b"".join((head, metadata)))
+        header = read_sng_header(tables)
+        if header.file_identifier != b"SNGPKG":
+            raise TypeError("Invalid file identifier")
+        return header, await run(decode_metadata, tables), []
+
+    metadata = await reader.read_exactly(metadata_len + U64.size, "Metadata")
+    file_meta_len = U64.unpack_from(metadata, metadata_len)[0]
+    file_meta = await reader.read_exactly(file_meta_len + U64.size, "File metadata")
+
+    def parse():
+        tables = io.BytesIO(b"".join((head, metadata, file_meta)))
+        header, metadata_info, file_meta_array = read_sng_tables(tables)
+        read_file_data_len(file_meta_array, tables)
+        return header, metadata_info, file_meta_array
+
+    return await run(parse)
+
+
+async def _open_reader(sng_file, run: _Run) -> _Reader:
+    if isinstance(sng_file, str):
+        sng_file = _as_path_obj(sng_file)
+    if isinstance(sng_file, os.PathLike):
+        _validate_path(sng_file)
+        return _Reader(await run(open, sng_file, "rb"), run, owned=True)
+    return _Reader(sng_file, run)
+
+
+async def _extract_member(
+    reader: _Reader,
+    file_meta: SngFileMetadata,
+    *,
+    xor_mask: bytes,
+    outdir: os.PathLike,
+    chunk_size: Optional[int],
+) -> None:
+    run = reader.run
+    file_path = os.path.join(outdir, file_meta.filename)
+    logger.debug("Writing file %s", file_meta.filename)
+    await reader.seek(file_meta.content_idx)
+    writer = _Writer(await run(open, file_path, "wb"), run, owned=True)
+    try:
+        copied = await _copy_masked(
+            reader,
+            writer,
+            xor_mask=xor_mask,
+            size=file_meta.content_len,
+            chunk_size=chunk_size or _chunk_size_for(writer.stream),
+        )
+        _check_written(file_meta, copied)
+    except BaseException:
+        await writer.aclose()
+        # don't leave a truncated file behind, including on cancellation
+        await run(os.remove, file_path)
+        raise
+    await writer.aclose()
+    logger.debug("Wrote %s in %s", file_meta.filename, outdir)
+
+
+async def async_decode_sng(
+    sng_file,
+    *,
+    outdir: Optional[os.PathLike | str] = None,
+    allow_nonsng_files: bool = False,
+    sng_dir: Optional[os.PathLike | str] = None,
+    overwrite: bool = False,
+    include: Optional[Iterable[str]] = None,
+    exclude: Optional[Iterable[str]] = None,
+    metadata_only: bool = False,
+    executor: Optional[Executor] = None,
+    limit: Optional[asyncio.Semaphore] = None,
+    chunk_size: Optional[int] = None,
+) -> str:
+    """
+    Decodes an SNG file like `decode_sng`, without blocking the event loop.
+
+    Blocking file I/O and masking run on `executor`, one chunk at a time, so cancelling the
+    task stops within a chunk, removing the partially written file. The archive is read
+    strictly forward, so it can come from an async byte stream such as a socket.
+
+    Args:
+        sng_file (os.PathLike | str | BufferedReader | async stream): The SNG file to decode.
+            Async streams need an awaitable `read(n)`, like `asyncio.StreamReader`.
+        outdir (os.PathLike | str, optional): The base output directory for decoded content. Defaults to the current directory.
+        allow_nonsng_files (bool, optional): Allow decoding of files not allowed by the sng standard. Defaults to False.
+        sng_dir (os.PathLike | str, optional): The specific directory within outdir to write the decoded content. Generated from metadata if not specified.
+        overwrite (bool, optional): If True, existing files or directories will be overwritten. Defaults to False.
+        include (Iterable[str], optional): Glob patterns of the files to decode. Defaults to every file.
+        exclude (Iterable[str], optional): Glob patterns of files not to decode.
+        metadata_only (bool, optional): Only write song.ini, without reading the file table. Defaults to False.
+        executor (Executor, optional): Executor running the blocking work. Defaults to `get_executor()`.
+        limit (asyncio.Semaphore, optional): Bounds the archives in flight. Defaults to `archive_semaphore()`.
+        chunk_size (int, optional): Bytes copied per trip to the executor. Defaults to one based on the file system block size.
+
+    Returns:
+        str: The directory the song was written to.
+    """
+    run = _runner(executor)
+    async with limit or archive_semaphore():
+        reader = await _open_reader(sng_file, run)
+        try:
+            header, metadata, file_meta_array = await _read_tables(
+                reader, run, metadata_only=metadata_only
+            )
+            outdir = await run(
+                _create_song_dir, metadata, _base_outdir(outdir), sng_dir, overwrite
+            )
+            logger.info("Writing decoded sng file to %s", outdir)
+            to_extract = _members_to_extract(
+                file_meta_array, allow_nonsng_files, include=include, exclude=exclude
+            )
+            # members are read in file order so streams never seek back
+            for file_meta in sorted(to_extract, key=lambda x: x.content_idx):
+                await _extract_member(
+                    reader,
+                    file_meta,
+                    xor_mask=header.xor_mask,
+                    outdir=outdir,
+                    chunk_size=chunk_size,
+                )
+        finally:
+            await reader.aclose()
+    logger.info("Wrote sng file output in %s", outdir)
+    return outdir
+
+
+async def async_encode_sng(
+    dir_to_encode: os.PathLike,
+    output_filename,
+    *,
+    allow_nonsng_files: bool = False,
+    overwrite: bool = False,
+    version: int = 1,
+    xor_mask: Optional[bytes] = None,
+    metadata: Optional[SngMetadataInfo] = None,
+    encode_audio: bool = True,
+    transcode_cache: Optional[TranscodeCache] = None,
+    executor: Optional[Executor] = None,
+    limit: Optional[asyncio.Semaphore] = None,
+    chunk_size: Optional[int] = None,
+) -> None:
+    """
+    Encodes a directory like `encode_sng`, without blocking the event loop.
+
+    The archive is written strictly forward, so the output can be an async byte stream.
+    Blocking file I/O, masking and transcoding run on `executor`, and file contents are
+    copied one chunk at a time, so cancelling the task stops within a chunk. A partially
+    written output file is removed.
+
+    Args:
+        dir_to_encode (os.PathLike): The directory containing files to be encoded into the SNG package.
+        output_filename (os.PathLike | str | BufferedWriter | async stream): The output path of the SNG file, or a
+            writable stream. Async streams need an awaitable `write`, or a `drain` like `asyncio.StreamWriter`.
+            Unlike `encode_sng`, there is no md5 derived default.
+        allow_nonsng_files (bool, optional): Allow encoding of files not allowed by the sng standard. Defaults to False.
+        overwrite (bool, optional): If True, an existing output file will be overwritten. Defaults to False.
+        version (int, optional): The version of the SNG format to use. Defaults to 1.
+        xor_mask (bytes, optional): An optional XOR mask for encryption. If not provided, a random one is generated.
+        metadata (SngMetadataInfo, optional): Metadata for the SNG package. If not provided, it's read from a 'song.ini' file in the directory.
+        encode_audio (bool, optional): Transcode audio files to opus. Defaults to True.
+        transcode_cache (TranscodeCache, optional): On-disk cache of opus transcodes, such as `TRANSCODE_CACHE`. Defaults to None, always transcoding.
+        executor (Executor, optional): Executor running the blocking work. Defaults to `get_executor()`.
+        limit (asyncio.Semaphore, optional): Bounds the archives in flight. Defaults to `archive_semaphore()`.
+        chunk_size (int, optional): Bytes copied per trip to the executor. Defaults to one based on the file system block size.
+
+    Returns:
+        None
+    """
+    run = _runner(executor)
+    async with limit or archive_semaphore():
+        write_args = await run(
+            _encode_args,
+            dir_to_encode,
+            version=version,
+            xor_mask=xor_mask,
+            metadata=metadata,
+            allow_nonsng_files=allow_nonsng_files,
+            encode_audio=encode_audio,
+            transcode_cache=transcode_cache,
+        )
+        tables = io.BytesIO()
+        executor = executor or get_executor()
+        planned = executor.submit(
+            _write_tables_forward, tables, dir_to_encode, **write_args
+        )
+        try:
+            members, transcoded = await asyncio.wrap_future(planned)
+        except asyncio.CancelledError:
+            # transcoding keeps running on the executor, its outputs are freed once it is done
+            planned.add_done_callback(_close_transcoded)
+            raise
+
+        output_path = None
+        try:
+            if isinstance(output_filename, (str, os.PathLike)):
+                output_path = _output_path(output_filename, overwrite)
+                writer = _Writer(await run(open, output_path, "wb"), run, owned=True)
+            else:
+                writer = _Writer(output_filename, run)
+            try:
+                await writer.write(tables.getbuffer())
+                for source, file_meta in members:
+                    await _add_member(
+                        writer,
+                        source,
+                        file_meta,
+                        xor_mask=write_args["xor_mask"],
+                        chunk_size=chunk_size,
+                    )
+            finally:
+                await writer.aclose()
+        except BaseException:
+            if output_path is not None and os.path.exists(output_path):
+                await run(os.remove, output_path)
+            raise
+        finally:
+            for tmpfile in transcoded.values():
+                tmpfile.close()
+    logger.info("Wrote sng file to %s", output_path or "stream")
+
+
+def _close_transcoded(planned: concurrent.futures.Future) -> None:
+    """
+    Frees the transcoded outputs of a planned archive that was abandoned. Internal function.
+    """
+    if planned.cancelled() or planned.exception() is not None:
+        return
+    for tmpfile in planned.result()[1].values():
+        tmpfile.close()
+
+
+async def _add_member(
+    writer: _Writer,
+    source: str | io.BufferedReader,
+    file_meta: SngFileMetadata,
+    *,
+    xor_mask: bytes,
+    chunk_size: Optional[int],
+) -> None:
+    run = writer.run
+    logger.debug("Writing %s to file", file_meta.filename)
+    if isinstance(source, str):
+        reader = _Reader(await run(open, source, "rb"), run, owned=True)
+    else:
+        reader = _Reader(source, run)
+    try:
+        copied = await _copy_masked(
+            reader,
+            writer,
+            xor_mask=xor_mask,
+            size=file_meta.content_len,
+            chunk_size=chunk_size or _chunk_size_for(reader.stream),
+        )
+    finally:
+        await reader.aclose()
+    if copied != file_meta.content_len:
+        raise RuntimeError(
+            "Wrote %d bytes when expected %d bytes" % (copied, file_meta.content_len)
+        )
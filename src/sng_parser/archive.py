@@ -0,0 +1,443 @@
+import io
+import logging
+import mmap
+import os
+import stat
+
+from collections.abc import Mapping
+from io import BufferedReader
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .common import (
+    SngFileMetadata,
+    SngHeader,
+    SngMetadataInfo,
+    mask_into,
+    _fail_on_short_sng,
+)
+from .cache import TABLE_CACHE, SngTableCache, SngTables, cache_key
+from .decode import read_file_data_len, read_sng_tables
+
+__all__ = ["SngArchive", "SngMemberReader", "SngMembers", "decode_sng_to_mapping"]
+
+logger = logging.getLogger(__package__)
+
+
+class _ViewReader(io.RawIOBase):
+    """
+    Minimal file object reading from a buffer without copying it, to parse tables
+    of an SNG file held in memory. Internal use.
+    """
+
+    def __init__(self, view: memoryview) -> None:
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        data = self._view[self._pos : self._pos + len(buf)]
+        buf[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+def _parse_tables(buffer: mmap.mmap | _ViewReader) -> SngTables:
+    """
+    Parses and validates the tables of a mapped SNG file. Internal use.
+    """
+    header, metadata, file_meta_array = read_sng_tables(buffer)
+    read_file_data_len(file_meta_array, buffer)
+    return SngTables(header, metadata, file_meta_array)
+
+
+class SngArchive:
+    """
+    Random access reader for an SNG file.
+
+    The file is memory-mapped once, or used in place when it is already in memory, and
+    the header, metadata and file table are parsed when the archive is opened. Members
+    are unmasked only when read, and reads never touch a shared file position, so one
+    archive can be used from several threads.
+
+    Example:
+        with SngArchive('example.sng') as sng:
+            chart = sng.read('notes.chart')
+    """
+
+    def __init__(
+        self,
+        sng_file: os.PathLike | str | BufferedReader | bytes | bytearray | memoryview,
+        *,
+        cache: Optional[SngTableCache] = TABLE_CACHE,
+    ) -> None:
+        """
+        Opens and parses an SNG file.
+
+        Args:
+            sng_file (os.PathLike | str | BufferedReader | bytes): Path to the SNG file, a file opened in binary mode, or the SNG file itself as a buffer. A passed file is not closed by the archive, and one that isn't a regular file, such as `io.BytesIO`, a pipe or a socket, is read from its current position to the end.
+            cache (SngTableCache, optional): Cache of parsed tables, used when the file has a path. Pass None to always parse. Defaults to the shared `TABLE_CACHE`.
+
+        Raises:
+            FileNotFoundError: When no file exists at the given path
+            TypeError: When the file is not an SNG file
+            RuntimeError: When the file is shorter than the header, or the sections of the file do not match their recorded sizes
+        """
+        self._mmap: Optional[mmap.mmap] = None
+        self._closed = False
+        path = st = None
+        if isinstance(sng_file, (bytes, bytearray, memoryview)):
+            self._view = memoryview(sng_file).cast("B")
+            _fail_on_short_sng(len(self._view))
+        elif isinstance(sng_file, (str, os.PathLike)):
+            if not os.path.exists(sng_file):
+                raise FileNotFoundError("No file located at %s" % sng_file)
+            with open(sng_file, "rb") as f:
+                st = os.fstat(f.fileno())
+                if stat.S_ISREG(st.st_mode):
+                    path = sng_file
+                    _fail_on_short_sng(st.st_size)
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self._view = self._read_all(f)
+        else:
+            try:
+                st = os.fstat(sng_file.fileno())
+            except (AttributeError, io.UnsupportedOperation):
+                st = None
+            if st is not None and stat.S_ISREG(st.st_mode):
+                path = getattr(sng_file, "name", None)
+                _fail_on_short_sng(st.st_size)
+                self._mmap = mmap.mmap(sng_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._view = self._read_all(sng_file)
+        if self._mmap is not None:
+            self._view = memoryview(self._mmap)
+        try:
+            if self._mmap is None:
+                tables = _parse_tables(_ViewReader(self._view))
+            elif cache is not None and isinstance(path, (str, os.PathLike)):
+                key = cache_key(os.path.abspath(path), st)
+                tables = cache.get_or_parse(key, lambda: _parse_tables(self._mmap))
+            else:
+                tables = _parse_tables(self._mmap)
+            self._header = tables.header
+            self._metadata = dict(tables.metadata)
+            self._members: Dict[str, SngFileMetadata] = {
+                file_meta.filename: file_meta for file_meta in tables.files
+            }
+            self._validate_member_ranges()
+        except BaseException:
+            self.close()
+            raise
+
+    @staticmethod
+    def _read_all(sng_file: BufferedReader) -> memoryview:
+        """
+        Reads a file that can't be mapped, such as a pipe or an in-memory buffer, to its end. Internal use.
+        """
+        logger.debug("Not a regular file, reading it into memory")
+        view = memoryview(sng_file.read())
+        _fail_on_short_sng(len(view))
+        return view
+
+    def _validate_member_ranges(self) -> None:
+        """
+        Ensures every member lies within the mapped file. Internal use.
+        """
+        size = len(self._view)
+        for file_meta in self._members.values():
+            if file_meta.content_idx + file_meta.content_len > size:
+                raise RuntimeError(
+                    "File content of %s exceeds the sng file size. Expected at most %d, got %d"
+                    % (
+                        file_meta.filename,
+                        size,
+                        file_meta.content_idx + file_meta.content_len,
+                    )
+                )
+
+    @property
+    def header(self) -> SngHeader:
+        """The parsed header of the SNG file."""
+        return self._header
+
+    @property
+    def metadata(self) -> SngMetadataInfo:
+        """The song metadata stored in the SNG file."""
+        return self._metadata
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def members(self) -> List[SngFileMetadata]:
+        """
+        Lists the files stored in the SNG file, in file table order.
+
+        Returns:
+            List[SngFileMetadata]: The metadata of every member.
+        """
+        return list(self._members.values())
+
+    def getmember(self, name: str) -> SngFileMetadata:
+        """
+        Looks up a member by filename.
+
+        Args:
+            name (str): The filename of the member.
+
+        Returns:
+            SngFileMetadata: The metadata of the member.
+
+        Raises:
+            KeyError: When no member has the given name
+        """
+        try:
+            return self._members[name]
+        except KeyError:
+            raise KeyError("No file named %s in the sng file" % name) from None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._members
+
+    def read(self, name: str, offset: int = 0, size: Optional[int] = None) -> bytearray:
+        """
+        Reads and unmasks the contents of a member.
+
+        Args:
+            name (str): The filename of the member.
+            offset (int, optional): Position inside the member to start reading at. Defaults to 0.
+            size (int, optional): Maximum amount of bytes to read. Defaults to the rest of the member.
+
+        Returns:
+            bytearray: The unmasked contents.
+
+        Raises:
+            KeyError: When no member has the given name
+            ValueError: When the archive is closed or `offset` is negative
+        """
+        if offset < 0:
+            raise ValueError("Negative offset %d" % offset)
+        file_meta = self.getmember(name)
+        remaining = max(file_meta.content_len - offset, 0)
+        data = bytearray(remaining if size is None else min(size, remaining))
+        self._readinto(file_meta, offset, data)
+        return data
+
+    def open_member(self, name: str) -> "SngMemberReader":
+        """
+        Opens a member as a read-only, seekable binary file object.
+
+        The member is unmasked as it is read, so large files can be streamed
+        without loading them into memory.
+
+        Args:
+            name (str): The filename of the member.
+
+        Returns:
+            SngMemberReader: A file object over the unmasked contents of the member.
+
+        Raises:
+            KeyError: When no member has the given name
+        """
+        return SngMemberReader(self, self.getmember(name))
+
+    def _readinto(self, file_meta: SngFileMetadata, offset: int, buf) -> int:
+        """
+        Copies member contents starting at `offset` into `buf` and unmasks them. Internal use.
+
+        Returns:
+            int: The number of bytes copied.
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed sng file")
+        view = memoryview(buf).cast("B")
+        size = max(min(len(view), file_meta.content_len - offset), 0)
+        start = file_meta.content_idx + offset
+        view[:size] = self._view[start : start + size]
+        mask_into(view[:size], self._header.xor_mask, offset)
+        return size
+
+    def close(self) -> None:
+        """
+        Unmaps the SNG file. Reading from a closed archive raises a ValueError.
+        """
+        self._closed = True
+        self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __enter__(self) -> "SngArchive":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        if self.closed:
+            return "<SngArchive closed>"
+        return "<SngArchive version=%d members=%d>" % (
+            self._header.version,
+            len(self._members),
+        )
+
+
+class SngMemberReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over a single member of an `SngArchive`.
+
+    Each read unmasks only the requested range, with the keystream aligned to
+    the position inside the member. Created with `SngArchive.open_member`.
+    """
+
+    def __init__(self, archive: SngArchive, file_meta: SngFileMetadata) -> None:
+        super().__init__()
+        self._archive = archive
+        self._file_meta = file_meta
+        self._pos = 0
+        self.name = file_meta.filename
+
+    @property
+    def size(self) -> int:
+        """The unmasked size of the member."""
+        return self._file_meta.content_len
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        self._checkClosed()
+        read = self._archive._readinto(self._file_meta, self._pos, buf)
+        self._pos += read
+        return read
+
+    def readall(self) -> bytes:
+        self._checkClosed()
+        data = self._archive.read(self._file_meta.filename, self._pos)
+        self._pos += len(data)
+        return bytes(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._file_meta.content_len + offset
+        else:
+            raise ValueError("Invalid whence (%r)" % whence)
+        if pos < 0:
+            raise ValueError("Negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+
+    def tell(self) -> int:
+        self._checkClosed()
+        return self._pos
+
+
+class SngMembers(Mapping):
+    """
+    Read-only mapping of the filenames of an SNG file to their unmasked contents,
+    returned by `decode_sng_to_mapping`.
+
+    Nothing is unmasked until a member is looked up, and each lookup unmasks the member
+    again, so keep the value rather than looking it up repeatedly. Values are read-only
+    memoryviews, which stay valid after the mapping is closed.
+    """
+
+    def __init__(self, archive: SngArchive, max_size: Optional[int] = None) -> None:
+        self._archive = archive
+        self.max_size = max_size
+
+    def __getitem__(self, name: str) -> memoryview:
+        file_meta = self._archive.getmember(name)
+        if self.max_size is not None and file_meta.content_len > self.max_size:
+            raise ValueError(
+                "%s is %d bytes, more than the limit of %d bytes"
+                % (name, file_meta.content_len, self.max_size)
+            )
+        return memoryview(self._archive.read(name)).toreadonly()
+
+    def __iter__(self) -> Iterator[str]:
+        return (file_meta.filename for file_meta in self._archive.members())
+
+    def __len__(self) -> int:
+        return len(self._archive.members())
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._archive
+
+    def sizes(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dict[str, int]: The unmasked size of each member, without reading any.
+        """
+        return {
+            file_meta.filename: file_meta.content_len for file_meta in self._archive.members()
+        }
+
+    def close(self) -> None:
+        """
+        Releases the SNG file. Looking up a member of a closed mapping raises a ValueError.
+        """
+        self._archive.close()
+
+    def __enter__(self) -> "SngMembers":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def decode_sng_to_mapping(
+    sng_file: os.PathLike | str | BufferedReader | bytes | bytearray | memoryview,
+    *,
+    max_size: Optional[int] = None,
+    cache: Optional[SngTableCache] = TABLE_CACHE,
+) -> Tuple[SngMetadataInfo, SngMembers]:
+    """
+    Decodes an SNG file to its metadata and a lazy mapping of its members, without
+    writing anything to disk.
+
+    Example:
+        metadata, members = decode_sng_to_mapping(request_body)
+        with members:
+            chart = members['notes.chart']
+
+    Args:
+        sng_file (os.PathLike | str | BufferedReader | bytes): Path to the SNG file, a file opened in binary mode, or the SNG file itself as a buffer. Pipes and sockets, such as `sys.stdin.buffer`, are read to their end.
+        max_size (int, optional): Largest member, in bytes, that may be looked up. Larger ones raise a ValueError instead of being unmasked. Defaults to no limit.
+        cache (SngTableCache, optional): Cache of parsed tables, used when the file has a path. Defaults to the shared `TABLE_CACHE`.
+
+    Returns:
+        Tuple[SngMetadataInfo, SngMembers]: The song metadata and the members. Close the mapping, or use it as a context manager, to release the file.
+
+    Raises:
+        FileNotFoundError: When no file exists at the given path
+        TypeError: When the file is not an SNG file
+        RuntimeError: When the sections of the file do not match their recorded sizes
+    """
+    archive = SngArchive(sng_file, cache=cache)
+    return dict(archive.metadata), SngMembers(archive, max_size)
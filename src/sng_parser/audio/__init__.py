@@ -1,6 +1,15 @@
-from .parallel_transcode import eval_audio_futures, parllel_transcode_opus
+from .cache import TRANSCODE_CACHE, TranscodeCache, TranscodeCacheStats
+from .parallel_transcode import (
+    collect_audio_futures,
+    eval_audio_futures,
+    parllel_transcode_opus,
+)
 
 __all__ = [
+    'collect_audio_futures',
     'eval_audio_futures',
-    'parllel_transcode_opus'
+    'parllel_transcode_opus',
+    'TRANSCODE_CACHE',
+    'TranscodeCache',
+    'TranscodeCacheStats',
 ]
\ No newline at end of file
@@ -0,0 +1,315 @@
+import hashlib
+import logging
+import os
+
+from typing import BinaryIO, Dict, NamedTuple, Optional, Tuple
+
+from ..common import U64
+from .convert import OPUS_SETTINGS
+
+__all__ = ["TranscodeCache", "TranscodeCacheStats", "TRANSCODE_CACHE"]
+
+logger = logging.getLogger(__package__)
+
+# Default bound of the on-disk size of a cache
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Environment variable overriding the location of the default cache
+CACHE_DIR_ENV = "SNG_PARSER_CACHE_DIR"
+
+_ENTRY_EXT = ".opus-entry"
+_HASH_CHUNK_SIZE = 1 << 20
+
+# Size on disk of each cache directory as of its last listing, plus the entries this
+# process added since, so not every write has to list the directory
+_known_sizes: Dict[str, int] = {}
+
+
+class TranscodeCacheStats(NamedTuple):
+    """
+    Counters of a `TranscodeCache`, along with its current size on disk.
+    """
+
+    hits: int
+    misses: int
+    seconds_saved: float
+    entries: int
+    size: int
+
+
+def default_cache_dir() -> str:
+    """
+    Returns:
+        str: `$SNG_PARSER_CACHE_DIR`, or `sng_parser/opus` under `$XDG_CACHE_HOME` (defaulting to `~/.cache`).
+    """
+    directory = os.environ.get(CACHE_DIR_ENV)
+    if directory:
+        return directory
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "sng_parser", "opus")
+
+
+class TranscodeCache:
+    """
+    On-disk cache of opus transcodes, keyed by the hash of the source audio and the encoder
+    settings, so a file is only transcoded again when either changes.
+
+    Each entry is one file holding the time its transcode took followed by the opus data.
+    Entries are evicted least recently used first, by modification time, which is updated
+    on every hit, once the cache grows past `max_bytes`. Several processes can share a cache.
+
+    Caching is best effort: a cache that can't be read or written, such as a read-only or
+    missing directory, is logged and treated as empty, and audio is transcoded as usual.
+    """
+
+    def __init__(
+        self, directory: Optional[os.PathLike | str] = None, max_bytes: int = DEFAULT_MAX_BYTES
+    ) -> None:
+        """
+        Args:
+            directory (os.PathLike | str, optional): Location of the cache. Defaults to `default_cache_dir()`, resolved on use.
+            max_bytes (int, optional): Maximum size of the cache on disk. Defaults to 2 GiB.
+        """
+        self._directory = directory
+        self.max_bytes = max_bytes
+        self._hits = 0
+        self._misses = 0
+        self._seconds_saved = 0.0
+
+    @property
+    def directory(self) -> str:
+        if self._directory is None:
+            return default_cache_dir()
+        return os.fspath(self._directory)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + _ENTRY_EXT)
+
+    @staticmethod
+    def hash_source(
+        filepath: os.PathLike | str, *, key: bool = True, md5: bool = False
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Hashes a source audio file in a single read, for the key of its transcode and its md5,
+        so callers naming the sng file don't read it again. Callable without a cache.
+
+        Args:
+            filepath (os.PathLike | str): The audio file to transcode.
+            key (bool, optional): Compute the key. Defaults to True.
+            md5 (bool, optional): Compute the md5 of the file. Defaults to False.
+
+        Returns:
+            Tuple[Optional[str], Optional[str]]: The key and the md5, each None if not asked for.
+        """
+        keyhash = hashlib.sha256(repr(sorted(OPUS_SETTINGS.items())).encode()) if key else None
+        md5hash = hashlib.md5() if md5 else None
+        hashes = [filehash for filehash in (keyhash, md5hash) if filehash is not None]
+        if hashes:
+            with open(filepath, "rb") as f:
+                while chunk := f.read(_HASH_CHUNK_SIZE):
+                    for filehash in hashes:
+                        filehash.update(chunk)
+        return (
+            keyhash.hexdigest() if keyhash is not None else None,
+            md5hash.hexdigest() if md5hash is not None else None,
+        )
+
+    def key(self, filepath: os.PathLike | str) -> str:
+        """
+        Hashes a source audio file together with the encoder settings.
+
+        Args:
+            filepath (os.PathLike | str): The audio file to transcode.
+
+        Returns:
+            str: The key of its transcode.
+        """
+        return self.hash_source(filepath)[0]
+
+    def open_entry(self, key: str) -> Optional[Tuple[BinaryIO, int, float]]:
+        """
+        Opens a transcode without counting the lookup, so the opus data can be streamed
+        rather than read at once. The caller closes the file.
+
+        Args:
+            key (str): Key from `key`.
+
+        Returns:
+            Optional[Tuple[BinaryIO, int, float]]: The entry positioned at the opus data, the size of the data and the seconds its transcode took, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        except OSError as err:
+            logger.warning("Unable to read transcode cache entry %s: %s", path, err)
+            return None
+        try:
+            size = os.fstat(f.fileno()).st_size - U64.size
+            prefix = f.read(U64.size)
+        except OSError as err:
+            logger.warning("Unable to read transcode cache entry %s: %s", path, err)
+            f.close()
+            return None
+        if len(prefix) < U64.size:
+            # a truncated entry is dropped and transcoded again
+            logger.warning("Dropping corrupt transcode cache entry %s", path)
+            f.close()
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError as err:
+            logger.debug("Unable to mark %s as used: %s", path, err)
+        return f, size, U64.unpack(prefix)[0] / 1e6
+
+    def record_lookup(self, hit: bool, seconds_saved: float = 0.0) -> None:
+        """
+        Counts a lookup made with `open_entry`, possibly by another process.
+
+        Args:
+            hit (bool): Whether the transcode was found.
+            seconds_saved (float, optional): How long the transcode took, for hits. Defaults to 0.
+        """
+        if hit:
+            self._hits += 1
+            self._seconds_saved += seconds_saved
+        else:
+            self._misses += 1
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Looks up a transcode, counting the hit or miss.
+
+        Args:
+            key (str): Key from `key`.
+
+        Returns:
+            Optional[bytes]: The opus data, or None on a miss.
+        """
+        entry = self.open_entry(key)
+        if entry is None:
+            self.record_lookup(False)
+            return None
+        f, size, seconds = entry
+        try:
+            with f:
+                data = f.read(size)
+        except OSError as err:
+            logger.warning("Unable to read transcode cache entry %s: %s", key, err)
+            self.record_lookup(False)
+            return None
+        logger.debug("Transcode cache hit %s, saved %.2fs", key, seconds)
+        self.record_lookup(True, seconds)
+        return data
+
+    def put(self, key: str, data, seconds: float) -> None:
+        """
+        Stores a transcode, then evicts entries if the cache grew past `max_bytes`. The entry
+        is written to a temporary file and renamed, so readers never see it partially written.
+
+        The size of the cache is tracked per process from the last time its entries were listed,
+        so they are only listed again once it goes over `max_bytes`.
+
+        Args:
+            key (str): Key from `key`.
+            data (bytes-like): The opus data.
+            seconds (float): How long the transcode took, reported as saved on later hits.
+        """
+        directory = self.directory
+        tmp_path = os.path.join(directory, ".%s.tmp" % os.urandom(8).hex())
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, "xb") as f:
+                f.write(U64.pack(int(seconds * 1e6)))
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as err:
+            # caching is best effort, a full or read-only disk doesn't fail the encode
+            logger.warning("Unable to cache transcode %s: %s", key, err)
+            self._remove(tmp_path)
+            return
+        size = _known_sizes.get(directory)
+        if size is None:
+            size = self._scan()[1]
+        else:
+            size += U64.size + memoryview(data).nbytes
+        _known_sizes[directory] = size
+        if size > self.max_bytes:
+            self.trim()
+
+    def trim(self) -> int:
+        """
+        Evicts least recently used entries until the cache fits in `max_bytes`.
+
+        Returns:
+            int: The number of evicted entries.
+        """
+        entries, size = self._scan()
+        evicted = 0
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            if self._remove(path):
+                evicted += 1
+            size -= entry_size
+        _known_sizes[self.directory] = size
+        if evicted:
+            logger.debug("Evicted %d transcode cache entries", evicted)
+        return evicted
+
+    def _scan(self) -> Tuple[list, int]:
+        entries = []
+        size = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith(_ENTRY_EXT):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                    size += st.st_size
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logger.warning("Unable to list transcode cache %s: %s", self.directory, err)
+        return entries, size
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # evicted by another process sharing the cache
+            return False
+        except OSError as err:
+            logger.warning("Unable to remove transcode cache entry %s: %s", path, err)
+            return False
+        return True
+
+    def clear(self) -> None:
+        """
+        Deletes every entry. Counters are kept.
+        """
+        for _, _, path in self._scan()[0]:
+            self._remove(path)
+        _known_sizes.pop(self.directory, None)
+
+    def stats(self) -> TranscodeCacheStats:
+        """
+        Returns:
+            TranscodeCacheStats: Hits, misses and transcode time saved by this instance, along with the entries and size on disk.
+        """
+        entries, size = self._scan()
+        return TranscodeCacheStats(
+            self._hits, self._misses, self._seconds_saved, len(entries), size
+        )
+
+
+# Shared cache in the default location, used by the CLI. Library callers opt in by passing it
+TRANSCODE_CACHE = TranscodeCache()
@@ -1,22 +1,81 @@
 import os
 
-from io import BytesIO, BufferedWriter
+from io import BufferedWriter
+
 import soundfile as sf
 
+# Settings `to_opus` encodes with, part of the transcode cache key. Bump the version
+# whenever the output of `to_opus` changes.
+OPUS_SETTINGS = {
+    "format": "OGG",
+    "subtype": "OPUS",
+    "libsndfile": sf.__libsndfile_version__,
+    "version": 2,
+}
+
+# Sample rates the opus encoder of libsndfile accepts
+OPUS_SAMPLERATES = (8000, 12000, 16000, 24000, 48000)
+
+# Upper bound of the decoded samples held at once, per transcode
+BLOCK_BYTES = 1 << 20
+# Opus encodes 20ms frames, blocks are a whole number of them
+_OPUS_FRAMES_PER_SECOND = 50
+
+
+def block_frames(samplerate: int, channels: int) -> int:
+    """
+    Picks how many frames to decode and encode at once: as many whole 20ms opus frames
+    as fit in `BLOCK_BYTES` of float32 samples, and at least one.
+
+    Args:
+        samplerate (int): Sample rate of the audio.
+        channels (int): Channel count of the audio.
+
+    Returns:
+        int: The block size in frames.
+    """
+    # numpy is only needed to transcode, so importing sng_parser doesn't require it
+    import numpy as np
+
+    opus_frame = max(1, samplerate // _OPUS_FRAMES_PER_SECOND)
+    frames = BLOCK_BYTES // (channels * np.dtype(np.float32).itemsize)
+    return max(opus_frame, frames // opus_frame * opus_frame)
+
+
+def to_opus(filepath: os.PathLike | str, buf: BufferedWriter) -> None:
+    """
+    Transcodes an audio file to ogg opus, writing the encoded pages to `buf` as they are produced.
+
+    Audio is decoded one block at a time into a single reused array, so memory use does not
+    depend on the length of the track.
+
+    Args:
+        filepath (os.PathLike | str): The audio file to transcode.
+        buf (BufferedWriter): Destination of the opus data. Needs to be seekable.
+
+    Raises:
+        ValueError: When the sample rate of the file is not supported by opus
+    """
+    import numpy as np
 
-def to_opus(filepath: str, buf: BufferedWriter) -> None:
-    with sf.SoundFile(filepath, 'r') as f:
-        filename, _ = filepath.split('.')
-        size = f.seek(0, os.SEEK_END)
-        chunk_size = 1024
-        f.seek(0)
-        out= BytesIO()
-        # BufferedWriter(BytesIO())
-        out.name = filename+".opus"
-        with sf.SoundFile(out, 'w', samplerate=f.samplerate, channels=f.channels, format='ogg', subtype='Opus') as g:
-            while f.tell() != size:
-                if size - f.tell() < chunk_size:
-                    chunk_size = size - f.tell()
-                g.write(f.read(chunk_size))
-                buf.write(out.read(chunk_size))
-                out.seek(0)
+    with sf.SoundFile(filepath, "r") as src:
+        if src.samplerate not in OPUS_SAMPLERATES:
+            raise ValueError(
+                "Opus only supports sample rates of %s Hz, %s is %d Hz"
+                % (", ".join(map(str, OPUS_SAMPLERATES)), filepath, src.samplerate)
+            )
+        frames = block_frames(src.samplerate, src.channels)
+        block = np.empty((frames, src.channels), dtype=np.float32)
+        with sf.SoundFile(
+            buf,
+            "w",
+            samplerate=src.samplerate,
+            channels=src.channels,
+            format=OPUS_SETTINGS["format"],
+            subtype=OPUS_SETTINGS["subtype"],
+        ) as dest:
+            while True:
+                read = src.read(frames, dtype="float32", always_2d=True, out=block)
+                if not len(read):
+                    break
+                dest.write(read)
@@ -1,109 +1,479 @@
 import io
-from multiprocessing.pool import ThreadPool
-from concurrent.futures import as_completed, ThreadPoolExecutor
-from typing import List, Callable, Tuple
-from asyncio import Future
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker, shared_memory
+from functools import partial
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from .cache import TranscodeCache
 from .convert import to_opus
-import tempfile
 from ..common import (
     FileOffset,
+    FILE_ENTRY,
     write_and_mask,
-    _validate_and_pack,
-    _with_endian,
-    StructTypes,
+    _readinto_full,
 )
+from ..stats import SngStats
 import logging
-from multiprocessing import cpu_count
 
 
-s = StructTypes
-
 logger = logging.getLogger(__package__)
 
+# Added to the size of a source to size the block its output is encoded into
+_OUTPUT_HEADROOM = 1 << 20
+
 __all__ = [
     'parllel_transcode_opus',
-    'eval_futures'
+    'eval_audio_futures',
+    'collect_audio_futures',
+    'TranscodedAudio',
 ]
+
+
+class TranscodedAudio(io.RawIOBase):
+    """
+    Opus output of a transcoding worker, read straight from the shared memory block the
+    worker left it in. Closing it frees the block.
+    """
+
+    def __init__(
+        self,
+        name: Optional[str],
+        size: int,
+        data: Optional[bytes] = None,
+        seconds: Optional[float] = None,
+        source_md5: Optional[str] = None,
+    ) -> None:
+        """
+        Args:
+            name (str, optional): Name of the shared memory block, None when the output was returned as bytes.
+            size (int): Size of the output in bytes.
+            data (bytes, optional): The output, when it could not be put in shared memory.
+            seconds (float, optional): How long the transcode took, None when it came from the cache.
+            source_md5 (str, optional): md5 of the source file, when the worker was asked to hash it.
+        """
+        super().__init__()
+        self._shm = None
+        if name is not None:
+            self._shm = shared_memory.SharedMemory(name)
+            data = self._shm.buf
+        self._view = memoryview(data)[:size]
+        self.size = size
+        self.seconds = seconds
+        self.source_md5 = source_md5
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        n = min(len(buf), self.size - self._pos)
+        buf[:n] = self._view[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self._view.release()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+        super().close()
+
+
+class _Output(NamedTuple):
+    """
+    What a transcoding worker hands back. `seconds` is None for outputs found in the cache,
+    which took `saved` seconds to transcode when they were cached. Internal use.
+    """
+
+    filename: str
+    offset: int
+    name: Optional[str]
+    size: int
+    data: Optional[bytes]
+    seconds: Optional[float]
+    source_md5: Optional[str]
+    saved: float = 0.0
+
+
+class _SharedOutput(io.RawIOBase):
+    """
+    Seekable in-memory file a worker encodes into, backed by a shared memory block that
+    grows as needed, so the output is handed to the parent without being copied. Falls back
+    to a bytearray when no block can be created. Internal use.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        super().__init__()
+        self.size = 0
+        self._pos = 0
+        try:
+            self._shm: Optional[shared_memory.SharedMemory] = shared_memory.SharedMemory(
+                create=True, size=max(capacity, 1)
+            )
+        except OSError as err:
+            logger.debug("Unable to allocate shared memory (%s), returning the output by value", err)
+            self._shm = None
+            self._buf = bytearray()
+        else:
+            self._buf = self._shm.buf
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def _reserve(self, needed: int) -> None:
+        if needed <= len(self._buf):
+            return
+        if self._shm is None:
+            self._buf.extend(bytes(needed - len(self._buf)))
+            return
+        try:
+            shm = shared_memory.SharedMemory(create=True, size=max(needed, 2 * len(self._buf)))
+        except OSError as err:
+            logger.debug("Unable to grow shared memory (%s), returning the output by value", err)
+            shm = None
+            buf = bytearray(self._buf[: self.size])
+            buf.extend(bytes(needed - self.size))
+        else:
+            buf = shm.buf
+            buf[: self.size] = self._buf[: self.size]
+        self._free()
+        self._shm = shm
+        self._buf = buf
+
+    def write(self, data) -> int:
+        with memoryview(data) as view, view.cast("B") as view:
+            written = len(view)
+            end = self._pos + written
+            self._reserve(end)
+            self._buf[self._pos : end] = view
+        self._pos = end
+        self.size = max(self.size, end)
+        return written
+
+    def write_from(self, file: io.BufferedReader, size: int) -> None:
+        """
+        Reads `size` bytes of `file` straight into the output.
+        """
+        end = self._pos + size
+        self._reserve(end)
+        with memoryview(self._buf)[self._pos : end] as view:
+            read = _readinto_full(file, view)
+        if read != size:
+            raise RuntimeError("Transcode output ended after %d of %d bytes" % (read, size))
+        self._pos = end
+        self.size = max(self.size, end)
+
+    def readinto(self, buf) -> int:
+        n = max(0, min(len(buf), self.size - self._pos))
+        buf[:n] = self._buf[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def getbuffer(self) -> memoryview:
+        """
+        Returns:
+            memoryview: The output, to release before the output is handed off or closed.
+        """
+        return memoryview(self._buf)[: self.size]
+
+    def hand_off(self) -> Tuple[Optional[str], Optional[bytearray]]:
+        """
+        Leaves the output to the parent, which frees its block.
+
+        Returns:
+            Tuple[Optional[str], Optional[bytearray]]: The name of the block, or None and the
+            output when it is not in shared memory.
+        """
+        name, data = None, None
+        if self._shm is None:
+            del self._buf[self.size :]
+            data = self._buf
+        else:
+            name = self._shm.name
+            self._buf = bytearray()
+            self._shm.close()
+            self._shm = None
+        super().close()
+        return name, data
+
+    def _free(self) -> None:
+        if self._shm is not None:
+            self._buf = bytearray()
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def close(self) -> None:
+        self._free()
+        super().close()
+
+
+def _transcode(
+    filename: str,
+    offset: int,
+    cache: Optional[TranscodeCache],
+    hash_source: bool = False,
+) -> _Output:
+    """
+    Transcodes one file to opus in a worker process, handing the output back through a shared
+    memory block rather than pickling it. Falls back to returning bytes if the block can't be created.
+
+    With `cache`, the source is looked up first and new transcodes are stored in it. With
+    `hash_source`, the md5 of the source is returned too, so the parent doesn't read it again
+    to name the sng file. The cache key and md5 come from the same read of the source.
+
+    The output is encoded straight into the block, sized after the source and grown if needed.
+    Pages of the block past the output are never touched, so they take no memory.
+    """
+    key, source_md5 = TranscodeCache.hash_source(filename, key=cache is not None, md5=hash_source)
+    entry = cache.open_entry(key) if cache is not None else None
+    if entry is not None:
+        f, size, saved = entry
+        logger.debug("Found `%s` in the transcode cache", filename)
+        with f, _SharedOutput(size) as out:
+            out.write_from(f, size)
+            name, data = out.hand_off()
+        return _Output(filename, offset, name, size, data, None, source_md5, saved)
+
+    start = time.perf_counter()
+    with _SharedOutput(os.path.getsize(filename) + _OUTPUT_HEADROOM) as out:
+        to_opus(filename, out)
+        seconds = time.perf_counter() - start
+        if cache is not None:
+            with out.getbuffer() as view:
+                cache.put(key, view, seconds)
+        size = out.size
+        name, data = out.hand_off()
+    return _Output(filename, offset, name, size, data, seconds, source_md5)
+
+
+def _result(future: Future) -> Tuple[str, int, TranscodedAudio]:
+    output: _Output = future.result()
+    logger.debug("Completed `%s` transcoding", output.filename)
+    return output.filename, output.offset, TranscodedAudio(
+        output.name, output.size, output.data, output.seconds, output.source_md5
+    )
+
+
+def _release(futures: List[Future], consumed: set) -> None:
+    """
+    Frees the shared memory of finished transcoding tasks that won't be written.
+    """
+    for future in futures:
+        if future in consumed or not future.done() or future.cancelled():
+            continue
+        if future.exception() is None:
+            _result(future)[2].close()
+
+
+def _count_lookup(cache: TranscodeCache, future: Future) -> None:
+    """
+    Counts the cache lookup of a finished transcoding task in the parent's `cache`.
+    """
+    if future.cancelled() or future.exception() is not None:
+        return
+    output: _Output = future.result()
+    cache.record_lookup(output.seconds is None, output.saved)
+
+
 def _execute_audio_pool(
-    _wrap: Callable,
     offset_ref: List[FileOffset],
-) -> Tuple[ThreadPoolExecutor, List[Future]]:
-    try:
-        cores = cpu_count() // 4
-    except NotImplementedError:
-        # sometimes not specified
-        cores = 4
-    threads = min(cores, len(offset_ref))
-    tmp_files = [(x, y, tempfile.TemporaryFile("w+b")) for x, y in offset_ref]
-    logger.debug("Spinning up thread pool with %d threads", threads)
-    pool = ThreadPoolExecutor(threads)
+    cache: Optional[TranscodeCache] = None,
+    hash_sources: bool = False,
+) -> Tuple[ProcessPoolExecutor, List[Future]]:
     futures = []
-    for filename, offset, tmp in tmp_files:
+    workers = max(1, min(os.cpu_count() or 1, len(offset_ref)))
+    # started before the workers so they share it, and blocks created by a worker and
+    # freed here are tracked by a single process
+    resource_tracker.ensure_running()
+    logger.debug("Spinning up process pool with %d processes", workers)
+    pool = ProcessPoolExecutor(workers)
+    for filename, offset in offset_ref:
         logger.debug("Submitting opus transcoding task for `%s`", filename)
-        futures.append(pool.submit(_wrap, filename, offset, tmp))
-    logger.debug("Submitted %d transcoding tasks", len(futures))
+        future = pool.submit(_transcode, filename, offset, cache, hash_sources)
+        if cache is not None:
+            future.add_done_callback(partial(_count_lookup, cache))
+        futures.append(future)
+    logger.debug("Submitted %d transcoding tasks", len(offset_ref))
     return pool, futures
 
 
-def _wrap_opus(filename: str, offset: int, tmpfile: io.FileIO):
-    to_opus(filename, tmpfile)
-    tmpfile.truncate()
-    tmpfile.seek(0)
-    return filename, offset, tmpfile
+def _record_transcode(stats: Optional[SngStats], filename: str, audio: TranscodedAudio) -> str:
+    """
+    Records the transcode of `filename` in `stats` if passed. Returns the member name of its output.
+    """
+    member = os.path.splitext(os.path.basename(filename))[0] + ".opus"
+    if stats is None:
+        return member
+    if audio.seconds is None:
+        stats.record("transcode_cache", 0.0, audio.size, member)
+    else:
+        stats.record("transcode", audio.seconds, audio.size, member)
+    return member
 
 
 def _eval_transcoding(
-    buf: io.BufferedWriter, filename, offset, tmpfile: io.FileIO, *, xor_mask: bytearray
+    buf: io.BufferedWriter,
+    filename,
+    offset,
+    audio: TranscodedAudio,
+    *,
+    xor_mask: bytearray,
+    digests: Optional[Dict[str, str]] = None,
+    stats: Optional[SngStats] = None,
+    base: int = 0,
 ) -> int:
-    logger.debug("Completed `%s` transcoding", filename)
     logger.debug("Trancoded to: opus")
+    if digests is not None and audio.source_md5 is not None:
+        digests[os.path.basename(filename)] = audio.source_md5
     before_write = buf.tell()
     logger.debug("Writing transcoded `%s` to disk", filename)
-    write_and_mask(read_from=tmpfile, write_to=buf, xor_mask=xor_mask)
-    tmpfile.close()
-    after_write = buf.tell()
-    buf.truncate()
-    opus_size = after_write - before_write
-    size = opus_size
-    logger.debug("Wrote `%s` transcoded (size: %d bytes)", filename, size)
+    member = _record_transcode(stats, filename, audio)
+    with audio:
+        opus_size = write_and_mask(
+            read_from=audio,
+            write_to=buf,
+            xor_mask=xor_mask,
+            filesize=audio.size,
+            stats=stats,
+            member=member,
+        )
+    logger.debug("Wrote `%s` transcoded (size: %d bytes)", filename, opus_size)
     buf.seek(offset)
-    buf.write(_validate_and_pack(_with_endian(s.ULONGLONG), opus_size))
-    buf.write(_validate_and_pack(_with_endian(s.ULONGLONG), before_write))
-    buf.seek(after_write)
-    buf.truncate()
-    return size
+    buf.write(FILE_ENTRY.pack(opus_size, before_write - base))
+    buf.seek(before_write + opus_size)
+    return opus_size
 
 
 def eval_audio_futures(
     buf: io.BufferedWriter,
-    pool: ThreadPoolExecutor,
+    pool: ProcessPoolExecutor,
     futures: List[Future],
     *,
     xor_mask: bytearray,
+    digests: Optional[Dict[str, str]] = None,
+    stats: Optional[SngStats] = None,
+    base: int = 0,
 ) -> int:
+    """
+    Masks and writes each transcoded file at the end of `buf` as soon as it is done,
+    patching its file table entry with its size and its offset from `base`, the position
+    of the SNG file in `buf`. The md5 of the sources hashed by the workers are added to
+    `digests` if passed, keyed by filename. The transcode and copy of each file are
+    recorded in `stats` if passed.
+
+    Returns:
+        int: The number of bytes written.
+    """
     size = 0
+    consumed = set()
     logger.debug("Iterating transcoding futures.")
     try:
         for future in as_completed(futures):
-            size += _eval_transcoding(buf, *future.result(), xor_mask=xor_mask)
-    except KeyboardInterrupt as ke:
-        logger.error("Keyboard interrupt during transcoding, exiting gracefully")
-        pool.shutdown(cancel_futures=True)
-        raise ke
-    except Exception as e:
-        logger.error("Unknown exception occured")
+            consumed.add(future)
+            size += _eval_transcoding(
+                buf, *_result(future), xor_mask=xor_mask, digests=digests, stats=stats, base=base
+            )
+    except BaseException as e:
+        if isinstance(e, KeyboardInterrupt):
+            logger.error("Keyboard interrupt during transcoding, exiting gracefully")
+        else:
+            logger.error("Unknown exception occured")
         pool.shutdown(cancel_futures=True)
+        _release(futures, consumed)
         raise e
     pool.shutdown()
 
     return size
 
-def _wrap_opus(filename: str, offset: int, tmpfile: io.FileIO):
-    to_opus(filename, tmpfile)
-    tmpfile.truncate()
-    tmpfile.seek(0)
-    return filename, offset, tmpfile
 
-def parllel_transcode_opus(offset_ref: List[FileOffset]):
+def collect_audio_futures(
+    pool: ProcessPoolExecutor,
+    futures: List[Future],
+    *,
+    stats: Optional[SngStats] = None,
+) -> Dict[str, TranscodedAudio]:
+    """
+    Waits for every transcoding task without writing anything, for outputs that
+    cannot seek back to patch the file table. Transcode times are recorded in `stats` if passed.
+
+    Returns:
+        Dict[str, TranscodedAudio]: The transcoded output of each source file. Closing them frees their memory.
+    """
+    results = {}
+    consumed = set()
+    logger.debug("Waiting for transcoding futures.")
+    try:
+        for future in as_completed(futures):
+            consumed.add(future)
+            filename, _, audio = _result(future)
+            results[filename] = audio
+            _record_transcode(stats, filename, audio)
+    except BaseException as e:
+        if isinstance(e, KeyboardInterrupt):
+            logger.error("Keyboard interrupt during transcoding, exiting gracefully")
+        else:
+            logger.error("Unknown exception occured")
+        pool.shutdown(cancel_futures=True)
+        for audio in results.values():
+            audio.close()
+        _release(futures, consumed)
+        raise e
+    pool.shutdown()
+
+    return results
+
+
+def parllel_transcode_opus(
+    offset_ref: List[FileOffset],
+    cache: Optional[TranscodeCache] = None,
+    hash_sources: bool = False,
+):
+    """
+    Starts transcoding files to opus on a process pool. Each worker hashes its source to
+    look it up in `cache`, and files found there are not transcoded.
+
+    Args:
+        offset_ref (List[FileOffset]): The files to transcode, with the position of their file table entry.
+        cache (TranscodeCache, optional): Cache looked up before transcoding, and filled with new transcodes.
+        hash_sources (bool, optional): Have the workers md5 the source files, returned as `TranscodedAudio.source_md5`. Defaults to False.
+
+    Returns:
+        Tuple[ProcessPoolExecutor, List[Future]]: The pool and one future per file.
+    """
     logger.debug("Encoding audio files to opus")
-    return _execute_audio_pool(_wrap_opus, offset_ref)
+    return _execute_audio_pool(offset_ref, cache, hash_sources)
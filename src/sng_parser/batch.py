@@ -0,0 +1,127 @@
+import logging
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+from .stats import SngStats
+
+__all__ = ["BatchResult", "run_batch", "path_size"]
+
+logger = logging.getLogger(__package__)
+
+
+class BatchResult(NamedTuple):
+    """
+    Outcome of one item of a batch run.
+    """
+
+    item: str
+    ok: bool
+    error: Optional[str]
+    seconds: float
+    stats: Optional[SngStats] = None
+
+
+def path_size(path: os.PathLike | str) -> int:
+    """
+    Size in bytes of a file, or of the files directly inside a directory. Missing paths have a size of 0.
+    """
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        with os.scandir(path) as entries:
+            return sum(
+                entry.stat().st_size for entry in entries if entry.is_file()
+            )
+    except OSError:
+        return 0
+
+
+def _run_item(func: Callable[[str], None], item: str, collect_stats: bool = False) -> BatchResult:
+    """
+    Runs one item, turning any exception into a failed result. Runs in a worker process.
+    With `collect_stats`, `func` is also passed the `stats` of the item, returned in its result.
+    """
+    stats = SngStats() if collect_stats else None
+    kwargs = {"stats": stats} if collect_stats else {}
+    start = time.perf_counter()
+    try:
+        func(item, **kwargs)
+    except Exception as err:
+        logger.debug("Stack trace:", exc_info=True)
+        return BatchResult(
+            item, False, "%s: %s" % (type(err).__name__, err), time.perf_counter() - start, stats
+        )
+    return BatchResult(item, True, None, time.perf_counter() - start, stats)
+
+
+def _init_worker(log_level: int, log_format: Optional[str]) -> None:
+    """
+    Sets up logging in worker processes, which don't inherit it when spawned.
+    """
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=log_level, format=log_format)
+
+
+def run_batch(
+    func: Callable[[str], None],
+    items: Iterable[os.PathLike | str],
+    *,
+    workers: int = 1,
+    log_format: Optional[str] = None,
+    collect_stats: bool = False,
+) -> List[BatchResult]:
+    """
+    Runs `func` on every item on a process pool, largest input first to cut tail latency.
+
+    A failing item does not stop the batch, its error is recorded in its result instead.
+    `func` has to be picklable, such as a module level function or a `functools.partial` of one.
+
+    Args:
+        func (Callable[[str], None]): Function run on each item.
+        items (Iterable[os.PathLike | str]): Files or directories to process.
+        workers (int, optional): Number of processes. With 1, items run in this process. Defaults to 1.
+        log_format (str, optional): Logging format for spawned worker processes.
+        collect_stats (bool, optional): Pass a `SngStats` to `func` as `stats` for each item, returned in its result. Defaults to False.
+
+    Returns:
+        List[BatchResult]: One result per item, in the order they were scheduled.
+    """
+    items = sorted((str(item) for item in items), key=path_size, reverse=True)
+    logger.debug("Scheduled %d items, largest first", len(items))
+    if workers <= 1 or len(items) <= 1:
+        results = []
+        for item in items:
+            results.append(_log_result(_run_item(func, item, collect_stats)))
+        return results
+
+    workers = min(workers, len(items))
+    logger.debug("Starting process pool with %d processes", workers)
+    results = {}
+    with ProcessPoolExecutor(
+        workers,
+        initializer=_init_worker,
+        initargs=(logging.getLogger().getEffectiveLevel(), log_format),
+    ) as pool:
+        futures = {
+            pool.submit(_run_item, func, item, collect_stats): item for item in items
+        }
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                result = future.result()
+            except Exception as err:
+                # the worker process itself died, e.g. killed by the OS
+                result = BatchResult(item, False, "%s: %s" % (type(err).__name__, err), 0.0)
+            results[item] = _log_result(result)
+    return [results[item] for item in items]
+
+
+def _log_result(result: BatchResult) -> BatchResult:
+    if result.ok:
+        logger.info("Processed %s in %.2fs", result.item, result.seconds)
+    else:
+        logger.error("Failed to process %s. Error: %s", result.item, result.error)
+    return result
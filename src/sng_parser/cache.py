@@ -0,0 +1,169 @@
+import logging
+import os
+import sys
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, List, NamedTuple, Tuple
+
+from .common import SngFileMetadata, SngHeader, SngMetadataInfo
+
+__all__ = ["SngTableCache", "CacheStats", "TABLE_CACHE"]
+
+logger = logging.getLogger(__package__)
+
+# Default bounds of the shared cache
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class CacheKey(NamedTuple):
+    path: str
+    device: int
+    inode: int
+    size: int
+    mtime_ns: int
+
+
+class SngTables(NamedTuple):
+    """
+    The parsed header, metadata and file table of an SNG file.
+    """
+
+    header: SngHeader
+    metadata: SngMetadataInfo
+    files: List[SngFileMetadata]
+
+
+class CacheStats(NamedTuple):
+    """
+    Counters of an `SngTableCache`, for sizing it.
+    """
+
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    approx_bytes: int
+
+
+def cache_key(path: os.PathLike | str, st: os.stat_result) -> CacheKey:
+    """
+    Builds the cache key of a file from its path and stat result.
+
+    Args:
+        path (os.PathLike | str): Path of the file.
+        st (os.stat_result): Stat result of the file, preferably from `os.fstat` on the open file.
+
+    Returns:
+        CacheKey: The key, which changes whenever the file is replaced or modified.
+    """
+    return CacheKey(os.fspath(path), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _approx_size(tables: SngTables) -> int:
+    """
+    Rough memory footprint of parsed tables, counting the strings and a fixed overhead per object.
+    """
+    size = sys.getsizeof(tables.header.xor_mask) + 200
+    for key, value in tables.metadata.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value) + 100
+    for file_meta in tables.files:
+        size += sys.getsizeof(file_meta.filename) + 150
+    return size
+
+
+class SngTableCache:
+    """
+    Thread-safe LRU cache of parsed SNG tables, keyed by path, device, inode, size and
+    modification time, so a replaced or modified file is parsed again.
+
+    Entries are evicted least recently used first once either the entry count or the
+    approximate memory used exceeds its bound.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ) -> None:
+        """
+        Args:
+            max_entries (int, optional): Maximum number of cached files. Defaults to 1024.
+            max_bytes (int, optional): Maximum approximate memory used by cached tables. Defaults to 64 MiB.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[CacheKey, Tuple[SngTables, int]]" = OrderedDict()
+        self._lock = Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get_or_parse(self, key: CacheKey, parse: Callable[[], SngTables]) -> SngTables:
+        """
+        Returns the cached tables for `key`, calling `parse` and caching its result on a miss.
+
+        Args:
+            key (CacheKey): Key of the file, from `cache_key`.
+            parse (Callable[[], SngTables]): Parses the tables of the file.
+
+        Returns:
+            SngTables: The parsed tables. They are shared between callers and should not be modified.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+        # parse outside the lock so misses on different files don't serialize
+        tables = parse()
+        self.put(key, tables)
+        return tables
+
+    def put(self, key: CacheKey, tables: SngTables) -> None:
+        """
+        Caches parsed tables, evicting least recently used entries past the bounds.
+        """
+        size = _approx_size(tables)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (tables, size)
+            self._bytes += size
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+            ):
+                evicted_key, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._evictions += 1
+                logger.debug("Evicted cached tables of %s", evicted_key.path)
+
+    def clear(self) -> None:
+        """
+        Drops every entry. Counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> CacheStats:
+        """
+        Returns:
+            CacheStats: Hit, miss and eviction counters along with the current size.
+        """
+        with self._lock:
+            return CacheStats(
+                self._hits, self._misses, self._evictions, len(self._entries), self._bytes
+            )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Cache shared by readers opened from a path
+TABLE_CACHE = SngTableCache()
@@ -1,40 +1,33 @@
+import io
+import logging
 import os
 import re
 import struct
 
-from enum import Enum
+from functools import lru_cache
 from io import BufferedReader, BufferedWriter, BufferedRandom
-from typing import Final, NamedTuple, NoReturn, Optional, Set, TypedDict, Tuple
+from typing import Callable, Dict, Final, NamedTuple, NoReturn, Optional, Set, TypedDict
 
+try:
+    import numpy as np
+except ImportError:  # numpy is optional for masking, fall back to pure python
+    np = None
 
-# Constants
-class StructTypes(Enum):
-    """
-    Enumerates the structure types used for sng data manipulation,
-    ensuring consistent endianness and providing easy
-    access to format characters for common data types.
-    """
+from .stats import PhaseTimer, SngStats, phase_timer
 
-    ENDIAN = "<"  # Little-endian
-    UINT = "I"  # Unsigned int
-    ULONGLONG = "Q"  # Unsigned long long
-    UBYTE = "B"  # Unsigned byte
-    CHAR = "s"  # Single character
+logger = logging.getLogger(__package__)
 
 
-# Regex for struct format validation
-STRUCT_TYPE_RE = re.compile(r"(?:([IQB])|(?:(\d+)(s)))")
+# Constants
 
-# Validation for struct packing
-STRUCT_VALIDATION = {
-    StructTypes.UINT.value: lambda x: 0
-    <= x
-    <= ((1 << 32) - 1),  # 2**32-1, 4_294_967_295
-    StructTypes.ULONGLONG.value: lambda x: 0
-    <= x
-    <= ((1 << 64) - 1),  # 2**64-1, 18_446_744_073_709_551_615
-    StructTypes.UBYTE.value: lambda x: 0 <= x <= 255,  # ((2<<8)-1), 2**8-1
-}
+# Precompiled codecs for the fixed size types used by the sng format
+U8: Final[struct.Struct] = struct.Struct("<B")
+U32: Final[struct.Struct] = struct.Struct("<I")
+U64: Final[struct.Struct] = struct.Struct("<Q")
+# Content length and content offset of a file table entry
+FILE_ENTRY: Final[struct.Struct] = struct.Struct("<QQ")
+# File identifier, version and xor mask
+HEADER: Final[struct.Struct] = struct.Struct("<6sI16s")
 
 # File format version
 SNG_VERSION: Final[int] = 1
@@ -67,6 +60,9 @@ SNG_AUDIO_FILES: Final[Set[str]] = {
 # Audio file extensions allowed
 SNG_AUDIO_EXT: Final[Set[str]] = {"mp3", "ogg", "opus", "wav"}
 
+# Audio file extensions transcoded to opus when encoding audio
+SNG_TRANSCODE_EXT: Final[Set[str]] = {"mp3", "ogg", "wav"}
+
 # Image filenames allowed
 SNG_IMG_FILES: Final[Set[str]] = {"album", "background", "highway"}
 
@@ -124,9 +120,132 @@ def _fail_on_invalid_sng_ver(ver: int) -> None | NoReturn:
         )
 
 
-def mask(data: bytes, xor_mask: bytes) -> bytearray:
+def _fail_on_short_sng(size: int) -> None | NoReturn:
+    if size < HEADER.size:
+        raise RuntimeError(
+            "Header read mismatch. Expected %d, read %d" % (HEADER.size, size)
+        )
+
+
+# Length of the masking keystream, the key for byte i repeats every 256 bytes
+MASK_PERIOD: Final[int] = 256
+
+# Smallest chunk size used when streaming files through the mask
+MIN_CHUNK_SIZE: Final[int] = 1 << 18
+
+
+@lru_cache(maxsize=64)
+def _keystream(xor_mask: bytes) -> bytes:
+    """
+    Builds the 256 byte keystream for the given XOR mask. Internal use.
+
+    The key for byte i of a file is `xor_mask[i % 16] ^ (i & 0xFF)`, which
+    repeats every 256 bytes, so the keystream only has to be built once per mask.
+
+    Args:
+        xor_mask (bytes): The 16 byte mask from the sng header.
+
+    Returns:
+        bytes: The keystream for one 256 byte period.
+    """
+    return bytes(xor_mask[i % 16] ^ i for i in range(MASK_PERIOD))
+
+
+@lru_cache(maxsize=64)
+def _numpy_keystream(xor_mask: bytes) -> "np.ndarray":
+    """
+    Two periods of the keystream as a read-only numpy array, so any phase
+    can be sliced out without copying. Internal use.
+    """
+    key = np.frombuffer(_keystream(xor_mask) * 2, dtype=np.uint8)
+    key.setflags(write=False)
+    return key
+
+
+def _mask_into_numpy(view: memoryview, xor_mask: bytes, offset: int) -> None:
+    """
+    Masks `view` in place with numpy, 256 bytes per row. Internal use.
+    """
+    arr = np.frombuffer(view, dtype=np.uint8)
+    phase = offset % MASK_PERIOD
+    key = _numpy_keystream(xor_mask)[phase : phase + MASK_PERIOD]
+    full = len(arr) - len(arr) % MASK_PERIOD
+    if full:
+        rows = arr[:full].reshape(-1, MASK_PERIOD)
+        np.bitwise_xor(rows, key, out=rows)
+    tail = arr[full:]
+    np.bitwise_xor(tail, key[: len(tail)], out=tail)
+
+
+def _mask_into_python(view: memoryview, xor_mask: bytes, offset: int) -> None:
+    """
+    Masks `view` in place by XORing it as one big integer. Internal use.
+    """
+    size = len(view)
+    if not size:
+        return
+    phase = offset % MASK_PERIOD
+    keystream = _keystream(xor_mask)
+    key = (keystream[phase:] + keystream[:phase]) * (size // MASK_PERIOD + 1)
+    view[:] = (
+        int.from_bytes(view, "little") ^ int.from_bytes(key[:size], "little")
+    ).to_bytes(size, "little")
+
+
+# Available masking backends, keyed by name
+MASK_BACKENDS: Final[Dict[str, Callable[[memoryview, bytes, int], None]]] = {
+    "python": _mask_into_python,
+}
+if np is not None:
+    MASK_BACKENDS["numpy"] = _mask_into_numpy
+
+# Backend used when none is requested, the fastest available one
+DEFAULT_MASK_BACKEND: Final[str] = "numpy" if np is not None else "python"
+
+
+def mask_into(
+    buf: bytearray | memoryview,
+    xor_mask: bytes,
+    offset: int = 0,
+    *,
+    backend: Optional[str] = None,
+) -> None:
+    """
+    Applies the sng XOR mask to a writable buffer in place.
+
+    Args:
+        buf (bytearray | memoryview): The writable buffer to mask.
+        xor_mask (bytes): The mask to be applied, 16 bytes long.
+        offset (int, optional): Position of the first byte of `buf` within the file it belongs to. Defaults to 0.
+        backend (str, optional): Name of the masking backend in `MASK_BACKENDS`. Defaults to the fastest available.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: When an unknown backend is requested
+    """
+    name = DEFAULT_MASK_BACKEND if backend is None else backend
+    try:
+        mask_fn = MASK_BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown mask backend `%s`, available: %s"
+            % (name, ", ".join(sorted(MASK_BACKENDS)))
+        ) from None
+    view = memoryview(buf).cast("B")
+    mask_fn(view, bytes(xor_mask), offset)
+
+
+def mask(
+    data: bytes,
+    xor_mask: bytes,
+    offset: int = 0,
+    *,
+    backend: Optional[str] = None,
+) -> bytearray:
     """
-    Applies an XOR mask to the given data byte by byte, with an additional
+    Applies an XOR mask to the given data, with an additional
     operation on the XOR key involving the index.
 
     The XOR key for each byte is the corresponding byte in the xor_mask,
@@ -136,126 +255,109 @@ def mask(data: bytes, xor_mask: bytes) -> bytearray:
     Args:
         data (bytes): The input data to be masked.
         xor_mask (bytes): The mask to be applied, typically 16 bytes long.
+        offset (int, optional): Position of the first byte of `data` within the file it belongs to. Defaults to 0.
+        backend (str, optional): Name of the masking backend in `MASK_BACKENDS`. Defaults to the fastest available.
 
     Returns:
         bytearray: The masked data as a mutable bytearray.
     """
-    masked_data = bytearray(len(data))
-    for i in range(len(data)):
-        xor_key = xor_mask[i % 16] ^ (i & 0xFF)
-        masked_data[i] = data[i] ^ xor_key
+    masked_data = bytearray(data)
+    mask_into(masked_data, xor_mask, offset, backend=backend)
     return masked_data
 
 
-def calc_and_unpack(fmt: str, buf: BufferedReader) -> tuple:
+@lru_cache(maxsize=256)
+def string_codec(length: int) -> struct.Struct:
     """
-    Calculates the size of the structure described by `fmt`, reads
-    that many bytes from `buf`, and unpacks the bytes according to `fmt`.
+    Returns the codec for a string of `length` bytes, cached per length.
 
     Args:
-        fmt (str): The format string for unpacking the data.
-        buf (BufferedReader): The buffer from which to read the data.
+        length (int): Length of the string in bytes.
 
     Returns:
-        tuple: The unpacked data.
+        struct.Struct: The codec for the string.
+    """
+    return struct.Struct("<%ds" % length)
+
+
+def _check_uint(codec: struct.Struct, value: int) -> int | NoReturn:
+    """
+    Validate an unsigned integer fits in the codec it is packed with. Internal use.
+
+    Raises:
+        ValueError: When `value` is negative or exceeds the byte requirements of the codec
     """
-    read_size = struct.calcsize(fmt)
-    buffer = buf.read(read_size)
-    return struct.unpack_from(fmt, buffer)
+    if not 0 <= value < 1 << (codec.size * 8):
+        raise ValueError("Invalid byte size for %s: %d" % (codec.format, value))
+    return value
 
 
-def calc_and_read_buf(fmt: str, buf: BufferedReader) -> Tuple[int, bytes]:
+def pack_uint(codec: struct.Struct, value: int) -> bytes:
     """
-    Calculates the size required for the format `fmt`, reads that many bytes
-    from the buffer `buf`, and returns the size read along with the bytes.
+    Validate and pack an unsigned integer with one of `U8`, `U32` or `U64`.
 
     Args:
-        fmt (str): The format string representing the data structure to read.
-        buf (BufferedReader): The buffer from which to read the data.
+        codec (struct.Struct): The codec to pack with.
+        value (int): The value to pack.
 
     Returns:
-        Tuple[int, bytes]: A tuple containing the number of bytes read and the read bytes.
+        bytes: The packed value.
+
+    Raises:
+        ValueError: When `value` does not fit in the codec
     """
-    read_size = struct.calcsize(fmt)
-    return read_size, buf.read(read_size)
+    return codec.pack(_check_uint(codec, value))
 
 
-def _valid_char_arg(content: bytes, pack_len: int) -> bool | NoReturn:
+def pack_uint_into(codec: struct.Struct, buf: bytearray, offset: int, value: int) -> int:
     """
-    Validate a character in a string to pack. Internal use
+    Validate and pack an unsigned integer into `buf` at `offset`.
 
     Args:
-        content (bytes): Byte string to check if valid.
-        pack_len (int): Length of the byte string
+        codec (struct.Struct): The codec to pack with.
+        buf (bytearray): The buffer to pack into.
+        offset (int): Position in `buf` to pack at.
+        value (int): The value to pack.
 
     Returns:
-        Whether the byte string is valid or not.
+        int: The offset after the packed value.
 
     Raises:
-        ValueError: When `pack_len` does not equal the length of `content`
+        ValueError: When `value` does not fit in the codec
     """
-    if (e := len(content)) != pack_len:
-        raise ValueError(
-            "String pack size difference. Expected %d, got %d" % (e, pack_len)
-        )
-    return all(0 <= char <= 255 for char in content)
+    codec.pack_into(buf, offset, _check_uint(codec, value))
+    return offset + codec.size
 
 
-def _validate_and_pack(fmt: str, content: bytes | int) -> bytes:
+def pack_str_into(buf: bytearray, offset: int, content: bytes) -> int:
     """
-    Validate the data being packed, and pack the data if it's valid. Internal function.
+    Pack a byte string into `buf` at `offset`. The length prefix is packed separately.
 
     Args:
-        fmt (str): Struct format string to use for packing
-        content (bytes | int): Data to be packed
+        buf (bytearray): The buffer to pack into.
+        offset (int): Position in `buf` to pack at.
+        content (bytes): The string to pack.
 
     Returns:
-        Byte string of the packed data from the struct
-
-    Raises:
-        ValueError: When the endian string is not the endian set by the sng standard
-        ValueError: When the struct fmt string is invalid
-        ValueError: When `fmt` contains a char array and an invalid character is passed
-        ValueError: When `fmt` has a numerical value and exceeds the byte requirements of the type
-        RuntimError: When something goes *horribly* wrong
+        int: The offset after the packed string.
     """
-    if fmt[0] != StructTypes.ENDIAN.value:
-        raise ValueError(
-            "First character in struct format is not the expected endian. Expected endian: `%s`"
-            % StructTypes.ENDIAN.value
-        )
-    matches = STRUCT_TYPE_RE.findall(fmt[1:])
-    if matches is None:
-        raise ValueError(
-            "No struct characters used by sng format found in passed format."
-        )
-    for match in matches:
-        if match[1] and match[2]:  # is char, we need to convert it.
-            if not _valid_char_arg(content, int(match[1])):
-                raise ValueError("Invalid byte in character string passed.")
-        elif match[0]:
-            if not STRUCT_VALIDATION[match[0]](content):
-                raise ValueError("Invalid byte size for %s: %d" % (match[0], content))
-        else:
-            raise RuntimeError("Something is wrong")
-    return struct.pack(fmt, content)
+    codec = string_codec(len(content))
+    codec.pack_into(buf, offset, content)
+    return offset + codec.size
 
 
-def _with_endian(*args: Tuple[StructTypes | int]):
+def read_struct(codec: struct.Struct, buf: BufferedReader) -> tuple:
     """
-    Constructs a format string for struct operations that includes the specified
-    endian prefix followed by the format specifiers provided in `args`.
+    Reads `codec.size` bytes from `buf` and unpacks them with `codec`.
 
     Args:
-        *args (Tuple[StructTypes | int]): A sequence of StructTypes enums or integers
-        representing the number of characters.
+        codec (struct.Struct): The codec to unpack with.
+        buf (BufferedReader): The buffer from which to read the data.
 
     Returns:
-        str: The format string with endian prefix.
+        tuple: The unpacked data.
     """
-    return StructTypes.ENDIAN.value + "".join(
-        map(lambda x: x.value if isinstance(x, StructTypes) else str(x), args)
-    )
+    return codec.unpack(buf.read(codec.size))
 
 
 def _valid_img_file(filename: str, ext: str) -> bool:
@@ -304,6 +406,33 @@ def _valid_sng_file(file: str) -> bool:
     )
 
 
+def _chunk_size_for(*files) -> int:
+    """
+    Picks a chunk size for streaming between `files` from the file system block size.
+    Internal use.
+
+    The largest `st_blksize` of the files is scaled up to at least `MIN_CHUNK_SIZE`
+    and rounded to a multiple of `MASK_PERIOD`, so chunks stay aligned with the keystream.
+
+    Args:
+        *files: File objects to stream between. Ones without a file descriptor are ignored.
+
+    Returns:
+        int: The chunk size in bytes.
+    """
+    blksize = 0
+    for file in files:
+        try:
+            blksize = max(blksize, os.fstat(file.fileno()).st_blksize)
+        except (AttributeError, OSError, ValueError):
+            # in-memory buffers have no fileno, st_blksize is unix only
+            continue
+    if not blksize:
+        blksize = io.DEFAULT_BUFFER_SIZE
+    chunk_size = max(blksize, MIN_CHUNK_SIZE // blksize * blksize)
+    return -(-chunk_size // MASK_PERIOD) * MASK_PERIOD
+
+
 def _write_and_mask(
     *,
     outfile: BufferedWriter,
@@ -311,13 +440,127 @@ def _write_and_mask(
     xor_mask: bytearray,
     filesize: int,
     chunk_size: int,
-) -> None:
-    cur_offset = infile.tell()
-    expected_offset = cur_offset+ filesize
-    while infile.tell() != expected_offset:
-        chunk_size = min(expected_offset - infile.tell(), chunk_size)
-        buf = infile.read(chunk_size)
-        outfile.write(mask(buf, xor_mask))
+    digest=None,
+    timer: PhaseTimer = phase_timer(None),
+) -> int:
+    """
+    Streams `filesize` bytes from `infile` to `outfile`, masking them on the way.
+    Internal use.
+
+    A single buffer is read into and masked in place. The keystream phase is taken
+    from the number of bytes already copied, so any chunk size produces the same output.
+    If `digest` is passed, it is updated with the bytes read before they are masked.
+
+    Returns:
+        int: The number of bytes written, less than `filesize` if `infile` ran out.
+    """
+    buf = memoryview(bytearray(min(chunk_size, filesize)))
+    written = 0
+    while written < filesize:
+        chunk = buf[: min(len(buf), filesize - written)]
+        read = infile.readinto(chunk)
+        timer.lap("read", read)
+        if not read:
+            logger.debug("Input ended after %d of %d bytes", written, filesize)
+            break
+        chunk = chunk[:read]
+        if digest is not None:
+            digest.update(chunk)
+            timer.lap("hash", read)
+        mask_into(chunk, xor_mask, written)
+        timer.lap("mask", read)
+        outfile.write(chunk)
+        timer.lap("write", read)
+        written += read
+    return written
+
+
+def _readinto_full(file: BufferedReader, view: memoryview) -> int:
+    """
+    Fills `view` from `file`, stopping early only at the end of the file. Internal use.
+
+    Returns:
+        int: The number of bytes read.
+    """
+    read = 0
+    while read < len(view):
+        n = file.readinto(view[read:])
+        if not n:
+            break
+        read += n
+    return read
+
+
+def _pread_into(fd: int, buf: memoryview, offset: int) -> int:
+    """
+    Reads from `fd` at `offset` into `buf` without moving the file position. Internal use.
+    """
+    if hasattr(os, "preadv"):
+        return os.preadv(fd, [buf], offset)
+    data = os.pread(fd, len(buf), offset)
+    buf[: len(data)] = data
+    return len(data)
+
+
+def pread_and_mask(
+    *,
+    fd: int,
+    offset: int,
+    write_to: os.PathLike | BufferedWriter,
+    xor_mask: bytearray,
+    filesize: int,
+    chunk_size: Optional[int] = None,
+    stats: Optional[SngStats] = None,
+    member: Optional[str] = None,
+) -> int:
+    """
+    Copies `filesize` bytes starting at `offset` of the file descriptor `fd`,
+    applying the sng XOR mask.
+
+    Positional reads are used, so several threads can copy from the same
+    descriptor at once.
+
+    Args:
+        fd (int): File descriptor to read from.
+        offset (int): Position in `fd` of the first byte to copy.
+        write_to (os.PathLike | BufferedWriter): Path or buffer to write to.
+        xor_mask (bytearray): The 16 byte mask to apply.
+        filesize (int): Amount of bytes to copy.
+        chunk_size (int, optional): Size of the copy buffer. Defaults to one derived from the file system block size.
+        stats (SngStats, optional): Stats to record the read, mask and write time of the copy in.
+        member (str, optional): Member the copy is recorded under in `stats`.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    passed_write_buffer = not isinstance(write_to, (str, os.PathLike))
+    if not passed_write_buffer:
+        write_to = open(write_to, "wb")
+    timer = phase_timer(stats, member)
+    try:
+        if chunk_size is None:
+            chunk_size = _chunk_size_for(write_to)
+        buf = memoryview(bytearray(min(chunk_size, filesize)))
+        written = 0
+        while written < filesize:
+            chunk = buf[: min(len(buf), filesize - written)]
+            read = _pread_into(fd, chunk, offset + written)
+            timer.lap("read", read)
+            if not read:
+                logger.debug("Input ended after %d of %d bytes", written, filesize)
+                break
+            chunk = chunk[:read]
+            mask_into(chunk, xor_mask, written)
+            timer.lap("mask", read)
+            write_to.write(chunk)
+            timer.lap("write", read)
+            written += read
+        return written
+    finally:
+        if not passed_write_buffer:
+            write_to.close()
+        timer.done()
+
 
 def write_and_mask(
     *,
@@ -325,34 +568,63 @@ def write_and_mask(
     write_to: os.PathLike | BufferedWriter,
     xor_mask: bytearray,
     filesize: Optional[int] = None,
-    chunk_size: int = 1024,
+    chunk_size: Optional[int] = None,
+    digest=None,
+    stats: Optional[SngStats] = None,
+    member: Optional[str] = None,
 ) -> int:
-    passed_read_buffer = not isinstance(read_from, str)
-    passed_write_buffer = not isinstance(write_to, str)
+    """
+    Copies a file, or `filesize` bytes from the current position of a buffer,
+    applying the sng XOR mask.
 
+    Args:
+        read_from (os.PathLike | BufferedReader): Path or buffer to read from.
+        write_to (os.PathLike | BufferedWriter): Path or buffer to write to.
+        xor_mask (bytearray): The 16 byte mask to apply.
+        filesize (int, optional): Amount of bytes to copy. Defaults to the size of `read_from`.
+        chunk_size (int, optional): Size of the copy buffer. Defaults to one derived from the file system block size.
+        digest (hashlib hash, optional): Hash object updated with the bytes read, before they are masked.
+        stats (SngStats, optional): Stats to record the read, mask, write and hash time of the copy in.
+        member (str, optional): Member the copy is recorded under in `stats`.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    passed_read_buffer = not isinstance(read_from, (str, os.PathLike))
+    passed_write_buffer = not isinstance(write_to, (str, os.PathLike))
+
+    timer = phase_timer(stats, member)
     if not passed_read_buffer:
         if os.path.exists(read_from):
             read_from = open(read_from, "rb")
         else:
             raise FileNotFoundError("No read file found at %s" % read_from)
-    if not passed_write_buffer:
-        write_to = open(write_to, "wb")
-
-    if filesize is None:
-        filesize = _calc_filesize(read_from)
+    try:
+        if not passed_write_buffer:
+            write_to = open(write_to, "wb")
+        try:
+            if filesize is None:
+                filesize = _calc_filesize(read_from)
+            if chunk_size is None:
+                chunk_size = _chunk_size_for(read_from, write_to)
+
+            return _write_and_mask(
+                outfile=write_to,
+                infile=read_from,
+                xor_mask=xor_mask,
+                filesize=filesize,
+                chunk_size=chunk_size,
+                digest=digest,
+                timer=timer,
+            )
+        finally:
+            if not passed_write_buffer:
+                write_to.close()
+    finally:
+        if not passed_read_buffer:
+            read_from.close()
+        timer.done()
 
-    _write_and_mask(
-        outfile=write_to,
-        infile=read_from,
-        xor_mask=xor_mask,
-        filesize=filesize,
-        chunk_size=chunk_size,
-    )
-    if not passed_read_buffer:
-        read_from.close()
-    if not passed_write_buffer:
-        write_to.close()
-    return filesize
 
 def _calc_filesize(file: BufferedReader | BufferedWriter) -> int:
 
@@ -0,0 +1,393 @@
+import io
+import logging
+import os
+import posixpath
+import shutil
+import tarfile
+import time
+import zipfile
+
+from io import BufferedReader, BufferedWriter
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, NoReturn, Optional, Tuple
+
+from .archive import SngArchive
+from .common import (
+    SNG_AUDIO_EXT,
+    SNG_IMG_EXT,
+    SNG_VIDEO_EXT,
+    SngMetadataInfo,
+)
+from .decode import _members_to_extract, format_song_ini
+from .encode import (
+    _check_name,
+    _raise_if_exists,
+    _xor_mask_or_random,
+    parse_song_ini,
+    write_members_forward,
+)
+
+__all__ = ["sng_to_pack", "pack_to_sng", "PACK_FORMATS"]
+
+logger = logging.getLogger(__package__)
+
+# Pack formats, and the suffixes they are recognized by
+PACK_FORMATS: Dict[str, Tuple[str, ...]] = {
+    "zip": (".zip",),
+    "tar": (".tar",),
+    "tar.gz": (".tar.gz", ".tgz"),
+    "tar.bz2": (".tar.bz2", ".tbz2"),
+    "tar.xz": (".tar.xz", ".txz"),
+}
+
+# Files already compressed, stored in zip packs as is rather than deflated
+_COMPRESSED_EXT = (SNG_AUDIO_EXT | SNG_IMG_EXT | SNG_VIDEO_EXT) - {"wav"}
+_COPY_CHUNK_SIZE = 1 << 20
+
+
+def _pack_format(pack: os.PathLike | str | BufferedReader, format: Optional[str]) -> str | NoReturn:
+    """
+    Returns the format of a pack, guessed from its name when not given. Internal function.
+    """
+    if format is not None:
+        if format not in PACK_FORMATS:
+            raise ValueError(
+                "Unknown pack format %s, expected one of %s" % (format, ", ".join(PACK_FORMATS))
+            )
+        return format
+    name = getattr(pack, "name", pack)
+    if isinstance(name, (str, os.PathLike)):
+        name = os.fspath(name).lower()
+        for fmt, suffixes in PACK_FORMATS.items():
+            if name.endswith(suffixes):
+                return fmt
+    raise ValueError(
+        "Unable to tell the format of pack %s, pass one of %s" % (name, ", ".join(PACK_FORMATS))
+    )
+
+
+def _tar_mode(format: str, access: str, stream: bool) -> str:
+    compression = format[len("tar.") :] if "." in format else ""
+    return "%s%s%s" % (access, "|" if stream else ":", compression)
+
+
+class _ZipWriter:
+    """
+    Adds files to a zip pack from readers, deflating only what isn't already compressed.
+    Internal use.
+    """
+
+    def __init__(self, pack: os.PathLike | str | BufferedWriter) -> None:
+        self._zip = zipfile.ZipFile(pack, "w")
+        self._date_time = time.localtime()[:6]
+
+    def add(self, arcname: str, fileobj: BufferedReader, size: int) -> None:
+        info = zipfile.ZipInfo(arcname, self._date_time)
+        ext = arcname.rsplit(".", 1)[-1].lower()
+        info.compress_type = zipfile.ZIP_STORED if ext in _COMPRESSED_EXT else zipfile.ZIP_DEFLATED
+        info.file_size = size
+        with self._zip.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as dest:
+            shutil.copyfileobj(fileobj, dest, _COPY_CHUNK_SIZE)
+
+    def close(self) -> None:
+        self._zip.close()
+
+
+class _TarWriter:
+    """
+    Adds files to a tar pack from readers. Outputs that can't seek are written as a stream.
+    Internal use.
+    """
+
+    def __init__(self, pack: os.PathLike | str | BufferedWriter, format: str) -> None:
+        if isinstance(pack, (str, os.PathLike)):
+            self._tar = tarfile.open(pack, _tar_mode(format, "w", False))
+        else:
+            stream = not pack.seekable()
+            self._tar = tarfile.open(fileobj=pack, mode=_tar_mode(format, "w", stream))
+        self._mtime = time.time()
+
+    def add(self, arcname: str, fileobj: BufferedReader, size: int) -> None:
+        info = tarfile.TarInfo(arcname)
+        info.size = size
+        info.mtime = self._mtime
+        info.mode = 0o644
+        self._tar.addfile(info, fileobj)
+
+    def close(self) -> None:
+        self._tar.close()
+
+
+def sng_to_pack(
+    sng_files: Iterable[os.PathLike | str],
+    pack: os.PathLike | str | BufferedWriter,
+    *,
+    format: Optional[str] = None,
+    allow_nonsng_files: bool = False,
+) -> int:
+    """
+    Converts SNG files to a zip or tar pack, one folder per SNG file named after it, holding
+    its song.ini and files. Each file is unmasked as it is streamed into the pack, nothing
+    is written to disk besides the pack.
+
+    Args:
+        sng_files (Iterable[os.PathLike | str]): The SNG files to convert.
+        pack (os.PathLike | str | BufferedWriter): Path of the pack, or a writable binary stream. Streams that can't seek are written as streamed zip or tar files.
+        format (str, optional): One of `PACK_FORMATS`. Defaults to the one of the name of `pack`.
+        allow_nonsng_files (bool, optional): Allow converting files not allowed by the sng standard. Defaults to False.
+
+    Returns:
+        int: The number of files added to the pack, song.ini files included.
+
+    Raises:
+        ValueError: When the format is unknown or can't be guessed, or two SNG files have the same name
+    """
+    format = _pack_format(pack, format)
+    writer = _ZipWriter(pack) if format == "zip" else _TarWriter(pack, format)
+    song_dirs = set()
+    added = 0
+    try:
+        for sng_file in sng_files:
+            song_dir = Path(sng_file).stem
+            if song_dir in song_dirs:
+                raise ValueError("Two sng files are named %s" % song_dir)
+            song_dirs.add(song_dir)
+            logger.info("Adding %s to the pack", sng_file)
+            with SngArchive(sng_file) as archive:
+                ini = format_song_ini(archive.metadata).encode("utf-8")
+                writer.add(posixpath.join(song_dir, "song.ini"), io.BytesIO(ini), len(ini))
+                added += 1
+                for file_meta in _members_to_extract(archive.members(), allow_nonsng_files):
+                    with archive.open_member(file_meta.filename) as member:
+                        writer.add(
+                            posixpath.join(song_dir, file_meta.filename),
+                            member,
+                            file_meta.content_len,
+                        )
+                    added += 1
+    except BaseException:
+        writer.close()
+        # a partial pack is not left behind
+        if isinstance(pack, (str, os.PathLike)) and os.path.exists(pack):
+            os.remove(pack)
+        raise
+    writer.close()
+    logger.info("Wrote %d files to the pack", added)
+    return added
+
+
+class _PackEntry(NamedTuple):
+    """
+    A file of a pack being read, opened on demand. Internal use.
+    """
+
+    name: str
+    size: int
+    open: Callable[[], BufferedReader]
+
+
+def _pack_entries(pack: os.PathLike | str | BufferedReader, format: str) -> Tuple[List[_PackEntry], object]:
+    """
+    Lists the files of a pack. Returns them along with the open pack, which the caller closes.
+    Internal function.
+    """
+    if format == "zip":
+        zf = zipfile.ZipFile(pack)
+        entries = [
+            _PackEntry(info.filename, info.file_size, lambda info=info: zf.open(info))
+            for info in zf.infolist()
+            if not info.is_dir()
+        ]
+        return entries, zf
+    if isinstance(pack, (str, os.PathLike)):
+        tf = tarfile.open(pack, _tar_mode(format, "r", False))
+    else:
+        tf = tarfile.open(fileobj=pack, mode=_tar_mode(format, "r", False))
+    entries = [
+        _PackEntry(info.name, info.size, lambda info=info: tf.extractfile(info))
+        for info in tf.getmembers()
+        if info.isfile()
+    ]
+    return entries, tf
+
+
+def _split_entry_name(name: str) -> Tuple[str, str]:
+    """
+    Splits the name of a file of a pack into its folder and filename, dropping empty and `.`
+    components. A leading `/` is kept, so absolute names can be rejected. Internal function.
+    """
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if not parts:
+        return "", ""
+    song_dir = "/".join(parts[:-1])
+    if name.startswith("/"):
+        song_dir = "/" + song_dir
+    return song_dir, parts[-1]
+
+
+def _song_output(outdir: os.PathLike | str, song_dir: str) -> Path | NoReturn:
+    """
+    Path of the SNG file of a song of a pack, which has to stay within `outdir`. Internal function.
+
+    Raises:
+        ValueError: When the folder of the song is absolute, or leads out of `outdir`
+    """
+    if song_dir.startswith("/") or ".." in song_dir.split("/"):
+        raise ValueError("Song folder %s leads outside of the output directory" % song_dir)
+    output = Path(outdir, song_dir + ".sng")
+    root = Path(outdir).resolve()
+    if not output.resolve().is_relative_to(root):
+        raise ValueError("Song folder %s leads outside of the output directory" % song_dir)
+    return output
+
+
+def _pack_songs(entries: List[_PackEntry]) -> Dict[str, Tuple[_PackEntry, List[_PackEntry]]]:
+    """
+    Groups the files of a pack by song: every folder holding a song.ini, with the files
+    directly inside it. Internal function.
+    """
+    songs = {}
+    for entry in entries:
+        song_dir, filename = _split_entry_name(entry.name)
+        if filename == "song.ini":
+            songs[song_dir] = (entry, [])
+    for entry in entries:
+        song_dir, filename = _split_entry_name(entry.name)
+        if song_dir in songs and filename != "song.ini":
+            songs[song_dir][1].append(entry)
+    return songs
+
+
+def _song_members(
+    entries: List[_PackEntry], allow_nonsng_files: bool
+) -> List[_PackEntry]:
+    members = []
+    for entry in entries:
+        filename = posixpath.basename(entry.name)
+        try:
+            _check_name(filename, allow_nonsng_files)
+        except ValueError as err:
+            logger.warning("Skipping %s: %s", entry.name, err)
+            continue
+        members.append(entry)
+    return members
+
+
+def _read_song_ini(entry: _PackEntry) -> SngMetadataInfo:
+    with entry.open() as f:
+        return parse_song_ini(io.TextIOWrapper(f, encoding="utf-8"), entry.name)
+
+
+def pack_to_sng(
+    pack: os.PathLike | str | BufferedReader,
+    outdir: Optional[os.PathLike | str] = None,
+    *,
+    format: Optional[str] = None,
+    overwrite: bool = False,
+    allow_nonsng_files: bool = False,
+    version: int = 1,
+    xor_mask: Optional[bytes] = None,
+) -> List[Path]:
+    """
+    Converts every song of a zip or tar pack to an SNG file. A song is a folder of the pack
+    holding a song.ini, and its files are the ones directly inside it. Each file is masked as it
+    is streamed out of the pack, nothing is extracted.
+
+    The SNG files keep the layout of the pack: the song `Pack/Artist - Song/` is written to
+    `outdir/Pack/Artist - Song.sng`. A song.ini at the root of the pack gives an SNG file
+    named after the pack. Files are stored as given, audio is not transcoded.
+
+    A song that can't be converted, because its SNG file exists or its folder is absolute or
+    leads out of `outdir`, is logged and skipped, and the rest of the pack is still converted.
+    The failed songs are raised once the pack is done.
+
+    Args:
+        pack (os.PathLike | str | BufferedReader): Path of the pack, or a seekable binary stream.
+        outdir (os.PathLike | str, optional): Directory to write the SNG files to. Defaults to the current directory.
+        format (str, optional): One of `PACK_FORMATS`. Defaults to the one of the name of `pack`.
+        overwrite (bool, optional): If True, existing SNG files are overwritten. Defaults to False.
+        allow_nonsng_files (bool, optional): Allow converting files not allowed by the sng standard. Defaults to False.
+        version (int, optional): The version of the SNG format to use. Defaults to 1.
+        xor_mask (bytes, optional): XOR mask of every SNG file. A random one is generated per file if not provided.
+
+    Returns:
+        List[Path]: The paths of the written SNG files.
+
+    Raises:
+        ValueError: When the format is unknown or can't be guessed, or the pack has no song.ini
+        RuntimeError: When any song failed to convert, after converting the others
+    """
+    format = _pack_format(pack, format)
+    if outdir is None:
+        outdir = os.curdir
+    pack_name = Path(os.fspath(getattr(pack, "name", pack))).name
+    for suffix in PACK_FORMATS[format]:
+        if pack_name.lower().endswith(suffix):
+            pack_name = pack_name[: -len(suffix)]
+            break
+
+    entries, opened = _pack_entries(pack, format)
+    written: List[Path] = []
+    failed: List[str] = []
+    try:
+        songs = _pack_songs(entries)
+        if not songs:
+            raise ValueError("No song.ini found in pack %s" % pack_name)
+        for song_dir, (ini_entry, files) in sorted(songs.items()):
+            song = song_dir or pack_name
+            try:
+                output = _song_output(outdir, song)
+                _raise_if_exists(output, overwrite)
+                metadata = _read_song_ini(ini_entry)
+                members = _song_members(files, allow_nonsng_files)
+                logger.info("Converting %s to %s", song, output)
+                output.parent.mkdir(parents=True, exist_ok=True)
+                _write_song(output, metadata, members, version, _xor_mask_or_random(xor_mask))
+            except Exception as err:
+                logger.error("Failed to convert %s. Error: %s", song, err)
+                failed.append("%s (%s: %s)" % (song, type(err).__name__, err))
+                continue
+            written.append(output)
+    finally:
+        opened.close()
+    logger.info("Wrote %d sng files from %s (failed: %d)", len(written), pack_name, len(failed))
+    if failed:
+        raise RuntimeError(
+            "Failed to convert %d of %d songs of %s: %s"
+            % (len(failed), len(songs), pack_name, "; ".join(failed))
+        )
+    return written
+
+
+def _write_song(
+    output: Path,
+    metadata: SngMetadataInfo,
+    members: List[_PackEntry],
+    version: int,
+    xor_mask: bytes,
+) -> None:
+    """
+    Writes one song of a pack as an SNG file, removing it if the conversion fails. Internal function.
+    """
+    readers = []
+    try:
+        with open(output, "wb") as out:
+            for entry in members:
+                readers.append(entry.open())
+            write_members_forward(
+                out,
+                metadata,
+                [
+                    (posixpath.basename(entry.name), reader, entry.size)
+                    for entry, reader in zip(members, readers)
+                ],
+                version=version,
+                xor_mask=xor_mask,
+            )
+    except BaseException:
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+    finally:
+        for reader in readers:
+            reader.close()
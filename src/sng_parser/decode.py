@@ -1,34 +1,43 @@
+import io
 import logging
+import mmap
 import os
 import re
-import struct
 
+from fnmatch import fnmatchcase
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BufferedReader
 from pathlib import Path
-from typing import List, Optional, NoReturn, Tuple
+from typing import Iterable, List, Optional, NoReturn, Tuple
 
 from configparser import ConfigParser
 
 from .common import (
-    _with_endian,
+    FILE_ENTRY,
+    HEADER,
+    MIN_CHUNK_SIZE,
+    U8,
+    U32,
+    U64,
     SngFileMetadata,
     SngMetadataInfo,
-    calc_and_unpack,
     SngHeader,
-    StructTypes,
-    calc_and_read_buf,
+    read_struct,
+    string_codec,
     _valid_sng_file,
     _fail_on_invalid_sng_ver,
     _illegal_filename,
     _filter_illegal_chars,
     write_and_mask,
+    pread_and_mask,
 )
+from .stats import SngStats, phase_timer
 
 __all__ = [
     'decode_sng'
 ]
 
-s = StructTypes
 logger = logging.getLogger(__package__)
 
 
@@ -47,9 +56,7 @@ def read_sng_header(buffer: BufferedReader) -> SngHeader:
     xor_mask: bytes
     version: int
     file_identifier: bytes
-    file_identifier, version, xor_mask = calc_and_unpack(
-        _with_endian(6, s.CHAR, s.UINT, 16, s.CHAR), buffer
-    )
+    file_identifier, version, xor_mask = read_struct(HEADER, buffer)
     _fail_on_invalid_sng_ver(version)
     return SngHeader(file_identifier, version, xor_mask)
 
@@ -69,28 +76,20 @@ def decode_filedata(buffer: BufferedReader) -> Tuple[SngFileMetadata, int]:
     logger.debug("Retrieving file metadata")
     amt_read: int = 0
 
-    logger.debug("Reading filename length")
-    fmt = _with_endian(s.UBYTE)
-    read_size, content = calc_and_read_buf(fmt, buffer)
-    amt_read += read_size
-    filename_len: int = struct.unpack(fmt, content)[0]
-    logger.debug("Filename length: %d (bytes: %d)", filename_len, read_size)
+    filename_len: int = read_struct(U8, buffer)[0]
+    amt_read += U8.size
+    logger.debug("Filename length: %d", filename_len)
 
-    logger.debug("Reading filename string")
-    fmt = _with_endian(filename_len, s.CHAR)
-    read_size, content = calc_and_read_buf(fmt, buffer)
-    amt_read += read_size
-    filename: str = struct.unpack(fmt, content)[0].decode()
-    logger.debug("Filename: %s (bytes: %d)", filename, read_size)
+    codec = string_codec(filename_len)
+    filename: str = read_struct(codec, buffer)[0].decode()
+    amt_read += codec.size
+    logger.debug("Filename: %s", filename)
 
     contents_len: int
     contents_index: int
 
-    logger.debug("Reading file content offset and file content size")
-    fmt = _with_endian(s.ULONGLONG, s.ULONGLONG)
-    read_size, content = calc_and_read_buf(fmt, buffer)
-    amt_read += read_size
-    contents_len, contents_index = struct.unpack(fmt, content)
+    contents_len, contents_index = read_struct(FILE_ENTRY, buffer)
+    amt_read += FILE_ENTRY.size
     logger.debug("File content size: %d (offset %d)", contents_len, contents_index)
 
     metadata = SngFileMetadata(filename, contents_len, contents_index)
@@ -100,11 +99,72 @@ def decode_filedata(buffer: BufferedReader) -> Tuple[SngFileMetadata, int]:
     return metadata, amt_read
 
 
+def _read_section(buffer: BufferedReader, length: int, section: str) -> memoryview:
+    """
+    Internal function.
+    Reads a whole length-prefixed section from the buffer in a single call.
+
+    Args:
+        buffer (BufferedReader): The input buffer, positioned after the length prefix.
+        length (int): The length of the section.
+        section (str): Name of the section, used in error messages.
+
+    Returns:
+        memoryview: The contents of the section.
+
+    Raises:
+        RuntimeError: When the section is longer than what is left of the buffer
+    """
+    left = _bytes_left(buffer)
+    if left is not None and length > left:
+        # a corrupt length never turns into a huge read
+        raise RuntimeError(
+            "%s read mismatch. Expected %d, %d left" % (section, length, left)
+        )
+    if left is None and length > MIN_CHUNK_SIZE:
+        content = bytearray()
+        while len(content) < length:
+            chunk = buffer.read(min(MIN_CHUNK_SIZE, length - len(content)))
+            if not chunk:
+                break
+            content += chunk
+    else:
+        content = buffer.read(length)
+    if len(content) != length:
+        raise RuntimeError(
+            "%s read mismatch. Expected %d, read %d" % (section, length, len(content))
+        )
+    return memoryview(content)
+
+
+def _bytes_left(buffer: BufferedReader | mmap.mmap) -> Optional[int]:
+    """
+    Internal function.
+    Number of bytes between the position of the buffer and its end, or None when it can't seek.
+    """
+    if isinstance(buffer, mmap.mmap):
+        return len(buffer) - buffer.tell()
+    if not buffer.seekable():
+        return None
+    pos = buffer.tell()
+    end = buffer.seek(0, os.SEEK_END)
+    buffer.seek(pos)
+    return end - pos
+
+
+def _section_bounds(section: str, end: int, section_len: int) -> None | NoReturn:
+    if end > section_len:
+        raise RuntimeError(
+            "%s read mismatch. Expected %d, read %d" % (section, section_len, end)
+        )
+
+
 def decode_file_metadata(buffer: BufferedReader) -> List[SngFileMetadata]:
     """
     Decodes and returns a list of SngFileMetadata objects from the given buffer.
 
-    Reads the overall length of the file metadata section, the count of files, and then iterates to read each file's metadata.
+    Reads the overall length of the file metadata section, then reads the whole section at once
+    and unpacks the count of files and each file's metadata from it.
 
     Args:
         buffer (BufferedReader): The input buffer from which to decode the file metadata.
@@ -113,33 +173,42 @@ def decode_file_metadata(buffer: BufferedReader) -> List[SngFileMetadata]:
         List[SngFileMetadata]: A list of file metadata objects.
     """
     logger.info("Decoding sng file content metadata")
-    amt_read: int = 0
+    debug = logger.isEnabledFor(logging.DEBUG)
 
-    logger.debug("Reading file metadata")
-    file_meta_len: int = calc_and_unpack(_with_endian(s.ULONGLONG), buffer)[0]
-    logger.debug("File metadata content length: %d", file_meta_len)
+    file_meta_len: int = read_struct(U64, buffer)[0]
+    if debug:
+        logger.debug("File metadata content length: %d", file_meta_len)
+    section = _read_section(buffer, file_meta_len, "File metadata")
 
-    logger.debug("Reading file count")
-    bytes_read, content = calc_and_read_buf(_with_endian(s.ULONGLONG), buffer)
-    amt_read += bytes_read
-    file_count: int = struct.unpack(_with_endian(s.ULONGLONG), content)[0]
-    logger.debug("File count: %d (bytes: %d)", file_count, bytes_read)
+    _section_bounds("File metadata", U64.size, file_meta_len)
+    file_count: int = U64.unpack_from(section)[0]
+    if debug:
+        logger.debug("File count: %d", file_count)
+    pos = U64.size
 
     file_meta_array: List[SngFileMetadata] = []
     for _ in range(file_count):
-        file_meta, bytes_read = decode_filedata(buffer)
-        amt_read += bytes_read
-        logger.debug(
-            "Retrieved metadata of %s (offset: %d, content length: %d)",
-            file_meta.filename,
-            file_meta.content_idx,
-            file_meta.content_len,
-        )
-        file_meta_array.append(file_meta)
-    if file_meta_len != amt_read:
+        _section_bounds("File metadata", pos + U8.size, file_meta_len)
+        filename_len: int = U8.unpack_from(section, pos)[0]
+        pos += U8.size
+        codec = string_codec(filename_len)
+        _section_bounds("File metadata", pos + codec.size + FILE_ENTRY.size, file_meta_len)
+        filename: str = codec.unpack_from(section, pos)[0].decode()
+        pos += codec.size
+        contents_len, contents_index = FILE_ENTRY.unpack_from(section, pos)
+        pos += FILE_ENTRY.size
+        if debug:
+            logger.debug(
+                "Retrieved metadata of %s (offset: %d, content length: %d)",
+                filename,
+                contents_index,
+                contents_len,
+            )
+        file_meta_array.append(SngFileMetadata(filename, contents_len, contents_index))
+    if file_meta_len != pos:
         raise RuntimeError(
             "File metadata read mismatch. Expected %d, read %d"
-            % (file_meta_len, amt_read)
+            % (file_meta_len, pos)
         )
 
     logger.info("Decoded file metadata for %d files", len(file_meta_array))
@@ -151,7 +220,8 @@ def decode_metadata(sng_buffer: BufferedReader) -> SngMetadataInfo:
     """
     Decodes the key-value pairs of metadata from the SNG buffer and returns them as a dictionary.
 
-    Reads the total length of the metadata section and the number of metadata entries, then decodes each key-value pair.
+    Reads the total length of the metadata section, then reads the whole section at once
+    and unpacks the number of metadata entries and each key-value pair from it.
 
     Args:
         sng_buffer (BufferedReader): The input buffer from which to decode the metadata.
@@ -160,56 +230,44 @@ def decode_metadata(sng_buffer: BufferedReader) -> SngMetadataInfo:
         SngMetadataInfo: A dictionary containing the metadata key-value pairs.
     """
     logger.info("Decoding sng metadata")
-    total_bytes: int = 0
+    debug = logger.isEnabledFor(logging.DEBUG)
 
-    logger.debug("Reading metadata content length")
-    metadata_len: int = calc_and_unpack(_with_endian(s.ULONGLONG), sng_buffer)[0]
-    logger.debug("Metadata content length: %d", metadata_len)
+    metadata_len: int = read_struct(U64, sng_buffer)[0]
+    if debug:
+        logger.debug("Metadata content length: %d", metadata_len)
+    section = _read_section(sng_buffer, metadata_len, "Metadata")
 
-    logger.debug("Reading song metadata count")
-    bytes_read, content = calc_and_read_buf(_with_endian(s.ULONGLONG), sng_buffer)
-    total_bytes += bytes_read
-    metadata_count: int = struct.unpack(_with_endian(s.ULONGLONG), content)[0]
-    logger.debug("Metadata entries: %d (bytes: %d)", metadata_count, bytes_read)
+    _section_bounds("Metadata", U64.size, metadata_len)
+    metadata_count: int = U64.unpack_from(section)[0]
+    if debug:
+        logger.debug("Metadata entries: %d", metadata_count)
+    pos = U64.size
 
     metadata = {}
 
     for i in range(metadata_count):
-        logger.debug("Retrieving metadata key size of entry %d", i + 1)
-        fmt = _with_endian(s.UINT)
-        bytes_read, content = calc_and_read_buf(fmt, sng_buffer)
-        total_bytes += bytes_read
-        key_len: int = struct.unpack(fmt, content)[0]
-        logger.debug("Metadata key size: %d (bytes: %d)", key_len, bytes_read)
-
-        logger.debug("Retrieving metadata key %d", i + 1)
-        fmt = _with_endian(key_len, s.CHAR)
-        bytes_read, content = calc_and_read_buf(fmt, sng_buffer)
-        total_bytes += bytes_read
-        key: str = struct.unpack(fmt, content)[0].decode()
-        logger.debug("Metadata key %d: '%s' (bytes: %d)", i + 1, key, bytes_read)
-
-        logger.debug("Retriveing metadata value size of '%s'", key)
-        fmt = _with_endian(s.UINT)
-        bytes_read, content = calc_and_read_buf(fmt, sng_buffer)
-        total_bytes += bytes_read
-        value_len: int = struct.unpack(fmt, content)[0]
-        logger.debug("Metadata value size: %d (bytes: %d)", value_len, bytes_read)
-
-        logger.debug("Retriveing metadata value of '%s'", key)
-        fmt = _with_endian(value_len, s.CHAR)
-        bytes_read, content = calc_and_read_buf(fmt, sng_buffer)
-        total_bytes += bytes_read
-        value: str = struct.unpack(fmt, content)[0].decode()
-        logger.debug(
-            "Metadata value for key '%s': '%s' (bytes: %d)", key, value, bytes_read
-        )
+        _section_bounds("Metadata", pos + U32.size, metadata_len)
+        key_len: int = U32.unpack_from(section, pos)[0]
+        pos += U32.size
+        codec = string_codec(key_len)
+        _section_bounds("Metadata", pos + codec.size + U32.size, metadata_len)
+        key: str = codec.unpack_from(section, pos)[0].decode()
+        pos += codec.size
+
+        value_len: int = U32.unpack_from(section, pos)[0]
+        pos += U32.size
+        codec = string_codec(value_len)
+        _section_bounds("Metadata", pos + codec.size, metadata_len)
+        value: str = codec.unpack_from(section, pos)[0].decode()
+        pos += codec.size
+        if debug:
+            logger.debug("Metadata entry %d: '%s' = '%s'", i + 1, key, value)
 
         metadata[key] = value
 
-    if total_bytes != metadata_len:
+    if pos != metadata_len:
         raise RuntimeError(
-            "Metadata read mismatch. Expected %d, read %d" % (metadata_len, total_bytes)
+            "Metadata read mismatch. Expected %d, read %d" % (metadata_len, pos)
         )
 
     metadata_attrs_read = len(metadata)
@@ -221,6 +279,63 @@ def decode_metadata(sng_buffer: BufferedReader) -> SngMetadataInfo:
     return metadata
 
 
+def read_file_data_len(
+    file_meta_array: List[SngFileMetadata], buffer: BufferedReader
+) -> int:
+    """
+    Reads the length of the file data section and verifies it matches the total
+    content length recorded in the file metadata.
+
+    Args:
+        file_meta_array (List[SngFileMetadata]): List of file metadata objects.
+        buffer (BufferedReader): The input buffer, positioned at the start of the file data section.
+
+    Returns:
+        int: The length of the file data section.
+
+    Raises:
+        RuntimeError: When the section length and the file metadata disagree
+    """
+    file_data_len: int = read_struct(U64, buffer)[0]
+    logger.debug("Content size of the files: %d", file_data_len)
+    logger.debug(
+        "Verifying file section content size matches file metadata content size"
+    )
+    file_meta_content_size: int = sum(map(lambda x: x.content_len, file_meta_array))
+    logger.debug("File metadata content size total: %d", file_meta_content_size)
+
+    if file_meta_content_size != file_data_len:
+        raise RuntimeError(
+            "File content size mismatch. Expected %d, got %d)"
+            % (file_data_len, file_meta_content_size)
+        )
+    return file_data_len
+
+
+def read_sng_tables(
+    buffer: BufferedReader,
+) -> Tuple[SngHeader, SngMetadataInfo, List[SngFileMetadata]]:
+    """
+    Reads the header, metadata and file metadata sections of an SNG file, leaving the buffer
+    at the start of the file data section.
+
+    Args:
+        buffer (BufferedReader): The input buffer, positioned at the start of the SNG file.
+
+    Returns:
+        Tuple[SngHeader, SngMetadataInfo, List[SngFileMetadata]]: The header, the metadata and the file metadata.
+
+    Raises:
+        TypeError: When the file identifier is not the one of an SNG file
+    """
+    header = read_sng_header(buffer)
+    if header.file_identifier != b"SNGPKG":
+        raise TypeError("Invalid file identifier")
+    metadata = decode_metadata(buffer)
+    file_meta_array = decode_file_metadata(buffer)
+    return header, metadata, file_meta_array
+
+
 def write_file_contents(
     file_meta_array: List[SngFileMetadata],
     buffer: BufferedReader,
@@ -228,6 +343,10 @@ def write_file_contents(
     allow_nonsng_files: bool,
     xor_mask: bytes,
     outdir: os.PathLike,
+    workers: int = 1,
+    include: Optional[Iterable[str]] = None,
+    exclude: Optional[Iterable[str]] = None,
+    stats: Optional[SngStats] = None,
 ):
     """
     Writes the actual file contents for each file metadata in the list to the specified output directory.
@@ -240,26 +359,83 @@ def write_file_contents(
         allow_nonsng_files (bool): Allow decoding of files not allowed by the sng standard.
         xor_mask (bytes): The XOR mask to apply for decryption.
         outdir (os.PathLike): The output directory where files will be written.
+        workers (int, optional): Number of threads extracting files at once. Defaults to 1.
+        include (Iterable[str], optional): Glob patterns of the files to write. Defaults to every file.
+        exclude (Iterable[str], optional): Glob patterns of files not to write, applied after `include`.
+        stats (SngStats, optional): Stats to record the time and bytes of each file in.
 
     Returns:
         None
     """
     logger.info("Writing decoded sng file to %s", outdir)
 
-    file_data_len: int = calc_and_unpack(_with_endian(s.ULONGLONG), buffer)[0]
-    logger.debug("Content size of the files: %d", file_data_len)
-    logger.debug(
-        "Verifying file section content size matches file metadata content size"
+    read_file_data_len(file_meta_array, buffer)
+
+    to_extract = _members_to_extract(
+        file_meta_array, allow_nonsng_files, include=include, exclude=exclude
     )
-    file_meta_content_size: int = sum(map(lambda x: x.content_len, file_meta_array))
-    logger.debug("File metadata content size total: %d", file_meta_content_size)
 
-    if file_meta_content_size != file_data_len:
-        raise RuntimeError(
-            "File content size mismatch. Expected %d, got %d)"
-            % (file_data_len, file_meta_content_size)
+    fd = _positional_fd(buffer) if workers > 1 and len(to_extract) > 1 else None
+    if fd is None:
+        for file_meta in to_extract:
+            buffer.seek(file_meta.content_idx)
+            _write_file_contents(
+                file_meta, buffer, xor_mask=xor_mask, outdir=outdir, stats=stats
+            )
+        return
+
+    workers = min(workers, len(to_extract))
+    logger.debug("Extracting %d files with %d threads", len(to_extract), workers)
+    pool = ThreadPoolExecutor(workers, thread_name_prefix="SngExtract")
+    futures = [
+        pool.submit(
+            _pwrite_file_contents, file_meta, fd, xor_mask=xor_mask, outdir=outdir, stats=stats
         )
+        for file_meta in to_extract
+    ]
+    try:
+        for future in as_completed(futures):
+            future.result()
+    except BaseException as e:
+        logger.error("Failed to extract files, cancelling remaining extractions")
+        pool.shutdown(cancel_futures=True)
+        raise e
+    pool.shutdown()
+
+
+def _matches(filename: str, patterns: Iterable[str]) -> bool:
+    return any(fnmatchcase(filename, pattern) for pattern in patterns)
+
+
+def _members_to_extract(
+    file_meta_array: List[SngFileMetadata],
+    allow_nonsng_files: bool,
+    *,
+    include: Optional[Iterable[str]] = None,
+    exclude: Optional[Iterable[str]] = None,
+) -> List[SngFileMetadata]:
+    """
+    Internal function.
+    Keeps the files matching `include` and not `exclude`, then drops the files with
+    illegal names, and files not allowed by the sng standard unless allowed.
+
+    Args:
+        file_meta_array (List[SngFileMetadata]): List of file metadata objects.
+        allow_nonsng_files (bool): Allow decoding of files not allowed by the sng standard.
+        include (Iterable[str], optional): Glob patterns of the files to keep. Defaults to every file.
+        exclude (Iterable[str], optional): Glob patterns of the files to drop.
 
+    Returns:
+        List[SngFileMetadata]: The files to write, in table order.
+    """
+    if include is not None:
+        include = list(include)
+        file_meta_array = [x for x in file_meta_array if _matches(x.filename, include)]
+    if exclude is not None:
+        exclude = list(exclude)
+        file_meta_array = [x for x in file_meta_array if not _matches(x.filename, exclude)]
+
+    to_extract: List[SngFileMetadata] = []
     for file_meta in file_meta_array:
         if _illegal_filename(file_meta.filename):
             logger.warn("Illegal filename: %s. Skipping", file_meta.filename)
@@ -278,9 +454,31 @@ def write_file_contents(
                 "Allowing non-sng files is set to True, decoding file %s.",
                 file_meta.filename,
             )
+        to_extract.append(file_meta)
+    return to_extract
 
-        buffer.seek(file_meta.content_idx)
-        _write_file_contents(file_meta, buffer, xor_mask=xor_mask, outdir=outdir)
+
+def _positional_fd(buffer: BufferedReader) -> Optional[int]:
+    """
+    Returns the file descriptor of `buffer` if it supports positional reads, None otherwise.
+    Internal function.
+    """
+    if not hasattr(os, "pread"):
+        logger.debug("Positional reads are not supported, extracting sequentially")
+        return None
+    try:
+        return buffer.fileno()
+    except (AttributeError, OSError):
+        logger.debug("Buffer has no file descriptor, extracting sequentially")
+        return None
+
+
+def _check_written(file_metadata: SngFileMetadata, bytes_written: int) -> None:
+    if file_metadata.content_len != bytes_written:
+        raise RuntimeError(
+            "File write mismatch. Expected %d, wrote %d"
+            % (file_metadata.content_len, bytes_written)
+        )
 
 
 def _write_file_contents(
@@ -289,6 +487,7 @@ def _write_file_contents(
     *,
     xor_mask: bytes,
     outdir: os.PathLike,
+    stats: Optional[SngStats] = None,
 ) -> None:
     """
     Internal function.
@@ -300,6 +499,7 @@ def _write_file_contents(
         buffer (BufferedReader): The input buffer from which to read the file contents.
         xor_mask (bytes): The XOR mask to apply for decryption.
         outdir (os.PathLike): The output directory where the file will be written.
+        stats (SngStats, optional): Stats to record the time and bytes of the file in.
 
     Returns:
         None
@@ -311,12 +511,49 @@ def _write_file_contents(
         write_to=file_path,
         xor_mask=xor_mask,
         filesize=file_metadata.content_len,
+        stats=stats,
+        member=file_metadata.filename,
     )
-    if file_metadata.content_len != bytes_written:
-        raise RuntimeError(
-            "File write mismatch. Expected %d, wrote %d"
-            % (file_metadata.content_len, bytes_written)
-        )
+    _check_written(file_metadata, bytes_written)
+
+    logger.debug("Wrote %s in %s", file_metadata.filename, outdir)
+
+
+def _pwrite_file_contents(
+    file_metadata: SngFileMetadata,
+    fd: int,
+    *,
+    xor_mask: bytes,
+    outdir: os.PathLike,
+    stats: Optional[SngStats] = None,
+) -> None:
+    """
+    Internal function.
+    Same as `_write_file_contents`, but reads with positional reads from `fd`,
+    so it can run alongside other extractions of the same sng file.
+
+    Args:
+        file_metadata (SngFileMetadata): The metadata for the file to write.
+        fd (int): File descriptor of the sng file.
+        xor_mask (bytes): The XOR mask to apply for decryption.
+        outdir (os.PathLike): The output directory where the file will be written.
+        stats (SngStats, optional): Stats to record the time and bytes of the file in.
+
+    Returns:
+        None
+    """
+    file_path = os.path.join(outdir, file_metadata.filename)
+    logger.debug("Writing file %s", file_metadata.filename)
+    bytes_written = pread_and_mask(
+        fd=fd,
+        offset=file_metadata.content_idx,
+        write_to=file_path,
+        xor_mask=xor_mask,
+        filesize=file_metadata.content_len,
+        stats=stats,
+        member=file_metadata.filename,
+    )
+    _check_written(file_metadata, bytes_written)
 
     logger.debug("Wrote %s in %s", file_metadata.filename, outdir)
 
@@ -361,6 +598,11 @@ def decode_sng(
     allow_nonsng_files: bool = False,
     sng_dir: Optional[os.PathLike | str] = None,
     overwrite: bool = False,
+    workers: int = 1,
+    include: Optional[Iterable[str]] = None,
+    exclude: Optional[Iterable[str]] = None,
+    metadata_only: bool = False,
+    stats: Optional[SngStats] = None,
 ) -> None | NoReturn:
     """
     Decodes an SNG file and writes its contents, including metadata and file data, to the specified output directory.
@@ -371,15 +613,17 @@ def decode_sng(
         allow_nonsng_files (bool, optional): Allow decoding of files not allowed by the sng standard. Defaults to False.
         sng_dir (os.PathLike | str, optional): The specific directory within outdir to write the decoded content. Generated from metadata if not specified.
         overwrite (bool, optional): If True, existing files or directories will be overwritten. Defaults to False.
+        workers (int, optional): Number of threads extracting files at once. Files are read with positional reads, so this needs a file with a descriptor. Defaults to 1.
+        include (Iterable[str], optional): Glob patterns, such as `notes.*`, of the files to decode. Defaults to every file.
+        exclude (Iterable[str], optional): Glob patterns of files not to decode. Files filtered out are skipped without being read.
+        metadata_only (bool, optional): Only write song.ini, without reading the file table. Defaults to False.
+        stats (SngStats, optional): Filled with the time and bytes spent in each phase, and per file.
 
     Returns:
         None | NoReturn: None on success, raises an exception on failure.
     """
     path_passed = not isinstance(sng_file, BufferedReader)
-    if outdir is None:
-        outdir = os.curdir
-    if isinstance(outdir, str):
-        outdir = _as_path_obj(outdir, validate=False)
+    outdir = _base_outdir(outdir)
     if isinstance(sng_file, str):
         sng_file = _as_path_obj(sng_file)
 
@@ -387,12 +631,80 @@ def decode_sng(
         _validate_path(sng_file)
         sng_file = open(sng_file, "rb")
 
+    timer = phase_timer(stats)
     header = read_sng_header(sng_file)
+    timer.lap("header", HEADER.size)
 
     if header.file_identifier.decode() != "SNGPKG":
         raise TypeError("Invalid file identifier")
 
+    start = _tell(sng_file)
     metadata = decode_metadata(sng_file)
+    timer.lap("metadata", _tell(sng_file) - start)
+    outdir = _create_song_dir(metadata, outdir, sng_dir, overwrite)
+    timer.lap("song_dir")
+
+    if not metadata_only:
+        start = _tell(sng_file)
+        file_meta_array: List[SngFileMetadata] = decode_file_metadata(sng_file)
+        timer.lap("file_table", _tell(sng_file) - start)
+        timer.done()
+        write_file_contents(
+            file_meta_array,
+            sng_file,
+            xor_mask=header.xor_mask,
+            outdir=outdir,
+            allow_nonsng_files=allow_nonsng_files,
+            workers=workers,
+            include=include,
+            exclude=exclude,
+            stats=stats,
+        )
+    timer.done()
+
+    if path_passed:
+        sng_file.close()
+
+    logger.info("Wrote sng file output in %s", outdir)
+
+
+def _tell(buffer: BufferedReader) -> int:
+    """
+    Position of `buffer`, or 0 if it can't tell it, such as a pipe. Internal function.
+    """
+    try:
+        return buffer.tell()
+    except OSError:
+        return 0
+
+
+def _base_outdir(outdir: Optional[os.PathLike | str]) -> os.PathLike:
+    if outdir is None:
+        outdir = os.curdir
+    if isinstance(outdir, str):
+        outdir = _as_path_obj(outdir, validate=False)
+    return outdir
+
+
+def _create_song_dir(
+    metadata: SngMetadataInfo,
+    outdir: os.PathLike,
+    sng_dir: Optional[os.PathLike | str],
+    overwrite: bool,
+) -> str:
+    """
+    Internal function.
+    Creates the directory of a decoded song and writes its song.ini.
+
+    Args:
+        metadata (SngMetadataInfo): The metadata of the song.
+        outdir (os.PathLike): The base output directory.
+        sng_dir (os.PathLike | str, optional): The directory within outdir. Generated from metadata if not specified.
+        overwrite (bool): If True, an existing directory is reused.
+
+    Returns:
+        str: The path of the created directory.
+    """
     if sng_dir is None:
         sng_dir = create_dirname(metadata)
     outdir = os.path.join(outdir, sng_dir)
@@ -403,20 +715,7 @@ def decode_sng(
         raise fe
 
     write_metadata(metadata, outdir)
-
-    file_meta_array: List[SngFileMetadata] = decode_file_metadata(sng_file)
-    write_file_contents(
-        file_meta_array,
-        sng_file,
-        xor_mask=header.xor_mask,
-        outdir=outdir,
-        allow_nonsng_files=allow_nonsng_files,
-    )
-
-    if path_passed:
-        sng_file.close()
-
-    logger.info("Wrote sng file output in %s", outdir)
+    return outdir
 
 
 def create_dirname(metadata: SngFileMetadata) -> str:
@@ -448,10 +747,24 @@ def write_metadata(metadata: SngMetadataInfo, outdir: os.PathLike) -> None:
         None
     """
     logger.info("Writing metadata to %s" % outdir)
+    with open(os.path.join(outdir, "song.ini"), "w") as f:
+        f.write(format_song_ini(metadata))
+    logger.debug("Wrote song.ini in %s", outdir)
+
+
+def format_song_ini(metadata: SngMetadataInfo) -> str:
+    """
+    Formats metadata as the contents of a song.ini, under a '[Song]' section.
+
+    Args:
+        metadata (SngMetadataInfo): The metadata to format.
+
+    Returns:
+        str: The contents of the song.ini.
+    """
     cfg = ConfigParser()
     cfg.add_section("Song")
     cfg["Song"] = metadata
-    with open(os.path.join(outdir, "song.ini"), "w") as f:
-        cfg.write(f)
-
-    logger.debug("Wrote song.ini in %s", outdir)
+    buf = io.StringIO()
+    cfg.write(buf)
+    return buf.getvalue()
@@ -1,34 +1,46 @@
 import hashlib
+import io
 import logging
 import os
-import struct
 from pathlib import Path
-from copy import deepcopy
 from configparser import ConfigParser
-from io import BufferedWriter
-from typing import List, Optional, Tuple
+from io import BufferedReader, BufferedWriter
+from typing import Dict, Iterable, List, NoReturn, Optional, Tuple
 
 
 from .common import (
     SNG_RESERVED_FILES,
-    _with_endian,
+    SNG_TRANSCODE_EXT,
+    FILE_ENTRY,
+    HEADER,
+    U8,
+    U32,
+    U64,
     _fail_on_invalid_sng_ver,
     write_and_mask,
-    _validate_and_pack,
+    pack_uint,
+    pack_uint_into,
+    pack_str_into,
     _valid_sng_file,
     _illegal_filename,
     SngFileMetadata,
     SngMetadataInfo,
-    StructTypes,
     FileOffset,
 )
+from .stats import SngStats, phase_timer
 
-from .audio import parllel_transcode_opus, eval_audio_futures
+from .audio import (
+    TranscodeCache,
+    collect_audio_futures,
+    eval_audio_futures,
+    parllel_transcode_opus,
+)
 
-s = StructTypes
 logger = logging.getLogger(__package__)
 
-__all__ = ["decode_sng"]
+MemberSource = bytes | bytearray | memoryview | BufferedReader
+
+__all__ = ["encode_sng", "encode_sng_from_members"]
 
 
 def write_header(file: BufferedWriter, version: int, xor_mask: bytes) -> None:
@@ -50,110 +62,181 @@ def write_header(file: BufferedWriter, version: int, xor_mask: bytes) -> None:
     logger.info("Writing sng header")
     file.write(b"SNGPKG")
     _fail_on_invalid_sng_ver(version)
-    file.write(_validate_and_pack(_with_endian(s.UINT), version))
+    file.write(pack_uint(U32, version))
     file.write(xor_mask)
     logger.info("Wrote header")
 
 
+def _check_name(filename: str, allow_nonsng_files: bool) -> None | NoReturn:
+    """
+    Raises a ValueError for a member name `gather_files_from_directory` would skip. Internal function.
+    """
+    if _illegal_filename(filename):
+        raise ValueError("Illegal filename: %s" % filename)
+    if filename in SNG_RESERVED_FILES:
+        raise ValueError("%s is reserved, pass it as metadata instead" % filename)
+    if not allow_nonsng_files and not _valid_sng_file(filename):
+        raise ValueError("File not allowed by the sng standard: %s" % filename)
+
+
+def _transcoded_name(filename: str, convert_to_opus: bool) -> Optional[str]:
+    """
+    Returns the filename a file is stored under after transcoding, or None if it is stored as is.
+    """
+    if not convert_to_opus or "." not in filename:
+        return None
+    name, ext = filename.rsplit(".", 1)
+    if ext not in SNG_TRANSCODE_EXT:
+        return None
+    return name + ".opus"
+
+
 def write_file_meta(
-    file: BufferedWriter, file_meta_array: List[SngFileMetadata], convert_to_opus: bool
-) -> None:
+    file: BufferedWriter,
+    file_meta_array: List[SngFileMetadata],
+    convert_to_opus: bool,
+    *,
+    start: Optional[int] = None,
+) -> List[FileOffset]:
     """
     Writes metadata for multiple files included in the SNG package.
 
     Each file's metadata includes its name, content length, and offset within the SNG file.
     The total size of the metadata section and the number of files are also included.
+    The whole section is packed into one buffer and written at once.
+
+    When converting to opus, the entries of transcoded files are placeholders with a content
+    length and offset of 0, patched in place once transcoding is done.
 
     Args:
         file (BufferedWriter): The file buffer to write the metadata to.
         file_meta_array (List[SngFileMetadata]): A list of metadata objects for each file.
+        convert_to_opus (bool): Whether audio files are transcoded to opus.
+        start (int, optional): Position of the section from the start of the SNG file. Defaults to the position of `file`.
 
     Returns:
-        None
+        List[FileOffset]: The position from the start of the SNG file of the content length and offset of each file's entry.
     """
-    ret = []
-    meta_arr = deepcopy(file_meta_array)
     logger.info("Writing file metadata")
-    if convert_to_opus:
-        meta_arr = []
-        for a in file_meta_array:
-            filename, ext = a.filename.split(".")
-            if ext in {"ogg", "mp3", "wav"}:
-                meta_arr.append(SngFileMetadata(filename + ".opus", 0, 0))
-            else:
-                meta_arr.append(a)
-    calcd_size = struct.calcsize(_with_endian(s.ULONGLONG))
-    for file_meta in meta_arr:
-        filename_len = len(file_meta.filename)
-        calcd_size += (
-            struct.calcsize(_with_endian(s.UBYTE))
-            + struct.calcsize(_with_endian(filename_len, s.CHAR))
-            + struct.calcsize(_with_endian(s.ULONGLONG)) * 2
-        )
+    entries: List[Tuple[bytes, Optional[int]]] = []
+    for file_meta in file_meta_array:
+        transcoded_name = _transcoded_name(file_meta.filename, convert_to_opus)
+        if transcoded_name is None:
+            entries.append((file_meta.filename.encode("utf-8"), file_meta.content_len))
+        else:
+            entries.append((transcoded_name.encode("utf-8"), None))
+
+    section_len = U64.size + sum(
+        U8.size + len(filename) + FILE_ENTRY.size for filename, _ in entries
+    )
+    logger.debug("Calculated file metadata section size: %d", section_len)
+    section = bytearray(U64.size + section_len)
+    if start is None:
+        start = file.tell()
+
+    pos = pack_uint_into(U64, section, 0, section_len)
+    pos = pack_uint_into(U64, section, pos, len(entries))
+
+    # file contents start after this section and the length prefix of the data section
+    fileoffset = start + len(section) + U64.size
+    logger.debug("File content section start: %d", fileoffset)
 
-    file.write(_validate_and_pack(_with_endian(s.ULONGLONG), calcd_size))
-    file.write(_validate_and_pack(_with_endian(s.ULONGLONG), len(meta_arr)))
-    logger.debug("Calculated file metadata section size: %d", calcd_size)
+    ret: List[FileOffset] = []
+    for file_meta, (filename, content_len) in zip(file_meta_array, entries):
+        pos = pack_uint_into(U8, section, pos, len(filename))
+        pos = pack_str_into(section, pos, filename)
+        ret.append(FileOffset(file_meta.filename, start + pos))
+        if content_len is None:
+            # placeholder, left zeroed until transcoding is done
+            pos += FILE_ENTRY.size
+            continue
+        pos = pack_uint_into(U64, section, pos, content_len)
+        pos = pack_uint_into(U64, section, pos, fileoffset)
+        fileoffset += content_len
 
-    fileoffset = file.tell() + calcd_size
-    logger.debug("File content section start: %d", fileoffset)
+    file.write(section)
 
-    for idx, file_meta in enumerate(meta_arr):
-        logger.debug("Writing file metadata for %s", file_meta.filename)
-        filename_len = len(file_meta.filename)
-        file.write(_validate_and_pack(_with_endian(s.UBYTE), filename_len))
-        filename_packed = _validate_and_pack(
-            _with_endian(filename_len, s.CHAR), file_meta.filename.encode("utf-8")
-        )
-        file.write(filename_packed)
-        logger.debug("%s content size: %d", file_meta.filename, file_meta.content_len)
-        ret.append(FileOffset(file_meta_array[idx].filename, file.tell()))
-        file.write(_validate_and_pack(_with_endian(s.ULONGLONG), file_meta.content_len))
-        logger.debug("%s offset: %d", file_meta.filename, fileoffset)
-        file.write(_validate_and_pack(_with_endian(s.ULONGLONG), fileoffset))
-        fileoffset += file_meta.content_len
-
-    logger.info("Wrote file metadata for %d files", len(meta_arr))
+    logger.info("Wrote file metadata for %d files", len(entries))
     return ret
 
 
-def write_metadata(file: BufferedWriter, metadata: SngMetadataInfo) -> None:
+def _file_table_len(file_meta_array: Iterable[SngFileMetadata]) -> int:
+    """
+    Size of the file table, along with the length of the data section that follows it. Internal function.
+    """
+    return 3 * U64.size + sum(
+        U8.size + len(file_meta.filename.encode("utf-8")) + FILE_ENTRY.size
+        for file_meta in file_meta_array
+    )
+
+
+def write_metadata(file: BufferedWriter, metadata: SngMetadataInfo) -> int:
     """
     Writes key-value pairs of metadata information for the SNG file.
 
     The metadata is stored as a series of length-prefixed strings (both for keys and values),
     with the total length of the metadata section prefixed at the start.
+    The whole section is packed into one buffer and written at once.
 
     Args:
         file (BufferedWriter): The file buffer to write the metadata to.
         metadata (SngMetadataInfo): A dictionary containing metadata key-value pairs.
 
     Returns:
-        None
+        int: The number of bytes written.
     """
     logger.info("Writing song metadata")
 
-    metadata_content = _validate_and_pack(_with_endian(s.ULONGLONG), len(metadata))
-    key: str
-    value: str
-    for key, val in metadata.items():
-        key_len: int = len(key)
-        key_len_packed = _validate_and_pack(_with_endian(s.UINT), key_len)
-        key: bytes = _validate_and_pack(
-            _with_endian(key_len, s.CHAR), key.encode("utf-8")
-        )
+    entries = [(key.encode("utf-8"), val.encode("utf-8")) for key, val in metadata.items()]
+    section_len = U64.size + sum(
+        U32.size + len(key) + U32.size + len(value) for key, value in entries
+    )
+    section = bytearray(U64.size + section_len)
 
-        value_len: int = len(val)
-        value_len_packed: bytes = _validate_and_pack(_with_endian(s.UINT), value_len)
-        value: bytes = _validate_and_pack(
-            _with_endian(value_len, s.CHAR), val.encode("utf-8")
-        )
-        metadata_content += key_len_packed + key + value_len_packed + value
+    pos = pack_uint_into(U64, section, 0, section_len)
+    pos = pack_uint_into(U64, section, pos, len(entries))
+    for key, value in entries:
+        pos = pack_uint_into(U32, section, pos, len(key))
+        pos = pack_str_into(section, pos, key)
+        pos = pack_uint_into(U32, section, pos, len(value))
+        pos = pack_str_into(section, pos, value)
 
-    file.write(_validate_and_pack(_with_endian(s.ULONGLONG), len(metadata_content)))
-    file.write(metadata_content)
+    file.write(section)
 
     logger.info("Wrote song metadata")
+    return len(section)
+
+
+def _write_member(
+    out: BufferedWriter,
+    filepath: str | BufferedReader,
+    file_metadata: SngFileMetadata,
+    xor_mask: bytes,
+    digests: Optional[Dict[str, str]],
+    stats: Optional[SngStats] = None,
+) -> int:
+    """
+    Masks and writes one file, recording its md5 in `digests` if passed. Internal function.
+    """
+    logger.debug("Writing %s to file", file_metadata.filename)
+    filehash = hashlib.md5() if digests is not None else None
+    bytes_written = write_and_mask(
+        read_from=filepath,
+        write_to=out,
+        xor_mask=xor_mask,
+        filesize=file_metadata.content_len,
+        digest=filehash,
+        stats=stats,
+        member=file_metadata.filename,
+    )
+    if bytes_written != file_metadata.content_len:
+        raise RuntimeError(
+            "Wrote %d bytes when expected %d bytes"
+            % (bytes_written, file_metadata.content_len)
+        )
+    if filehash is not None:
+        digests[file_metadata.filename] = filehash.hexdigest()
+    return bytes_written
 
 
 def write_file_data(
@@ -162,6 +245,10 @@ def write_file_data(
     xor_mask: bytes,
     offset_ref: List[FileOffset],
     convert_to_opus: bool,
+    digests: Optional[Dict[str, str]] = None,
+    transcode_cache: Optional[TranscodeCache] = None,
+    stats: Optional[SngStats] = None,
+    base: int = 0,
 ):
     """
     Writes the actual file data for each file included in the SNG package.
@@ -173,6 +260,12 @@ def write_file_data(
         out (BufferedWriter): The output file buffer to write the data to.
         file_meta_array (List[Tuple[str, SngFileMetadata]]): A list of tuples containing file paths and their metadata.
         xor_mask (bytes): The byte sequence used as an XOR mask for file data encryption.
+        offset_ref (List[FileOffset]): Positions in `out` of the file table entries, used to patch transcoded files.
+        convert_to_opus (bool): Whether audio files are transcoded to opus.
+        digests (Dict[str, str], optional): If passed, filled with the md5 of each source file, keyed by filename. Transcoded files are hashed by their transcoding worker.
+        transcode_cache (TranscodeCache, optional): Cache of opus transcodes to use.
+        stats (SngStats, optional): Stats to record the time and bytes of each file in.
+        base (int, optional): Position of the SNG file in `out`, which file offsets are relative to. Defaults to 0.
 
     Returns:
         None
@@ -182,59 +275,210 @@ def write_file_data(
     size = 0
     data_idx = out.tell()
 
-    out.write(_validate_and_pack(_with_endian(s.ULONGLONG), 0))
+    out.write(pack_uint(U64, 0))
     if convert_to_opus:
-        exts = {"ogg", "mp3", "wav"}
 
         def _non_audio_opus_file(meta: str):
-            return any(meta.endswith(ext) for ext in exts)
+            return _transcoded_name(meta, convert_to_opus) is not None
 
         no_convert = filter(
             lambda x: not _non_audio_opus_file(x[1].filename), file_meta_array
         )
         convert = list(filter(lambda x: _non_audio_opus_file(x.filename), offset_ref))
-        pool, futures =  parllel_transcode_opus(convert)
+        pool, futures = parllel_transcode_opus(
+            convert, transcode_cache, hash_sources=digests is not None
+        )
         for filename, file_metadata in no_convert:
-            logger.debug("Writing %s to file", file_metadata.filename)
-            size += write_and_mask(
-                read_from=filename,
-                write_to=out,
-                xor_mask=xor_mask,
-                filesize=file_metadata.content_len,
-            )
-        size += eval_audio_futures(out, pool, futures, xor_mask=xor_mask)
+            size += _write_member(out, filename, file_metadata, xor_mask, digests, stats)
+        size += eval_audio_futures(
+            out, pool, futures, xor_mask=xor_mask, digests=digests, stats=stats, base=base
+        )
     else:
         for filename, file_metadata in file_meta_array:
-            bytes_written = write_and_mask(
-                read_from=filename,
-                write_to=out,
-                xor_mask=xor_mask,
-                filesize=file_metadata.content_len,
-            )
-            if bytes_written != file_metadata.content_len:
-                raise RuntimeError(
-                    "Wrote %d bytes when expected %d bytes",
-                    bytes_written,
-                    file_metadata.content_len,
-                )
-            size += file_metadata.content_len
+            size += _write_member(out, filename, file_metadata, xor_mask, digests, stats)
     out.truncate()
     out.seek(data_idx)
-    out.write(_validate_and_pack(_with_endian(s.ULONGLONG), size))
+    out.write(pack_uint(U64, size))
+
+    logger.debug("Wrote file data")
+
+
+def _write_sng(
+    file: BufferedWriter,
+    dir_to_encode: os.PathLike,
+    *,
+    version: int,
+    xor_mask: bytes,
+    metadata: SngMetadataInfo,
+    allow_nonsng_files: bool,
+    encode_audio: bool,
+    transcode_cache: Optional[TranscodeCache] = None,
+    digests: Optional[Dict[str, str]] = None,
+    stats: Optional[SngStats] = None,
+) -> None:
+    """
+    Writes the header, metadata, file table and file data of an SNG file at the current
+    position of `file`. Offsets are relative to that position. Internal function.
+    """
+    base = file.tell()
+    timer = phase_timer(stats)
+    write_header(file, version, xor_mask)
+    timer.lap("header", HEADER.size)
+    timer.lap("metadata", write_metadata(file, metadata))
+    file_meta_array = gather_files_from_directory(
+        dir_to_encode, offset=file.tell() - base, allow_nonsng_files=allow_nonsng_files
+    )
+    timer.lap("scan")
+    start = file.tell()
+    write_refs = write_file_meta(
+        file,
+        list(map(lambda x: x[1], file_meta_array)),
+        convert_to_opus=encode_audio,
+        start=start - base,
+    )
+    timer.lap("file_table", file.tell() - start)
+    timer.done()
+    write_refs = list(
+        map(
+            lambda x: FileOffset(
+                filename=os.path.join(dir_to_encode, x.filename), offset=base + x.offset
+            ),
+            write_refs,
+        )
+    )
+    write_file_data(
+        file,
+        file_meta_array,
+        xor_mask,
+        write_refs,
+        encode_audio,
+        digests=digests,
+        transcode_cache=transcode_cache,
+        stats=stats,
+        base=base,
+    )
+
+
+def _write_tables_forward(
+    file: BufferedWriter,
+    dir_to_encode: os.PathLike,
+    *,
+    version: int,
+    xor_mask: bytes,
+    metadata: SngMetadataInfo,
+    allow_nonsng_files: bool,
+    encode_audio: bool,
+    transcode_cache: Optional[TranscodeCache] = None,
+    stats: Optional[SngStats] = None,
+) -> Tuple[List[Tuple[str | BufferedReader, SngFileMetadata]], Dict[str, BufferedReader]]:
+    """
+    Plans the layout of an SNG file and writes everything before the file contents:
+    header, metadata, file table and the length of the data section. Internal function.
+
+    File sizes come from the directory scan, and audio is transcoded to completion before
+    the file table is written, so nothing has to be patched afterwards.
+
+    Returns:
+        Tuple[List[Tuple[str | BufferedReader, SngFileMetadata]], Dict[str, BufferedReader]]:
+        The source of each member in table order, and the transcoded outputs, which the caller closes.
+    """
+    timer = phase_timer(stats)
+    write_header(file, version, xor_mask)
+    timer.lap("header", HEADER.size)
+    metadata_len = write_metadata(file, metadata)
+    timer.lap("metadata", metadata_len)
+    position = HEADER.size + metadata_len
+    file_meta_array = gather_files_from_directory(
+        dir_to_encode, offset=position, allow_nonsng_files=allow_nonsng_files
+    )
+    timer.lap("scan")
+
+    transcoded = {}
+    if encode_audio:
+        convert = [
+            FileOffset(filepath, 0)
+            for filepath, file_meta in file_meta_array
+            if _transcoded_name(file_meta.filename, encode_audio) is not None
+        ]
+        if convert:
+            transcoded = collect_audio_futures(
+                *parllel_transcode_opus(convert, transcode_cache), stats=stats
+            )
+            timer.skip()
+
+    try:
+        members: List[Tuple[str | BufferedReader, SngFileMetadata]] = []
+        for filepath, file_meta in file_meta_array:
+            tmpfile = transcoded.get(filepath)
+            if tmpfile is None:
+                members.append((filepath, file_meta))
+                continue
+            opus_meta = SngFileMetadata(
+                _transcoded_name(file_meta.filename, encode_audio),
+                tmpfile.size,
+                0,
+            )
+            members.append((tmpfile, opus_meta))
 
+        write_file_meta(
+            file, [file_meta for _, file_meta in members], False, start=position
+        )
+        file.write(pack_uint(U64, sum(file_meta.content_len for _, file_meta in members)))
+        timer.lap("file_table", _file_table_len(file_meta for _, file_meta in members))
+        timer.done()
+    except BaseException:
+        for tmpfile in transcoded.values():
+            tmpfile.close()
+        raise
+    return members, transcoded
+
+
+def _write_sng_forward(
+    file: BufferedWriter,
+    dir_to_encode: os.PathLike,
+    *,
+    digests: Optional[Dict[str, str]] = None,
+    **write_args,
+) -> None:
+    """
+    Writes an SNG file strictly forward, for outputs that cannot seek such as pipes. Internal function.
+
+    The layout is planned by `_write_tables_forward` before any file contents are written.
+    """
+    members, transcoded = _write_tables_forward(file, dir_to_encode, **write_args)
+    xor_mask = write_args["xor_mask"]
+    stats = write_args.get("stats")
+    try:
+        for source, file_meta in members:
+            is_path = isinstance(source, str)
+            _write_member(
+                file, source, file_meta, xor_mask, digests if is_path else None, stats
+            )
+    finally:
+        for tmpfile in transcoded.values():
+            tmpfile.close()
     logger.debug("Wrote file data")
 
 
+def _raise_if_exists(output_filename: os.PathLike, overwrite: bool) -> None | NoReturn:
+    if os.path.exists(output_filename) and not overwrite:
+        err = FileExistsError("Sng file exists: %s" % output_filename)
+        err.filename = output_filename
+        raise err
+
+
 def encode_sng(
     dir_to_encode: os.PathLike,
     *,
-    output_filename: Optional[os.PathLike] = None,
+    output_filename: Optional[os.PathLike | BufferedWriter] = None,
     allow_nonsng_files: bool = False,
     overwrite: bool = False,
     version: int = 1,
     xor_mask: Optional[bytes] = None,
     metadata: Optional[SngMetadataInfo] = None,
     encode_audio: bool = True,
+    transcode_cache: Optional[TranscodeCache] = None,
+    stats: Optional[SngStats] = None,
 ) -> None:
     """
     Encodes a directory of files into a single SNG package file.
@@ -242,58 +486,232 @@ def encode_sng(
     This process involves reading metadata, writing a header, encoding file metadata,
     and writing the actual file data, optionally applying an XOR mask for encryption.
 
+    When no output filename is given, the files are hashed while they are written to a
+    temporary file in the working directory, which is then renamed to the md5 derived name.
+    An output file left partially written by a failed encode is removed.
+
     Args:
         dir_to_encode (os.PathLike): The directory containing files to be encoded into the SNG package.
-        output_filename (os.PathLike, optional): The output path of the SNG file. Defaults to the md5 sum of the containing files of converted dir.
+        output_filename (os.PathLike | BufferedWriter, optional): The output path of the SNG file, or a writable binary stream. Streams that cannot seek, such as pipes, are written strictly forward. Defaults to the md5 sum of the containing files of converted dir.
         allow_nonsng_files (bool, optional): Allow encoding of files not allowed by the sng standard. Defaults to False.
         overwrite (bool, optional): If True, existing files or directories will be overwritten. Defaults to False.
         version (int, optional): The version of the SNG format to use. Defaults to 1.
         xor_mask (bytes, optional): An optional XOR mask for encryption. If not provided, a random one is generated.
         metadata (SngMetadataInfo, optional): Metadata for the SNG package. If not provided, it's read from a 'song.ini' file in the directory.
+        encode_audio (bool, optional): Transcode audio files to opus. Defaults to True.
+        transcode_cache (TranscodeCache, optional): On-disk cache of opus transcodes, looked up before transcoding, such as `TRANSCODE_CACHE`. Defaults to None, always transcoding.
+        stats (SngStats, optional): Filled with the time and bytes spent in each phase, and per file.
 
     Returns:
         None
     """
-    if not os.path.exists(dir_to_encode):
-        raise FileNotFoundError("%s was not found." % dir_to_encode)
-    if metadata is None:
-        metadata = read_file_meta(dir_to_encode)
+    write_args = _encode_args(
+        dir_to_encode,
+        version=version,
+        xor_mask=xor_mask,
+        metadata=metadata,
+        allow_nonsng_files=allow_nonsng_files,
+        encode_audio=encode_audio,
+        transcode_cache=transcode_cache,
+        stats=stats,
+    )
+    if output_filename is None:
+        _encode_to_hashed_name(dir_to_encode, overwrite=overwrite, **write_args)
+        return
+    if not isinstance(output_filename, (str, os.PathLike)):
+        if output_filename.seekable():
+            _write_sng(output_filename, dir_to_encode, **write_args)
+        else:
+            _write_sng_forward(output_filename, dir_to_encode, **write_args)
+        return
+    output_filename = _output_path(output_filename, overwrite)
+    try:
+        with open(output_filename, "wb") as file:
+            _write_sng(file, dir_to_encode, **write_args)
+    except BaseException:
+        # a partial sng file is not left behind
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+        raise
+
+
+def _member_source(source: MemberSource) -> Tuple[BufferedReader, int]:
+    """
+    Returns a reader positioned at the start of a member and the size of the member.
+    Streams that can't seek are read to the end to learn their size. Internal function.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source), memoryview(source).nbytes
+    if source.seekable():
+        start = source.tell()
+        size = source.seek(0, os.SEEK_END) - start
+        source.seek(start)
+        return source, size
+    data = source.read()
+    return io.BytesIO(data), len(data)
+
+
+def encode_sng_from_members(
+    metadata: SngMetadataInfo,
+    members: Dict[str, MemberSource],
+    out: Optional[BufferedWriter] = None,
+    *,
+    allow_nonsng_files: bool = False,
+    version: int = 1,
+    xor_mask: Optional[bytes] = None,
+    stats: Optional[SngStats] = None,
+) -> Optional[bytes]:
+    """
+    Encodes an SNG file from files held in memory, without a directory to encode.
+
+    The file is written strictly forward, so `out` can be any writable binary stream,
+    including ones that can't seek. Members are stored as given, audio is not transcoded.
+
+    Args:
+        metadata (SngMetadataInfo): Metadata of the SNG file, the contents of the song.ini of a directory. Values are converted to strings.
+        members (Dict[str, bytes | bytearray | memoryview | BufferedReader]): Contents of each file keyed by filename, as a buffer or a readable binary stream read from its current position.
+        out (BufferedWriter, optional): Where to write the SNG file. Defaults to returning it as bytes.
+        allow_nonsng_files (bool, optional): Allow files not allowed by the sng standard. Defaults to False.
+        version (int, optional): The version of the SNG format to use. Defaults to 1.
+        xor_mask (bytes, optional): An optional XOR mask for encryption. If not provided, a random one is generated.
+        stats (SngStats, optional): Filled with the time and bytes spent in each phase, and per file.
+
+    Returns:
+        Optional[bytes]: The SNG file when `out` is not passed, None otherwise.
+
+    Raises:
+        ValueError: When a filename is illegal, reserved or not allowed by the sng standard, or the xor mask is not 16 bytes long
+    """
+    for filename in members:
+        _check_name(filename, allow_nonsng_files)
+    xor_mask = _xor_mask_or_random(xor_mask)
+
+    buf = io.BytesIO() if out is None else out
+    timer = phase_timer(stats)
+    sources = [(filename, *_member_source(source)) for filename, source in members.items()]
+    timer.lap("scan")
+    timer.done()
+    write_members_forward(
+        buf, metadata, sources, version=version, xor_mask=xor_mask, stats=stats
+    )
+
+    if out is None:
+        return buf.getvalue()
+    return None
+
+
+def write_members_forward(
+    out: BufferedWriter,
+    metadata: SngMetadataInfo,
+    sources: List[Tuple[str, BufferedReader, int]],
+    *,
+    version: int,
+    xor_mask: bytes,
+    stats: Optional[SngStats] = None,
+) -> None:
+    """
+    Writes an SNG file strictly forward from readers of known size. The names are not checked.
+
+    Args:
+        out (BufferedWriter): Where to write the SNG file.
+        metadata (SngMetadataInfo): Metadata of the SNG file. Values are converted to strings.
+        sources (List[Tuple[str, BufferedReader, int]]): Filename, reader positioned at the start of the contents and size of each member.
+        version (int): The version of the SNG format to use.
+        xor_mask (bytes): The 16 byte XOR mask.
+        stats (SngStats, optional): Filled with the time and bytes spent in each phase, and per file.
+
+    Returns:
+        None
+    """
+    metadata = {str(key): str(value) for key, value in metadata.items()}
+    timer = phase_timer(stats)
+    write_header(out, version, xor_mask)
+    timer.lap("header", HEADER.size)
+    position = HEADER.size + write_metadata(out, metadata)
+    timer.lap("metadata", position - HEADER.size)
+
+    file_meta_array = [SngFileMetadata(filename, size, 0) for filename, _, size in sources]
+    write_file_meta(out, file_meta_array, False, start=position)
+    out.write(pack_uint(U64, sum(size for _, _, size in sources)))
+    timer.lap("file_table", _file_table_len(file_meta_array))
+    timer.done()
+    for (_, source, _), file_meta in zip(sources, file_meta_array):
+        _write_member(out, source, file_meta, xor_mask, None, stats)
+    logger.info("Wrote sng file of %d files", len(sources))
+
+
+def _xor_mask_or_random(xor_mask: Optional[bytes]) -> bytes | NoReturn:
+    """
+    Checks the length of an xor mask, generating a random one if None. Internal function.
+    """
     if xor_mask is None:
         xor_mask = os.urandom(16)
     if (x := len(xor_mask)) != 16:
         raise ValueError(
             "xor mask should be of length 16, found xor_mask of length %d" % x
         )
-    if output_filename is None:
-        output_filename = create_sng_filename(dir_to_encode) + ".sng"
+    return xor_mask
+
+
+def _encode_args(
+    dir_to_encode: os.PathLike,
+    *,
+    xor_mask: Optional[bytes],
+    metadata: Optional[SngMetadataInfo],
+    **write_args,
+) -> dict:
+    """
+    Validates the arguments of an encode and fills in the defaults of the metadata
+    and xor mask. Internal function.
+
+    Returns:
+        dict: Keyword arguments for `_write_sng` and `_write_sng_forward`.
+    """
+    if not os.path.exists(dir_to_encode):
+        raise FileNotFoundError("%s was not found." % dir_to_encode)
+    if metadata is None:
+        metadata = read_file_meta(dir_to_encode)
+    xor_mask = _xor_mask_or_random(xor_mask)
+    return dict(xor_mask=xor_mask, metadata=metadata, **write_args)
+
+
+def _output_path(output_filename: os.PathLike | str, overwrite: bool) -> Path | NoReturn:
+    """
+    Adds the .sng extension to an output path if missing, and checks it may be written. Internal function.
+    """
     if isinstance(output_filename, str):
         output_filename = Path(output_filename)
     if not output_filename.name.endswith(".sng"):
-        output_filename += ".sng"
-    if os.path.exists(output_filename) and not overwrite:
-        err = FileExistsError("Sng file exists: %s" % output_filename)
-        err.filename = output_filename
-        raise err
-    with open(output_filename, "wb") as file:
-        write_header(file, version, xor_mask)
-        write_metadata(file, metadata)
-        file_meta_array = gather_files_from_directory(
-            dir_to_encode, offset=file.tell(), allow_nonsng_files=allow_nonsng_files
-        )
-        write_refs = write_file_meta(
-            file,
-            list(map(lambda x: x[1], file_meta_array)),
-            convert_to_opus=encode_audio,
-        )
-        write_refs = list(
-            map(
-                lambda x: FileOffset(
-                    filename=os.path.join(dir_to_encode, x.filename), offset=x.offset
-                ),
-                write_refs,
-            )
-        )
-        write_file_data(file, file_meta_array, xor_mask, write_refs, encode_audio)
+        output_filename = output_filename.with_name(output_filename.name + ".sng")
+    _raise_if_exists(output_filename, overwrite)
+    return output_filename
+
+
+def _encode_to_hashed_name(
+    dir_to_encode: os.PathLike, *, overwrite: bool, **write_args
+) -> Path:
+    """
+    Encodes to a temporary file in the working directory while hashing the files, then
+    atomically renames it to the name `create_sng_filename` would give. Internal function.
+
+    Returns:
+        Path: The path of the written SNG file.
+    """
+    digests: Dict[str, str] = {}
+    # opened with "x" rather than through tempfile, so it gets the usual umask permissions
+    tmp_path = os.path.join(os.curdir, ".%s.sng.tmp" % os.urandom(8).hex())
+    try:
+        with open(tmp_path, "xb") as file:
+            _write_sng(file, dir_to_encode, digests=digests, **write_args)
+        output_filename = Path(create_sng_filename(dir_to_encode, digests) + ".sng")
+        _raise_if_exists(output_filename, overwrite)
+        os.replace(tmp_path, output_filename)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logger.info("Wrote sng file to %s", output_filename)
+    return output_filename
 
 
 def _get_file_md5(path: os.PathLike) -> str:
@@ -310,12 +728,29 @@ def _get_file_md5(path: os.PathLike) -> str:
     return filehash.hexdigest()
 
 
-def create_sng_filename(sng_dir: os.PathLike) -> str:
+def create_sng_filename(
+    sng_dir: os.PathLike, file_md5s: Optional[Dict[str, str]] = None
+) -> str:
+    """
+    Creates the default name of an SNG file from the md5 sums of the files in `sng_dir`.
+
+    Args:
+        sng_dir (os.PathLike): The directory being encoded.
+        file_md5s (Dict[str, str], optional): Already computed md5 sums keyed by filename. Other files are read and hashed.
+
+    Returns:
+        str: The md5 derived name, without extension.
+    """
+    if file_md5s is None:
+        file_md5s = {}
     filehash = hashlib.md5()
     for file_name in sorted(os.listdir(sng_dir)):
         path = os.path.join(sng_dir, file_name)
         filehash.update(file_name.encode("utf-8"))
-        filehash.update(_get_file_md5(path).encode())
+        file_md5 = file_md5s.get(file_name)
+        if file_md5 is None:
+            file_md5 = _get_file_md5(path)
+        filehash.update(file_md5.encode())
     return filehash.hexdigest()
 
 
@@ -385,14 +820,28 @@ def read_file_meta(filedir: os.PathLike) -> SngMetadataInfo:
     Returns:
         SngMetadataInfo: A dictionary containing the metadata key-value pairs.
     """
-    cfg = ConfigParser()
     ini_path = os.path.join(filedir, "song.ini")
     if not os.path.exists(ini_path):
         raise FileNotFoundError(
             "song.ini not found in provided directory '%s'." % filedir
         )
     with open(ini_path) as f:
-        cfg.read_file(f)
+        return parse_song_ini(f)
+
+
+def parse_song_ini(lines: Iterable[str], source: str = "<song.ini>") -> SngMetadataInfo:
+    """
+    Parses the metadata of a song.ini, expected under a '[Song]' section.
+
+    Args:
+        lines (Iterable[str]): Lines of the song.ini, such as an open text file.
+        source (str, optional): Name of the song.ini used in parsing errors.
+
+    Returns:
+        SngMetadataInfo: A dictionary containing the metadata key-value pairs.
+    """
+    cfg = ConfigParser()
+    cfg.read_file(lines, source)
     if "song" in cfg:
         return dict(cfg["song"])
     return dict(cfg["Song"])
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import sqlite3
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .decode import read_sng_tables
+
+__all__ = ["index_library", "open_index", "IndexSummary"]
+
+logger = logging.getLogger(__package__)
+
+# Schema of the index database. `archives` holds one row per sng file, keyed by its
+# absolute path, with the stat values used to detect changes. `members` holds the file table.
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    version INTEGER,
+    metadata TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS members (
+    path TEXT NOT NULL REFERENCES archives(path) ON DELETE CASCADE,
+    filename TEXT NOT NULL,
+    content_len INTEGER NOT NULL,
+    content_idx INTEGER NOT NULL,
+    PRIMARY KEY (path, filename)
+);
+"""
+
+# Number of parsed files written to the database per transaction
+_COMMIT_EVERY = 500
+
+
+class StatKey(NamedTuple):
+    inode: int
+    size: int
+    mtime_ns: int
+
+
+class IndexSummary(NamedTuple):
+    """
+    Counts of what a call to `index_library` did.
+    """
+
+    scanned: int
+    updated: int
+    unchanged: int
+    removed: int
+    failed: int
+
+
+class _IndexedFile(NamedTuple):
+    path: str
+    stat_key: StatKey
+    version: Optional[int]
+    metadata: Optional[str]
+    members: List[Tuple[str, int, int]]
+    error: Optional[str]
+
+
+def _stat_key(st: os.stat_result) -> StatKey:
+    return StatKey(st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _walk_sng_files(root: str) -> Iterator[Tuple[str, StatKey]]:
+    """
+    Yields the absolute path and stat key of every .sng file under `root`. Internal use.
+    """
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.endswith(".sng"):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                yield path, _stat_key(os.stat(path))
+            except OSError as err:
+                logger.warning("Unable to stat %s: %s", path, err)
+
+
+def _index_file(job: Tuple[str, StatKey]) -> _IndexedFile:
+    """
+    Parses the header, metadata and file table of one sng file. Runs in a worker process.
+    Errors are returned rather than raised so one bad file does not stop the scan.
+    """
+    path, stat_key = job
+    try:
+        with open(path, "rb") as f:
+            header, metadata, file_meta_array = read_sng_tables(f)
+    except Exception as err:
+        return _IndexedFile(path, stat_key, None, None, [], "%s: %s" % (type(err).__name__, err))
+    return _IndexedFile(
+        path,
+        stat_key,
+        header.version,
+        json.dumps(metadata),
+        [
+            (file_meta.filename, file_meta.content_len, file_meta.content_idx)
+            for file_meta in file_meta_array
+        ],
+        None,
+    )
+
+
+def open_index(db_path: os.PathLike | str) -> sqlite3.Connection:
+    """
+    Opens the index database, creating its tables if needed.
+
+    Args:
+        db_path (os.PathLike | str): Path to the SQLite database.
+
+    Returns:
+        sqlite3.Connection: The open database.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(INDEX_SCHEMA)
+    return conn
+
+
+def _store(conn: sqlite3.Connection, indexed: _IndexedFile) -> None:
+    conn.execute("DELETE FROM archives WHERE path = ?", (indexed.path,))
+    conn.execute(
+        "INSERT INTO archives (path, inode, size, mtime_ns, version, metadata, error) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (indexed.path, *indexed.stat_key, indexed.version, indexed.metadata, indexed.error),
+    )
+    conn.executemany(
+        "INSERT INTO members (path, filename, content_len, content_idx) VALUES (?, ?, ?, ?)",
+        ((indexed.path, *member) for member in indexed.members),
+    )
+
+
+def index_library(
+    root: os.PathLike | str,
+    db_path: os.PathLike | str,
+    *,
+    workers: Optional[int] = None,
+) -> IndexSummary:
+    """
+    Indexes every .sng file under `root` into a SQLite database.
+
+    Only the header, metadata and file table of each file are parsed. Files whose inode,
+    size and modification time match the index are skipped, and files no longer present
+    under `root` are removed from it. Parsing runs on a process pool.
+
+    Args:
+        root (os.PathLike | str): Directory to scan recursively.
+        db_path (os.PathLike | str): Path to the SQLite database, created if missing.
+        workers (int, optional): Number of worker processes. Defaults to the cpu count.
+
+    Returns:
+        IndexSummary: Counts of scanned, updated, unchanged, removed and failed files.
+    """
+    root = os.path.abspath(root)
+    if not os.path.isdir(root):
+        raise FileNotFoundError("No directory located at %s" % root)
+    prefix = os.path.join(root, "")
+
+    conn = open_index(db_path)
+    try:
+        known: Dict[str, StatKey] = {
+            path: StatKey(inode, size, mtime_ns)
+            for path, inode, size, mtime_ns in conn.execute(
+                "SELECT path, inode, size, mtime_ns FROM archives"
+            )
+            if path.startswith(prefix)
+        }
+
+        scanned = 0
+        jobs: List[Tuple[str, StatKey]] = []
+        for path, stat_key in _walk_sng_files(root):
+            scanned += 1
+            if known.pop(path, None) != stat_key:
+                jobs.append((path, stat_key))
+        logger.info("Found %d sng files, %d to index", scanned, len(jobs))
+
+        with conn:
+            conn.executemany("DELETE FROM archives WHERE path = ?", ((path,) for path in known))
+        logger.info("Removed %d sng files no longer present", len(known))
+
+        failed = 0
+        if jobs:
+            workers = min(workers or os.cpu_count() or 1, len(jobs))
+            logger.debug("Indexing with %d processes", workers)
+            with ProcessPoolExecutor(workers) as pool:
+                results = pool.map(
+                    _index_file, jobs, chunksize=max(1, min(64, len(jobs) // (workers * 4)))
+                )
+                for done, indexed in enumerate(results, 1):
+                    if indexed.error is not None:
+                        failed += 1
+                        logger.warning("Failed to index %s: %s", indexed.path, indexed.error)
+                    _store(conn, indexed)
+                    if done % _COMMIT_EVERY == 0:
+                        conn.commit()
+                        logger.info("Indexed %d/%d sng files", done, len(jobs))
+            conn.commit()
+    finally:
+        conn.close()
+
+    return IndexSummary(
+        scanned=scanned,
+        updated=len(jobs),
+        unchanged=scanned - len(jobs),
+        removed=len(known),
+        failed=failed,
+    )
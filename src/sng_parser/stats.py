@@ -0,0 +1,209 @@
+import threading
+import time
+
+from typing import Callable, Dict, NamedTuple, Optional
+
+__all__ = ["SngStats", "PhaseStats", "PhaseTimer", "phase_timer"]
+
+
+class PhaseStats(NamedTuple):
+    """
+    Wall time and bytes spent in one phase, over `count` measurements.
+    """
+
+    seconds: float
+    bytes: int
+    count: int
+
+
+class SngStats:
+    """
+    Collects the wall time and bytes `decode_sng` and `encode_sng` spend in each phase,
+    in total and per member of the archive.
+
+    Archive level phases are `header`, `metadata`, `song_dir`, `scan` and `file_table`.
+    Member level phases are `read`, `mask` and `write` for every copied chunk, `hash` when
+    hashing for the output name, and `transcode` or `transcode_cache` for audio converted to opus.
+    Transcode times are the time the worker took, which overlaps with the other phases.
+
+    Measurements are recorded from several threads at once when extracting with workers.
+    Instances can be pickled, without their callback, and combined with `merge`.
+    """
+
+    def __init__(
+        self, callback: Optional[Callable[[str, Optional[str], float, int], None]] = None
+    ) -> None:
+        """
+        Args:
+            callback (Callable[[str, Optional[str], float, int], None], optional): Called with the phase, member (None for archive level phases), seconds and bytes of every measurement as it is recorded.
+        """
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._phases: Dict[str, list] = {}
+        self._members: Dict[str, Dict[str, list]] = {}
+
+    def record(
+        self, phase: str, seconds: float, nbytes: int = 0, member: Optional[str] = None
+    ) -> None:
+        """
+        Adds a measurement of a phase, to the member if given.
+
+        Args:
+            phase (str): Name of the phase.
+            seconds (float): Wall time spent.
+            nbytes (int, optional): Bytes processed. Defaults to 0.
+            member (str, optional): Filename of the archive member the measurement belongs to.
+        """
+        with self._lock:
+            self._add(self._phases, phase, seconds, nbytes, 1)
+            if member is not None:
+                self._add(self._members.setdefault(member, {}), phase, seconds, nbytes, 1)
+        if self.callback is not None:
+            self.callback(phase, member, seconds, nbytes)
+
+    @staticmethod
+    def _add(totals: Dict[str, list], phase: str, seconds: float, nbytes: int, count: int) -> None:
+        total = totals.get(phase)
+        if total is None:
+            totals[phase] = [seconds, nbytes, count]
+            return
+        total[0] += seconds
+        total[1] += nbytes
+        total[2] += count
+
+    @property
+    def phases(self) -> Dict[str, PhaseStats]:
+        """
+        Returns:
+            Dict[str, PhaseStats]: Totals of each phase.
+        """
+        with self._lock:
+            return {phase: PhaseStats(*total) for phase, total in self._phases.items()}
+
+    @property
+    def members(self) -> Dict[str, Dict[str, PhaseStats]]:
+        """
+        Returns:
+            Dict[str, Dict[str, PhaseStats]]: Totals of each phase, per member filename.
+        """
+        with self._lock:
+            return {
+                member: {phase: PhaseStats(*total) for phase, total in phases.items()}
+                for member, phases in self._members.items()
+            }
+
+    def merge(self, other: "SngStats") -> None:
+        """
+        Adds the measurements of `other`, such as the stats of another archive of a batch.
+        Members with the same filename are combined.
+
+        Args:
+            other (SngStats): The stats to add.
+        """
+        phases, members = other.phases, other.members
+        with self._lock:
+            for phase, total in phases.items():
+                self._add(self._phases, phase, *total)
+            for member, member_phases in members.items():
+                totals = self._members.setdefault(member, {})
+                for phase, total in member_phases.items():
+                    self._add(totals, phase, *total)
+
+    def as_dict(self) -> dict:
+        """
+        Returns:
+            dict: The phase and member totals, as JSON serializable dicts.
+        """
+        return {
+            "phases": {phase: total._asdict() for phase, total in self.phases.items()},
+            "members": {
+                member: {phase: total._asdict() for phase, total in phases.items()}
+                for member, phases in self.members.items()
+            },
+        }
+
+    def __getstate__(self) -> dict:
+        with self._lock:
+            return {"phases": self._phases, "members": self._members}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__()
+        self._phases = state["phases"]
+        self._members = state["members"]
+
+
+class PhaseTimer:
+    """
+    Times consecutive phases of an archive or member, each lap measuring the time since the
+    previous one. Laps are summed locally and recorded in the stats once `done` is called,
+    so timing every chunk of a copy takes the lock only once.
+    """
+
+    __slots__ = ("_stats", "_member", "_last", "_laps")
+
+    def __init__(self, stats: SngStats, member: Optional[str] = None) -> None:
+        self._stats = stats
+        self._member = member
+        self._laps: Dict[str, list] = {}
+        self._last = time.perf_counter()
+
+    def lap(self, phase: str, nbytes: int = 0) -> None:
+        """
+        Ends a phase started at the previous lap, or at the creation of the timer.
+
+        Args:
+            phase (str): Name of the phase that just ended.
+            nbytes (int, optional): Bytes it processed. Defaults to 0.
+        """
+        now = time.perf_counter()
+        lap = self._laps.get(phase)
+        if lap is None:
+            self._laps[phase] = [now - self._last, nbytes]
+        else:
+            lap[0] += now - self._last
+            lap[1] += nbytes
+        self._last = now
+
+    def skip(self) -> None:
+        """
+        Leaves the time since the previous lap out of every phase.
+        """
+        self._last = time.perf_counter()
+
+    def done(self) -> None:
+        """
+        Records the laps in the stats.
+        """
+        for phase, (seconds, nbytes) in self._laps.items():
+            self._stats.record(phase, seconds, nbytes, self._member)
+        self._laps.clear()
+
+
+class _NullTimer:
+    """
+    Timer used when no stats are collected, every method does nothing.
+    """
+
+    __slots__ = ()
+
+    def lap(self, phase: str, nbytes: int = 0) -> None:
+        pass
+
+    def skip(self) -> None:
+        pass
+
+    def done(self) -> None:
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def phase_timer(stats: Optional[SngStats], member: Optional[str] = None) -> PhaseTimer:
+    """
+    Returns:
+        PhaseTimer: A timer recording in `stats`, or one doing nothing if `stats` is None.
+    """
+    if stats is None:
+        return _NULL_TIMER
+    return PhaseTimer(stats, member)
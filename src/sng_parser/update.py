@@ -0,0 +1,277 @@
+import io
+import logging
+import os
+import shutil
+
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .common import (
+    U64,
+    SngFileMetadata,
+    SngMetadataInfo,
+    pack_uint,
+    write_and_mask,
+)
+from .decode import read_file_data_len, read_sng_tables
+from .encode import _check_name, write_file_meta, write_header, write_metadata
+
+__all__ = ["update_sng"]
+
+logger = logging.getLogger(__package__)
+
+# Bytes copied per call when falling back from os.copy_file_range
+_COPY_CHUNK_SIZE = 1 << 20
+
+MemberSource = os.PathLike | str | bytes | bytearray | memoryview
+
+
+class _Member(NamedTuple):
+    filename: str
+    content_len: int
+    # offset of the member in the existing file, None for new contents
+    old_idx: Optional[int]
+    source: Optional[MemberSource]
+
+
+def _source_size(source: MemberSource) -> int:
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    return memoryview(source).nbytes
+
+
+def _plan_members(
+    file_meta_array: List[SngFileMetadata],
+    replace: Dict[str, MemberSource],
+    add: Dict[str, MemberSource],
+    remove: Iterable[str],
+    allow_nonsng_files: bool,
+) -> List[_Member]:
+    """
+    Orders the members of the updated file: existing members in the order of their data,
+    then the new contents. A member replaced with contents of the same size keeps its slot,
+    so the tables don't change and the file can be updated in place. Internal function.
+    """
+    existing = {file_meta.filename for file_meta in file_meta_array}
+    remove = set(remove)
+    for filename in (*replace, *remove):
+        if filename not in existing:
+            raise KeyError("No file named %s in the sng file" % filename)
+    for filename in add:
+        if filename in existing:
+            raise ValueError("%s is already in the sng file, replace it instead" % filename)
+        _check_name(filename, allow_nonsng_files)
+    if remove.intersection(replace):
+        raise ValueError(
+            "Files both replaced and removed: %s" % ", ".join(sorted(remove.intersection(replace)))
+        )
+
+    sizes = {filename: _source_size(source) for filename, source in (*replace.items(), *add.items())}
+    members = []
+    moved = []
+    for file_meta in sorted(file_meta_array, key=lambda x: x.content_idx):
+        filename = file_meta.filename
+        if filename in remove:
+            continue
+        if filename not in replace:
+            members.append(_Member(filename, file_meta.content_len, file_meta.content_idx, None))
+        elif sizes[filename] == file_meta.content_len:
+            members.append(_Member(filename, file_meta.content_len, None, replace[filename]))
+        else:
+            moved.append(filename)
+    for filename in moved:
+        members.append(_Member(filename, sizes[filename], None, replace[filename]))
+    for filename, source in add.items():
+        members.append(_Member(filename, sizes[filename], None, source))
+    return members
+
+
+def _copy_range(src_fd: int, dst_fd: int, count: int, src_offset: int, dst_offset: int) -> None:
+    """
+    Copies raw bytes between two files, in the kernel when `os.copy_file_range` is supported.
+    Internal function.
+    """
+    copy_file_range = getattr(os, "copy_file_range", None)
+    while count and copy_file_range is not None:
+        try:
+            copied = copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+        except OSError as err:
+            # e.g. across file systems on older kernels, or unsupported by the file system
+            logger.debug("copy_file_range failed (%s), copying through userspace", err)
+            break
+        if not copied:
+            raise RuntimeError("Unexpected end of file at %d" % src_offset)
+        count -= copied
+        src_offset += copied
+        dst_offset += copied
+
+    while count:
+        data = os.pread(src_fd, min(count, _COPY_CHUNK_SIZE), src_offset)
+        if not data:
+            raise RuntimeError("Unexpected end of file at %d" % src_offset)
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(dst_fd, view, dst_offset)
+            view = view[written:]
+            dst_offset += written
+        count -= len(data)
+        src_offset += len(data)
+
+
+def _write_new_members(
+    file: io.BufferedRandom, members: List[Tuple[int, _Member]], xor_mask: bytes
+) -> None:
+    """
+    Masks and writes new contents at their offsets. Internal function.
+    """
+    for content_idx, member in members:
+        logger.debug("Writing %s at %d", member.filename, content_idx)
+        source = member.source
+        if not isinstance(source, (str, os.PathLike)):
+            source = io.BytesIO(source)
+        file.seek(content_idx)
+        written = write_and_mask(
+            read_from=source,
+            write_to=file,
+            xor_mask=xor_mask,
+            filesize=member.content_len,
+        )
+        if written != member.content_len:
+            raise RuntimeError(
+                "Wrote %d bytes when expected %d bytes" % (written, member.content_len)
+            )
+
+
+def update_sng(
+    sng_file: os.PathLike | str,
+    *,
+    replace: Optional[Dict[str, MemberSource]] = None,
+    add: Optional[Dict[str, MemberSource]] = None,
+    remove: Iterable[str] = (),
+    metadata: Optional[SngMetadataInfo] = None,
+    allow_nonsng_files: bool = False,
+) -> List[SngFileMetadata]:
+    """
+    Replaces, adds or removes files of an SNG file without decoding and encoding it again.
+
+    Members are masked relative to their own start, so untouched members are moved as raw
+    bytes. The file is rebuilt next to the original, copying untouched members with
+    `os.copy_file_range`, and renamed over it with the permissions of the original, so a
+    failed update leaves the original as it was. Only the new contents are masked and written.
+
+    When the tables and size of the file don't change, such as replacing a file with contents
+    of the same size, the new contents are written in place instead. This is not atomic:
+    a failure partway leaves the replaced files partially written, though the tables stay valid.
+
+    New contents are stored as given, audio is not transcoded.
+
+    Args:
+        sng_file (os.PathLike | str): The SNG file to update.
+        replace (Dict[str, os.PathLike | str | bytes], optional): New contents of existing files, as a path or bytes, keyed by filename.
+        add (Dict[str, os.PathLike | str | bytes], optional): Files to add, as a path or bytes, keyed by filename.
+        remove (Iterable[str], optional): Names of files to remove.
+        metadata (SngMetadataInfo, optional): New metadata. Defaults to the current metadata.
+        allow_nonsng_files (bool, optional): Allow adding files not allowed by the sng standard. Defaults to False.
+
+    Returns:
+        List[SngFileMetadata]: The file table of the updated SNG file.
+
+    Raises:
+        KeyError: When a file to replace or remove is not in the SNG file
+        ValueError: When a file to add is already in the SNG file or has a disallowed name
+    """
+    replace = replace or {}
+    add = add or {}
+    sng_file = os.fspath(sng_file)
+    with open(sng_file, "r+b") as file:
+        header, old_metadata, file_meta_array = read_sng_tables(file)
+        old_data_len = read_file_data_len(file_meta_array, file)
+        old_data_start = file.tell()
+        old_data_end = old_data_start + old_data_len
+        if metadata is None:
+            metadata = old_metadata
+
+        members = _plan_members(file_meta_array, replace, add, remove, allow_nonsng_files)
+
+        tables = io.BytesIO()
+        write_header(tables, header.version, header.xor_mask)
+        write_metadata(tables, metadata)
+        write_file_meta(
+            tables,
+            [SngFileMetadata(x.filename, x.content_len, 0) for x in members],
+            False,
+        )
+        tables.write(pack_uint(U64, sum(member.content_len for member in members)))
+        data_start = tables.tell()
+
+        placed: List[Tuple[int, _Member]] = []
+        content_idx = data_start
+        for member in members:
+            placed.append((content_idx, member))
+            content_idx += member.content_len
+        data_end = content_idx
+        new_members = [(idx, member) for idx, member in placed if member.old_idx is None]
+
+        tmp_path = None
+        if data_end == old_data_end and _same_tables(file, tables):
+            logger.info("Tables and size are unchanged, updating %s in place", sng_file)
+            # every member keeps its offset and length, new contents only overwrite the old ones
+            _write_new_members(file, new_members, header.xor_mask)
+        else:
+            logger.info("Rebuilding %s", sng_file)
+            logger.debug("Data section moved from %d to %d", old_data_start, data_start)
+            tmp_path = _rebuild(file, sng_file, tables, placed, new_members, header.xor_mask)
+
+    if tmp_path is not None:
+        try:
+            shutil.copymode(sng_file, tmp_path)
+            os.replace(tmp_path, sng_file)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    logger.info("Updated %s", sng_file)
+    return [
+        SngFileMetadata(member.filename, member.content_len, idx) for idx, member in placed
+    ]
+
+
+def _same_tables(file: io.BufferedRandom, tables: io.BytesIO) -> bool:
+    """
+    Checks whether the file starts with the given tables. Internal function.
+    """
+    file.seek(0)
+    return file.read(tables.tell()) == tables.getbuffer()
+
+
+def _rebuild(
+    file: io.BufferedRandom,
+    sng_file: str,
+    tables: io.BytesIO,
+    placed: List[Tuple[int, _Member]],
+    new_members: List[Tuple[int, _Member]],
+    xor_mask: bytes,
+) -> str:
+    """
+    Writes the updated SNG file next to `sng_file`, to be renamed over the original once
+    it is closed. Internal function.
+
+    Returns:
+        str: The path of the written file.
+    """
+    tmp_path = os.path.join(
+        os.path.dirname(sng_file), ".%s.sng.tmp" % os.urandom(8).hex()
+    )
+    try:
+        with open(tmp_path, "x+b") as out:
+            out.write(tables.getbuffer())
+            out.flush()
+            for idx, member in placed:
+                if member.old_idx is not None:
+                    _copy_range(
+                        file.fileno(), out.fileno(), member.content_len, member.old_idx, idx
+                    )
+            _write_new_members(out, new_members, xor_mask)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return tmp_path
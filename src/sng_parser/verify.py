@@ -0,0 +1,280 @@
+import hashlib
+import logging
+import os
+import struct
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BufferedReader
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from .common import (
+    HEADER,
+    MIN_CHUNK_SIZE,
+    U64,
+    SngFileMetadata,
+    pread_and_mask,
+    read_struct,
+    _fail_on_invalid_sng_ver,
+    _fail_on_short_sng,
+)
+from .decode import (
+    decode_file_metadata,
+    decode_metadata,
+    read_file_data_len,
+)
+
+__all__ = ["verify_sng", "verify_sng_files", "SngVerifyResult"]
+
+logger = logging.getLogger(__package__)
+
+# Errors raised by the table decoders on a malformed sng file
+_DECODE_ERRORS = (RuntimeError, ValueError, struct.error)
+
+
+class SngVerifyResult(NamedTuple):
+    """
+    Outcome of verifying one SNG file. `ok` is True when `errors` is empty.
+    """
+
+    path: str
+    ok: bool
+    errors: List[str]
+    version: Optional[int]
+    size: int
+    members: int
+    hashes: Optional[Dict[str, str]]
+
+
+class _HashWriter:
+    """
+    Write target feeding a hash, so members are hashed with the same copy loop they are
+    extracted with. Internal use.
+    """
+
+    __slots__ = ("hash",)
+
+    def __init__(self, algorithm: str) -> None:
+        self.hash = hashlib.new(algorithm)
+
+    def write(self, data) -> int:
+        self.hash.update(data)
+        return len(data)
+
+
+def _check_hash_algorithm(algorithm: Optional[str]) -> None:
+    if algorithm is not None and algorithm not in hashlib.algorithms_available:
+        raise ValueError(
+            "Unknown hash algorithm %s, available: %s"
+            % (algorithm, ", ".join(sorted(hashlib.algorithms_available)))
+        )
+
+
+def _check_section_len(buffer: BufferedReader, size: int, section: str) -> None:
+    """
+    Fails before a section is read if its length prefix points past the end of the file,
+    so a corrupt length never turns into a huge read. Internal function.
+    """
+    pos = buffer.tell()
+    prefix = buffer.read(U64.size)
+    buffer.seek(pos)
+    if len(prefix) != U64.size:
+        raise RuntimeError("%s length missing, the file ends at %d" % (section, size))
+    length: int = U64.unpack(prefix)[0]
+    if pos + U64.size + length > size:
+        raise RuntimeError(
+            "%s section of %d bytes at %d extends past the end of the file (%d bytes)"
+            % (section, length, pos + U64.size, size)
+        )
+
+
+def _check_members(
+    file_meta_array: List[SngFileMetadata], data_start: int, data_end: int
+) -> List[str]:
+    """
+    Checks every member lies within the file data section, and no two members share a name
+    or overlap. Internal function.
+
+    Returns:
+        List[str]: One message per problem found.
+    """
+    errors = []
+    seen = set()
+    for file_meta in file_meta_array:
+        if file_meta.filename in seen:
+            errors.append("Duplicate member %s" % file_meta.filename)
+        seen.add(file_meta.filename)
+        end = file_meta.content_idx + file_meta.content_len
+        if file_meta.content_idx < data_start or end > data_end:
+            errors.append(
+                "Member %s (%d bytes at %d) lies outside the file data section (%d to %d)"
+                % (file_meta.filename, file_meta.content_len, file_meta.content_idx, data_start, data_end)
+            )
+
+    # empty members take no space, they can't overlap anything
+    ordered = sorted(
+        (file_meta for file_meta in file_meta_array if file_meta.content_len),
+        key=lambda file_meta: file_meta.content_idx,
+    )
+    for prev, file_meta in zip(ordered, ordered[1:]):
+        if file_meta.content_idx < prev.content_idx + prev.content_len:
+            errors.append(
+                "Member %s overlaps member %s at %d"
+                % (file_meta.filename, prev.filename, file_meta.content_idx)
+            )
+    return errors
+
+
+def _hash_members(
+    f: BufferedReader, xor_mask: bytes, file_meta_array: List[SngFileMetadata], algorithm: str
+) -> Dict[str, str]:
+    """
+    Hashes the unmasked contents of every member, reading with positional reads. Internal function.
+    """
+    hashes = {}
+    for file_meta in file_meta_array:
+        writer = _HashWriter(algorithm)
+        pread_and_mask(
+            fd=f.fileno(),
+            offset=file_meta.content_idx,
+            write_to=writer,
+            xor_mask=xor_mask,
+            filesize=file_meta.content_len,
+            chunk_size=MIN_CHUNK_SIZE,
+        )
+        hashes[file_meta.filename] = writer.hash.hexdigest()
+    return hashes
+
+
+def verify_sng(
+    sng_file: os.PathLike | str, *, hash_algorithm: Optional[str] = None
+) -> SngVerifyResult:
+    """
+    Checks the structure of an SNG file without extracting anything.
+
+    The header identifier and version, the length and count of the metadata and file metadata
+    sections, and the length of the file data section are checked against each other and against
+    the size of the file. Every member has to lie within the file data section, without
+    overlapping another one. Only the tables are read, unless `hash_algorithm` is given, in which
+    case the unmasked contents of every member are hashed once the structure checks pass.
+
+    Problems are reported in the result rather than raised, so a bad file doesn't stop
+    a run over a library.
+
+    Args:
+        sng_file (os.PathLike | str): The SNG file to verify.
+        hash_algorithm (str, optional): A `hashlib` algorithm, such as `sha256`, to hash each member with.
+
+    Returns:
+        SngVerifyResult: The errors found, the version, size and member count of the file, and the member hashes.
+
+    Raises:
+        ValueError: When the hash algorithm is unknown
+    """
+    _check_hash_algorithm(hash_algorithm)
+    path = os.fspath(sng_file)
+    errors: List[str] = []
+    version = None
+    size = 0
+    file_meta_array: List[SngFileMetadata] = []
+    hashes = None
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            _fail_on_short_sng(size)
+            file_identifier, version, xor_mask = read_struct(HEADER, f)
+            if file_identifier != b"SNGPKG":
+                raise RuntimeError("Invalid file identifier %r" % file_identifier)
+            _fail_on_invalid_sng_ver(version)
+            _check_section_len(f, size, "Metadata")
+            decode_metadata(f)
+            _check_section_len(f, size, "File metadata")
+            file_meta_array = decode_file_metadata(f)
+
+            data_start = f.tell() + U64.size
+            if data_start > size:
+                raise RuntimeError("File data length missing, the file ends at %d" % size)
+            try:
+                data_len = read_file_data_len(file_meta_array, f)
+            except RuntimeError as err:
+                # the member ranges are still worth checking against the file
+                errors.append(str(err))
+            else:
+                if data_start + data_len != size:
+                    errors.append(
+                        "File data section ends at %d, the file is %d bytes"
+                        % (data_start + data_len, size)
+                    )
+            errors += _check_members(file_meta_array, data_start, size)
+
+            if hash_algorithm is not None and not errors:
+                hashes = _hash_members(f, xor_mask, file_meta_array, hash_algorithm)
+    except _DECODE_ERRORS as err:
+        errors.append(str(err))
+    except OSError as err:
+        errors.append("%s: %s" % (type(err).__name__, err))
+    if errors:
+        logger.debug("%s failed verification: %s", path, "; ".join(errors))
+    return SngVerifyResult(
+        path, not errors, errors, version, size, len(file_meta_array), hashes
+    )
+
+
+def _sng_paths(paths: Iterable[os.PathLike | str]) -> List[str]:
+    """
+    Expands directories to the .sng files under them, recursively. Internal function.
+    """
+    found = []
+    for path in paths:
+        path = os.fspath(path)
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for dirpath, _, filenames in os.walk(path):
+            found.extend(
+                os.path.join(dirpath, filename)
+                for filename in sorted(filenames)
+                if filename.endswith(".sng")
+            )
+    return found
+
+
+def verify_sng_files(
+    paths: Iterable[os.PathLike | str],
+    *,
+    workers: Optional[int] = None,
+    hash_algorithm: Optional[str] = None,
+) -> List[SngVerifyResult]:
+    """
+    Verifies many SNG files with `verify_sng` on a process pool.
+
+    Args:
+        paths (Iterable[os.PathLike | str]): SNG files, or directories searched recursively for .sng files.
+        workers (int, optional): Number of worker processes. With 1, files are verified in this process. Defaults to the cpu count.
+        hash_algorithm (str, optional): A `hashlib` algorithm to hash each member with.
+
+    Returns:
+        List[SngVerifyResult]: One result per file, in the order they were found.
+
+    Raises:
+        ValueError: When the hash algorithm is unknown
+    """
+    _check_hash_algorithm(hash_algorithm)
+    files = _sng_paths(paths)
+    logger.info("Verifying %d sng files", len(files))
+    workers = min(workers or os.cpu_count() or 1, len(files))
+    if workers <= 1:
+        results = [verify_sng(path, hash_algorithm=hash_algorithm) for path in files]
+    else:
+        logger.debug("Verifying with %d processes", workers)
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(
+                pool.map(
+                    partial(verify_sng, hash_algorithm=hash_algorithm),
+                    files,
+                    chunksize=max(1, min(64, len(files) // (workers * 4))),
+                )
+            )
+    failed = sum(not result.ok for result in results)
+    logger.info("Verified %d sng files (failed: %d)", len(results), failed)
+    return results
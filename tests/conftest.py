@@ -0,0 +1,49 @@
+import random
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from sng_parser import encode_sng
+
+SONG_INI = """[song]
+name = Song
+artist = Artist
+charter = Charter
+"""
+
+
+def member_contents(seed: int = 0) -> dict:
+    """
+    Files of a small song, sized to cross the 16 and 256 byte mask periods.
+    """
+    rand = random.Random(seed)
+    return {
+        "notes.chart": rand.randbytes(1000),
+        "guitar.ogg": rand.randbytes(70000),
+        "album.png": rand.randbytes(257),
+        "video.webm": b"",
+    }
+
+
+def write_wav(path, seconds: float = 1.0) -> None:
+    rand = np.random.default_rng(0)
+    frames = int(48000 * seconds)
+    sf.write(path, rand.uniform(-0.5, 0.5, (frames, 2)).astype("float32"), 48000)
+
+
+@pytest.fixture
+def song_dir(tmp_path):
+    song = tmp_path / "song"
+    song.mkdir()
+    (song / "song.ini").write_text(SONG_INI)
+    for name, data in member_contents().items():
+        (song / name).write_bytes(data)
+    return song
+
+
+@pytest.fixture
+def sng_file(tmp_path, song_dir):
+    out = tmp_path / "song.sng"
+    encode_sng(song_dir, output_filename=out, encode_audio=False)
+    return out
@@ -0,0 +1,71 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+import sng_parser.aio
+from sng_parser import SngArchive, async_decode_sng, async_encode_sng
+
+from conftest import member_contents, write_wav
+
+
+def test_round_trip(tmp_path, song_dir):
+    out = tmp_path / "song.sng"
+    asyncio.run(async_encode_sng(song_dir, out, encode_audio=False))
+    asyncio.run(async_decode_sng(out, outdir=tmp_path / "out", sng_dir="song"))
+    for name, data in member_contents().items():
+        assert (tmp_path / "out" / "song" / name).read_bytes() == data
+
+
+def _shm_blocks():
+    return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")}
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm")
+def test_cancel_during_transcode_frees_outputs(tmp_path, song_dir, monkeypatch):
+    (song_dir / "guitar.ogg").unlink()
+    write_wav(song_dir / "guitar.wav", seconds=5.0)
+    before = _shm_blocks()
+    started = threading.Event()
+    closed = threading.Event()
+    write_tables = sng_parser.aio._write_tables_forward
+    close_transcoded = sng_parser.aio._close_transcoded
+
+    def tables(*args, **kwargs):
+        started.set()
+        return write_tables(*args, **kwargs)
+
+    def close(planned):
+        close_transcoded(planned)
+        closed.set()
+
+    monkeypatch.setattr(sng_parser.aio, "_write_tables_forward", tables)
+    monkeypatch.setattr(sng_parser.aio, "_close_transcoded", close)
+
+    async def main():
+        task = asyncio.create_task(
+            async_encode_sng(song_dir, tmp_path / "song.sng", transcode_cache=None)
+        )
+        await asyncio.to_thread(started.wait)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert closed.wait(60)
+    deadline = time.monotonic() + 5
+    while _shm_blocks() - before and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not _shm_blocks() - before
+    assert not (tmp_path / "song.sng").exists()
+
+
+def test_encoded_audio_is_readable(tmp_path, song_dir):
+    (song_dir / "guitar.ogg").unlink()
+    write_wav(song_dir / "guitar.wav")
+    out = tmp_path / "song.sng"
+    asyncio.run(async_encode_sng(song_dir, out, transcode_cache=None))
+    with SngArchive(out, cache=None) as archive:
+        assert archive.read("guitar.opus")[:4] == b"OggS"
@@ -0,0 +1,105 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from sng_parser import SngArchive, decode_sng_to_mapping
+
+from conftest import member_contents
+
+
+def test_read_members(sng_file):
+    with SngArchive(sng_file, cache=None) as archive:
+        assert archive.metadata["name"] == "Song"
+        assert {name: archive.read(name) for name in member_contents()} == member_contents()
+
+
+def test_open_from_bytes(sng_file):
+    with SngArchive(sng_file.read_bytes()) as archive:
+        assert archive.read("album.png") == member_contents()["album.png"]
+
+
+def test_member_reader_seeks(sng_file):
+    data = member_contents()["guitar.ogg"]
+    with SngArchive(sng_file, cache=None) as archive:
+        with archive.open_member("guitar.ogg") as member:
+            member.seek(300)
+            assert member.read(1000) == data[300:1300]
+
+
+@pytest.mark.parametrize("size", [0, 10])
+def test_short_file_raises_runtime_error(tmp_path, sng_file, size):
+    short = tmp_path / "short.sng"
+    short.write_bytes(sng_file.read_bytes()[:size])
+    with pytest.raises(RuntimeError):
+        SngArchive(short, cache=None)
+    with pytest.raises(RuntimeError):
+        SngArchive(short.read_bytes())
+
+
+def _pipe(data):
+    read_fd, write_fd = os.pipe()
+
+    def write():
+        with open(write_fd, "wb") as f:
+            f.write(data)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    return open(read_fd, "rb"), writer
+
+
+@pytest.mark.parametrize("source", ["path", "bytes", "file", "pipe", "fifo"])
+def test_decode_to_mapping(tmp_path, sng_file, source):
+    writer = None
+    if source == "path":
+        src = sng_file
+    elif source == "bytes":
+        src = sng_file.read_bytes()
+    elif source == "file":
+        src = open(sng_file, "rb")
+    elif source == "pipe":
+        src, writer = _pipe(sng_file.read_bytes())
+    else:
+        src = tmp_path / "fifo"
+        os.mkfifo(src)
+        writer = threading.Thread(target=lambda: src.write_bytes(sng_file.read_bytes()))
+        writer.start()
+    metadata, members = decode_sng_to_mapping(src, cache=None)
+    if writer is not None:
+        writer.join()
+    with members:
+        assert metadata["name"] == "Song"
+        assert members.sizes() == {name: len(data) for name, data in member_contents().items()}
+        assert {name: bytes(data) for name, data in members.items()} == member_contents()
+        chart = members["notes.chart"]
+    assert chart.readonly and bytes(chart) == member_contents()["notes.chart"]
+    with pytest.raises(ValueError):
+        members["notes.chart"]
+    if source in ("file", "pipe"):
+        src.close()
+
+
+def test_decode_to_mapping_from_stdin(sng_file):
+    code = (
+        "import sys\n"
+        "from sng_parser import decode_sng_to_mapping\n"
+        "metadata, members = decode_sng_to_mapping(sys.stdin.buffer)\n"
+        "with members:\n"
+        "    print(metadata['name'], len(members['guitar.ogg']))\n"
+    )
+    proc = subprocess.run([sys.executable, "-c", code], input=sng_file.read_bytes(), capture_output=True)
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.split() == [b"Song", str(len(member_contents()["guitar.ogg"])).encode()]
+
+
+def test_decode_to_mapping_size_cap(sng_file):
+    _, members = decode_sng_to_mapping(sng_file, max_size=1000, cache=None)
+    with members:
+        assert bytes(members["notes.chart"]) == member_contents()["notes.chart"]
+        with pytest.raises(ValueError):
+            members["guitar.ogg"]
+        with pytest.raises(KeyError):
+            members["missing.png"]
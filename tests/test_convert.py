@@ -0,0 +1,100 @@
+import logging
+import subprocess
+import sys
+import zipfile
+from configparser import ConfigParser
+from pathlib import Path
+
+import pytest
+
+from sng_parser import SngArchive
+from sng_parser.convert import pack_to_sng, sng_to_pack
+from sng_parser.decode import format_song_ini, write_metadata
+
+from conftest import member_contents
+
+
+def test_write_metadata(tmp_path, caplog):
+    metadata = {"name": "Song", "artist": "Artist"}
+    with caplog.at_level(logging.DEBUG, logger="sng_parser"):
+        write_metadata(metadata, tmp_path)
+    assert (tmp_path / "song.ini").read_text() == format_song_ini(metadata)
+    cfg = ConfigParser()
+    cfg.read(tmp_path / "song.ini")
+    assert dict(cfg["Song"]) == metadata
+    assert "Wrote song.ini in %s" % tmp_path in caplog.text
+
+
+@pytest.mark.parametrize("suffix", [".zip", ".tar", ".tar.gz"])
+def test_round_trip(tmp_path, sng_file, suffix):
+    pack = tmp_path / ("pack" + suffix)
+    assert sng_to_pack([sng_file], pack) == 1 + len(member_contents())
+    (written,) = pack_to_sng(pack, tmp_path / "out")
+    assert written == tmp_path / "out" / "song.sng"
+    with SngArchive(sng_file) as before, SngArchive(written) as after:
+        assert after.metadata == before.metadata
+        assert {m.filename: after.read(m.filename) for m in after.members()} == member_contents()
+
+
+def test_failed_pack_is_removed(tmp_path, sng_file):
+    bad = tmp_path / "bad.sng"
+    bad.write_bytes(b"SNGPKG")
+    with pytest.raises(RuntimeError):
+        sng_to_pack([sng_file, bad], tmp_path / "pack.zip")
+    assert not (tmp_path / "pack.zip").exists()
+
+
+def test_cli_reports_failed_pack(tmp_path, sng_file):
+    bad = tmp_path / "bad.sng"
+    bad.write_bytes(b"SNGPKG")
+    proc = subprocess.run(
+        [sys.executable, "-m", "sng_parser", "convert", "-o", str(tmp_path / "pack.zip"), str(sng_file), str(bad)],
+        capture_output=True,
+        text=True,
+    )
+    assert proc.returncode == 1
+    assert "Traceback" not in proc.stderr
+    assert "Converted 0 of 1 (failed: 1)" in proc.stderr
+    assert not (tmp_path / "pack.zip").exists()
+
+
+def _zip_pack(path, names):
+    with zipfile.ZipFile(path, "w") as zf:
+        for name in names:
+            zf.writestr(name, "[song]\nname = Song\n" if name.endswith("song.ini") else b"chart")
+    return path
+
+
+@pytest.mark.parametrize("song_dir", ["../../escaped", "a/../../escaped", "/abs/song"])
+def test_pack_cannot_write_outside_outdir(tmp_path, song_dir):
+    pack = _zip_pack(
+        tmp_path / "pack.zip",
+        [song_dir + "/song.ini", song_dir + "/notes.chart", "good/song.ini", "good/notes.chart"],
+    )
+    outdir = tmp_path / "out" / "inner"
+    with pytest.raises(RuntimeError, match="1 of 2 songs"):
+        pack_to_sng(pack, outdir)
+    assert [path.relative_to(tmp_path) for path in tmp_path.rglob("*.sng")] == [
+        Path("out/inner/good.sng")
+    ]
+
+
+def test_existing_song_does_not_stop_the_pack(tmp_path):
+    pack = _zip_pack(
+        tmp_path / "pack.zip", ["a/song.ini", "a/notes.chart", "b/song.ini", "b/notes.chart"]
+    )
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    (outdir / "a.sng").write_bytes(b"keep")
+    with pytest.raises(RuntimeError, match="a \\(FileExistsError"):
+        pack_to_sng(pack, outdir)
+    assert (outdir / "a.sng").read_bytes() == b"keep"
+    with SngArchive(outdir / "b.sng") as archive:
+        assert archive.read("notes.chart") == b"chart"
+
+
+def test_entry_names_are_normalized(tmp_path):
+    pack = _zip_pack(tmp_path / "pack.zip", ["./a//song.ini", "a/./notes.chart"])
+    assert pack_to_sng(pack, tmp_path / "out") == [tmp_path / "out" / "a.sng"]
+    with SngArchive(tmp_path / "out" / "a.sng") as archive:
+        assert [member.filename for member in archive.members()] == ["notes.chart"]
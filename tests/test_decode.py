@@ -0,0 +1,38 @@
+import io
+
+import pytest
+
+from sng_parser import SngArchive, decode_sng
+from sng_parser.common import HEADER, U64
+from sng_parser.decode import read_sng_tables
+
+
+class Pipe(io.BytesIO):
+    def seekable(self):
+        return False
+
+
+def _corrupt_length(sng_file, section, length):
+    data = bytearray(sng_file.read_bytes())
+    pos = HEADER.size
+    if section == "file_metadata":
+        pos += U64.size + U64.unpack_from(data, pos)[0]
+    U64.pack_into(data, pos, length)
+    return bytes(data)
+
+
+@pytest.mark.parametrize("length", [2**40, 2**63, 2**64 - 1])
+@pytest.mark.parametrize("section", ["metadata", "file_metadata"])
+def test_corrupt_section_length(tmp_path, sng_file, section, length):
+    data = _corrupt_length(sng_file, section, length)
+    corrupt = tmp_path / "corrupt.sng"
+    corrupt.write_bytes(data)
+    for buffer in (io.BytesIO(data), Pipe(data)):
+        with pytest.raises(RuntimeError, match="read mismatch"):
+            read_sng_tables(buffer)
+    with pytest.raises(RuntimeError, match="read mismatch"):
+        SngArchive(corrupt, cache=None)
+    with pytest.raises(RuntimeError, match="read mismatch"):
+        SngArchive(data)
+    with pytest.raises(RuntimeError, match="read mismatch"):
+        decode_sng(corrupt, outdir=tmp_path / "out")
@@ -0,0 +1,129 @@
+import io
+import subprocess
+import sys
+
+import pytest
+
+import sng_parser.encode
+from sng_parser import SngArchive, decode_sng, encode_sng
+from sng_parser.encode import create_sng_filename
+
+from conftest import member_contents, write_wav
+
+
+def test_round_trip(tmp_path, sng_file):
+    decode_sng(sng_file, outdir=tmp_path / "out", sng_dir="song")
+    out = tmp_path / "out" / "song"
+    for name, data in member_contents().items():
+        assert (out / name).read_bytes() == data
+    assert "name = Song" in (out / "song.ini").read_text()
+
+
+@pytest.mark.parametrize("encode_audio", [False, True])
+@pytest.mark.parametrize("prefix", [b"", b"x" * 100], ids=["at_start", "after_100_bytes"])
+def test_encode_to_seekable_and_unseekable_streams(song_dir, prefix, encode_audio):
+    class Pipe(io.BytesIO):
+        def seekable(self):
+            return False
+
+    if encode_audio:
+        (song_dir / "guitar.ogg").unlink()
+        write_wav(song_dir / "guitar.wav")
+    xor_mask = bytes(range(16))
+    seekable, pipe = io.BytesIO(prefix), Pipe(prefix)
+    seekable.seek(0, io.SEEK_END)
+    pipe.seek(0, io.SEEK_END)
+    encode_sng(song_dir, output_filename=seekable, encode_audio=encode_audio, xor_mask=xor_mask)
+    encode_sng(song_dir, output_filename=pipe, encode_audio=encode_audio, xor_mask=xor_mask)
+    assert seekable.getvalue().startswith(prefix) and pipe.getvalue().startswith(prefix)
+    with SngArchive(seekable.getvalue()[len(prefix) :]) as a, SngArchive(
+        pipe.getvalue()[len(prefix) :]
+    ) as b:
+        contents = {m.filename: a.read(m.filename) for m in a.members()}
+        assert contents == {m.filename: b.read(m.filename) for m in b.members()}
+    if encode_audio:
+        assert contents["guitar.opus"][:4] == b"OggS"
+    else:
+        assert contents == member_contents()
+
+
+def test_hashed_name(tmp_path, song_dir, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    encode_sng(song_dir, encode_audio=False)
+    assert (tmp_path / (create_sng_filename(song_dir) + ".sng")).is_file()
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_hashed_name_with_transcoded_audio(tmp_path, song_dir, monkeypatch):
+    (song_dir / "guitar.ogg").unlink()
+    write_wav(song_dir / "guitar.wav")
+    monkeypatch.chdir(tmp_path)
+    read_again = []
+    get_file_md5 = sng_parser.encode._get_file_md5
+    monkeypatch.setattr(
+        sng_parser.encode,
+        "_get_file_md5",
+        lambda path: read_again.append(path) or get_file_md5(path),
+    )
+    encode_sng(song_dir, transcode_cache=None)
+    # the wav was hashed by its transcoding worker, only song.ini is read again
+    assert [path.rsplit("/", 1)[-1] for path in read_again] == ["song.ini"]
+    sng_files = list(tmp_path.glob("*.sng"))
+    assert [path.name for path in sng_files] == [create_sng_filename(song_dir) + ".sng"]
+    with SngArchive(sng_files[0], cache=None) as archive:
+        assert "guitar.opus" in archive
+
+
+def test_failed_encode_removes_output(tmp_path, song_dir, monkeypatch):
+    def fail(**kwargs):
+        kwargs["write_to"].write(b"partial")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(sng_parser.encode, "write_and_mask", fail)
+    out = tmp_path / "out.sng"
+    with pytest.raises(OSError):
+        encode_sng(song_dir, output_filename=out, encode_audio=False)
+    assert not out.exists()
+
+
+def test_import_and_encode_without_numpy(tmp_path, song_dir):
+    code = (
+        "import sys; sys.modules['numpy'] = None\n"
+        "from sng_parser import SngArchive, encode_sng\n"
+        "encode_sng(sys.argv[1], output_filename=sys.argv[2], encode_audio=False)\n"
+        "with SngArchive(sys.argv[2]) as archive:\n"
+        "    print(len(archive.members()))\n"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", code, str(song_dir), str(tmp_path / "song.sng")],
+        capture_output=True,
+        text=True,
+    )
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip() == str(len(member_contents()))
+
+
+def test_encode_from_members(tmp_path, sng_file):
+    contents = member_contents()
+    members = {
+        "notes.chart": contents["notes.chart"],
+        "guitar.ogg": io.BytesIO(contents["guitar.ogg"]),
+        "album.png": bytearray(contents["album.png"]),
+        "video.webm": memoryview(contents["video.webm"]),
+    }
+    xor_mask = bytes(range(16))
+    data = sng_parser.encode_sng_from_members({"name": "Song"}, members, xor_mask=xor_mask)
+    members["guitar.ogg"].seek(0)
+    with open(tmp_path / "out.sng", "wb") as f:
+        assert sng_parser.encode_sng_from_members({"name": "Song"}, members, f, xor_mask=xor_mask) is None
+    assert (tmp_path / "out.sng").read_bytes() == data
+    with SngArchive(io.BytesIO(data)) as archive:
+        assert archive.metadata == {"name": "Song"}
+        assert archive.header.xor_mask == xor_mask
+        assert {name: archive.read(name) for name in contents} == contents
+
+
+@pytest.mark.parametrize("name", ["../notes.chart", "song.ini", "notes.txt"])
+def test_encode_from_members_checks_names(name):
+    with pytest.raises(ValueError):
+        sng_parser.encode_sng_from_members({}, {name: b""})
@@ -0,0 +1,90 @@
+import io
+import random
+
+import pytest
+
+from sng_parser.common import MASK_BACKENDS, mask, mask_into, write_and_mask
+
+SIZES = [0, 1, 15, 16, 255, 256, 257]
+OFFSETS = [0, 1, 15, 16, 200, 255, 256, 1000]
+XOR_MASK = bytes(random.Random(1).randrange(256) for _ in range(16))
+
+
+def reference_mask(data: bytes, xor_mask: bytes, offset: int = 0) -> bytearray:
+    """
+    The original per-byte masking loop, extended with the start offset.
+    """
+    masked_data = bytearray(len(data))
+    for i in range(len(data)):
+        pos = offset + i
+        xor_key = xor_mask[pos % 16] ^ (pos & 0xFF)
+        masked_data[i] = data[i] ^ xor_key
+    return masked_data
+
+
+def _data(size: int) -> bytes:
+    return random.Random(size).randbytes(size)
+
+
+@pytest.mark.parametrize("backend", sorted(MASK_BACKENDS))
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("offset", OFFSETS)
+def test_mask_matches_reference(backend, size, offset):
+    data = _data(size)
+    assert mask(data, XOR_MASK, offset, backend=backend) == reference_mask(data, XOR_MASK, offset)
+
+
+@pytest.mark.parametrize("backend", sorted(MASK_BACKENDS))
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("offset", OFFSETS)
+def test_mask_into_matches_reference(backend, size, offset):
+    data = _data(size)
+    buf = bytearray(data)
+    mask_into(buf, XOR_MASK, offset, backend=backend)
+    assert buf == reference_mask(data, XOR_MASK, offset)
+
+
+@pytest.mark.parametrize("backend", sorted(MASK_BACKENDS))
+def test_mask_into_memoryview_slice(backend):
+    data = _data(1000)
+    buf = bytearray(data)
+    mask_into(memoryview(buf)[100:357], XOR_MASK, 100, backend=backend)
+    expected = bytearray(data)
+    expected[100:357] = reference_mask(data[100:357], XOR_MASK, 100)
+    assert buf == expected
+
+
+@pytest.mark.parametrize("backend", sorted(MASK_BACKENDS))
+@pytest.mark.parametrize("chunk", [1, 15, 16, 255, 256, 257])
+def test_mask_chunked_matches_whole(backend, chunk):
+    data = _data(3000)
+    masked = bytearray()
+    for start in range(0, len(data), chunk):
+        masked += mask(data[start : start + chunk], XOR_MASK, start, backend=backend)
+    assert masked == reference_mask(data, XOR_MASK)
+
+
+@pytest.mark.parametrize("chunk_size", [256, 512, 4096])
+@pytest.mark.parametrize("size", SIZES + [4097])
+def test_write_and_mask_matches_reference(chunk_size, size):
+    data = _data(size)
+    out = io.BytesIO()
+    written = write_and_mask(
+        read_from=io.BytesIO(data),
+        write_to=out,
+        xor_mask=XOR_MASK,
+        filesize=size,
+        chunk_size=chunk_size,
+    )
+    assert written == size
+    assert out.getvalue() == reference_mask(data, XOR_MASK)
+
+
+def test_mask_is_an_involution():
+    data = _data(1000)
+    assert mask(mask(data, XOR_MASK), XOR_MASK) == data
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        mask(b"abc", XOR_MASK, backend="missing")
@@ -0,0 +1,71 @@
+import io
+import tempfile
+from multiprocessing import shared_memory
+
+import pytest
+
+import sng_parser.audio.parallel_transcode as parallel_transcode
+from sng_parser.audio.parallel_transcode import TranscodedAudio, _SharedOutput, _transcode
+
+from conftest import write_wav
+
+
+def _write_and_hand_off(out):
+    data = bytes(range(256)) * 40
+    for pos in range(0, len(data), 1000):
+        out.write(data[pos : pos + 1000])
+    out.seek(4)
+    out.write(b"head")
+    expected = data[:4] + b"head" + data[8:]
+    out.seek(0)
+    assert out.read() == expected
+    with out.getbuffer() as view:
+        assert view == expected
+    name, value = out.hand_off()
+    return expected, name, value
+
+
+def test_shared_output_grows(monkeypatch):
+    created = []
+    shm_class = shared_memory.SharedMemory
+    monkeypatch.setattr(
+        parallel_transcode.shared_memory,
+        "SharedMemory",
+        lambda *args, **kwargs: created.append(kwargs.get("size")) or shm_class(*args, **kwargs),
+    )
+    expected, name, value = _write_and_hand_off(_SharedOutput(16))
+    assert len(created) > 1 and value is None
+    with TranscodedAudio(name, len(expected)) as audio:
+        assert audio.read() == expected
+
+
+@pytest.mark.parametrize("fail_after", [0, 1])
+def test_shared_output_falls_back_to_memory(monkeypatch, fail_after):
+    shm_class = shared_memory.SharedMemory
+    created = []
+
+    def create(*args, **kwargs):
+        if len(created) >= fail_after:
+            raise OSError("no space left")
+        created.append(shm_class(*args, **kwargs))
+        return created[-1]
+
+    monkeypatch.setattr(parallel_transcode.shared_memory, "SharedMemory", create)
+    expected, name, value = _write_and_hand_off(_SharedOutput(16))
+    assert name is None and value == expected
+    for shm in created:
+        # blocks left behind by the fallback are freed
+        with pytest.raises(FileNotFoundError):
+            shm_class(shm.name)
+
+
+def test_transcode_encodes_in_memory(tmp_path, monkeypatch):
+    def no_temp_files(*args, **kwargs):
+        raise AssertionError("encoded through a temporary file")
+
+    monkeypatch.setattr(tempfile, "TemporaryFile", no_temp_files)
+    write_wav(tmp_path / "guitar.wav")
+    output = _transcode(str(tmp_path / "guitar.wav"), 0, None)
+    with TranscodedAudio(output.name, output.size, output.data) as audio:
+        assert audio.read(4) == b"OggS"
+        assert audio.seek(0, io.SEEK_END) == output.size
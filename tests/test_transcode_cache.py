@@ -0,0 +1,114 @@
+import hashlib
+import os
+import subprocess
+import sys
+
+import pytest
+
+from sng_parser import SngArchive, encode_sng
+from sng_parser.audio import TranscodeCache
+
+from conftest import write_wav
+
+
+@pytest.fixture
+def audio_song(song_dir):
+    (song_dir / "guitar.ogg").unlink()
+    write_wav(song_dir / "guitar.wav")
+    return song_dir
+
+
+def _opus(path):
+    with SngArchive(path, cache=None) as archive:
+        return archive.read("guitar.opus")
+
+
+def test_hit_skips_transcode(tmp_path, audio_song):
+    cache = TranscodeCache(tmp_path / "cache")
+    encode_sng(audio_song, output_filename=tmp_path / "a.sng", transcode_cache=cache)
+    encode_sng(audio_song, output_filename=tmp_path / "b.sng", transcode_cache=cache)
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.entries) == (1, 1, 1)
+    assert _opus(tmp_path / "a.sng") == _opus(tmp_path / "b.sng")
+
+
+def test_unusable_cache_dir_falls_back_to_transcoding(tmp_path, audio_song):
+    not_a_dir = tmp_path / "file"
+    not_a_dir.write_bytes(b"")
+    cache = TranscodeCache(not_a_dir / "cache")
+    out = tmp_path / "song.sng"
+    encode_sng(audio_song, output_filename=out, transcode_cache=cache)
+    assert _opus(out)[:4] == b"OggS"
+    assert cache.stats().entries == 0
+    assert cache.trim() == 0
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "geteuid") or os.geteuid() == 0, reason="permissions are not enforced for root"
+)
+def test_read_only_cache_dir_falls_back_to_transcoding(tmp_path, audio_song):
+    directory = tmp_path / "cache"
+    directory.mkdir()
+    directory.chmod(0o500)
+    try:
+        out = tmp_path / "song.sng"
+        encode_sng(audio_song, output_filename=out, transcode_cache=TranscodeCache(directory))
+        assert _opus(out)[:4] == b"OggS"
+    finally:
+        directory.chmod(0o700)
+
+
+def test_library_does_not_cache_by_default(tmp_path, audio_song, monkeypatch):
+    monkeypatch.setenv("SNG_PARSER_CACHE_DIR", str(tmp_path / "cache"))
+    encode_sng(audio_song, output_filename=tmp_path / "song.sng")
+    assert not (tmp_path / "cache").exists()
+
+
+def test_cli_caches_by_default(tmp_path, audio_song):
+    env = dict(os.environ, SNG_PARSER_CACHE_DIR=str(tmp_path / "cache"))
+    cmd = [sys.executable, "-m", "sng_parser", "encode", "-e", "-o"]
+    subprocess.run([*cmd, str(tmp_path / "a.sng"), str(audio_song)], env=env, check=True)
+    assert len(list((tmp_path / "cache").glob("*.opus-entry"))) == 1
+    subprocess.run(
+        [*cmd, str(tmp_path / "b.sng"), "--no-transcode-cache", str(audio_song)],
+        env=dict(env, SNG_PARSER_CACHE_DIR=str(tmp_path / "other")),
+        check=True,
+    )
+    assert not (tmp_path / "other").exists()
+
+
+def test_put_lists_entries_only_past_the_limit(tmp_path, monkeypatch):
+    cache = TranscodeCache(tmp_path / "cache", max_bytes=100)
+    cache.put("a", b"x" * 40, 1.0)
+    (entry,) = (tmp_path / "cache").iterdir()
+    os.utime(entry, (0, 0))
+    scans = []
+    scan = TranscodeCache._scan
+    monkeypatch.setattr(TranscodeCache, "_scan", lambda self: scans.append(1) or scan(self))
+    cache.put("b", b"x" * 30, 1.0)
+    assert not scans
+    assert cache.stats().entries == 2
+    scans.clear()
+    cache.put("c", b"x" * 30, 1.0)
+    assert scans
+    assert cache.get("a") is None
+    assert cache.get("c") == b"x" * 30
+
+
+def test_sources_are_not_hashed_in_the_parent(tmp_path, audio_song, monkeypatch):
+    def fail(self, filepath):
+        raise AssertionError("hashed %s in the parent" % filepath)
+
+    monkeypatch.setattr(TranscodeCache, "key", fail)
+    cache = TranscodeCache(tmp_path / "cache")
+    encode_sng(audio_song, output_filename=tmp_path / "a.sng", transcode_cache=cache)
+    encode_sng(audio_song, output_filename=tmp_path / "b.sng", transcode_cache=cache)
+    assert (cache.stats().hits, cache.stats().misses) == (1, 1)
+
+
+def test_hash_source(tmp_path, audio_song):
+    wav = audio_song / "guitar.wav"
+    key, md5 = TranscodeCache.hash_source(wav, md5=True)
+    assert key == TranscodeCache(tmp_path).key(wav)
+    assert md5 == hashlib.md5(wav.read_bytes()).hexdigest()
+    assert TranscodeCache.hash_source(wav, key=False) == (None, None)
@@ -0,0 +1,83 @@
+import os
+import stat
+
+import pytest
+
+import sng_parser.update
+from sng_parser import SngArchive, update_sng, verify_sng
+
+from conftest import member_contents
+
+
+def _contents(path):
+    with SngArchive(path, cache=None) as archive:
+        return {m.filename: archive.read(m.filename) for m in archive.members()}
+
+
+def test_replace_add_remove(sng_file):
+    expected = member_contents()
+    expected["notes.chart"] = b"new chart"
+    del expected["album.png"]
+    expected["background.jpg"] = b"jpg" * 100
+    update_sng(
+        sng_file,
+        replace={"notes.chart": b"new chart"},
+        add={"background.jpg": b"jpg" * 100},
+        remove=["album.png"],
+    )
+    assert _contents(sng_file) == expected
+    assert verify_sng(sng_file).ok
+
+
+def test_rebuild_keeps_mode(sng_file):
+    os.chmod(sng_file, 0o640)
+    update_sng(sng_file, remove=["album.png"])
+    assert stat.S_IMODE(os.stat(sng_file).st_mode) == 0o640
+
+
+@pytest.mark.parametrize("position", [0, 1, -1])
+def test_same_size_replace_in_place(sng_file, position):
+    inode = os.stat(sng_file).st_ino
+    members = sorted(_members(sng_file), key=lambda m: m.content_idx)
+    member = [m for m in members if m.content_len][position]
+    expected = _contents(sng_file)
+    expected[member.filename] = bytes(member.content_len)
+    update_sng(sng_file, replace={member.filename: expected[member.filename]})
+    assert os.stat(sng_file).st_ino == inode
+    assert _members(sng_file) == members
+    assert _contents(sng_file) == expected
+    assert verify_sng(sng_file).ok
+
+
+def test_same_size_replace_keeps_slot_when_rebuilt(sng_file):
+    members = sorted(_members(sng_file), key=lambda m: m.content_idx)
+    first, second = [m for m in members if m.content_len][:2]
+    expected = _contents(sng_file)
+    expected[first.filename] = bytes(first.content_len)
+    expected[second.filename] = b"longer" * 1000
+    update_sng(
+        sng_file,
+        replace={first.filename: expected[first.filename], second.filename: expected[second.filename]},
+    )
+    assert _contents(sng_file) == expected
+    updated = {m.filename: m for m in _members(sng_file)}
+    assert updated[first.filename].content_idx == first.content_idx
+    assert updated[second.filename].content_idx == max(m.content_idx for m in updated.values())
+
+
+def _members(path):
+    with SngArchive(path, cache=None) as archive:
+        return archive.members()
+
+
+def test_failed_update_leaves_original(sng_file, monkeypatch):
+    original = sng_file.read_bytes()
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(sng_parser.update, "_write_new_members", fail)
+    with pytest.raises(OSError):
+        update_sng(sng_file, replace={"notes.chart": b"longer than before" * 100})
+    assert sng_file.read_bytes() == original
+    assert not list(sng_file.parent.glob(".*.tmp"))
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import subprocess
+import sys
+
+import pytest
+
+from sng_parser import SngArchive, verify_sng, verify_sng_files
+from sng_parser.common import U64
+
+from conftest import member_contents
+
+
+def test_valid_file(sng_file):
+    result = verify_sng(sng_file, hash_algorithm="sha256")
+    assert result.ok and not result.errors
+    assert (result.version, result.size, result.members) == (1, sng_file.stat().st_size, 4)
+    assert result.hashes == {
+        name: hashlib.sha256(data).hexdigest() for name, data in member_contents().items()
+    }
+
+
+def test_truncated_file(tmp_path, sng_file):
+    truncated = tmp_path / "truncated.sng"
+    truncated.write_bytes(sng_file.read_bytes()[:-1])
+    result = verify_sng(truncated, hash_algorithm="sha256")
+    assert not result.ok and result.errors
+    assert result.hashes is None
+
+
+@pytest.mark.parametrize("size", [0, 10])
+def test_short_file(tmp_path, sng_file, size):
+    short = tmp_path / "short.sng"
+    short.write_bytes(sng_file.read_bytes()[:size])
+    assert not verify_sng(short).ok
+
+
+def test_overlapping_members(tmp_path, sng_file):
+    with SngArchive(sng_file, cache=None) as archive:
+        first, second = sorted(
+            (member for member in archive.members() if member.content_len),
+            key=lambda member: member.content_idx,
+        )[:2]
+    data = bytearray(sng_file.read_bytes())
+    # point the second member at the start of the first one
+    idx = data.index(U64.pack(second.content_idx), 0, first.content_idx)
+    data[idx : idx + U64.size] = U64.pack(first.content_idx)
+    corrupt = tmp_path / "corrupt.sng"
+    corrupt.write_bytes(data)
+    result = verify_sng(corrupt)
+    assert not result.ok
+    assert any("overlaps" in error for error in result.errors)
+
+
+def test_unknown_hash_algorithm(sng_file):
+    with pytest.raises(ValueError):
+        verify_sng(sng_file, hash_algorithm="not-a-hash")
+
+
+def test_verify_directory(tmp_path, sng_file):
+    (tmp_path / "bad.sng").write_bytes(b"SNGPKG")
+    results = verify_sng_files([tmp_path], workers=2)
+    assert [result.ok for result in results] == [False, True]
+
+
+def test_cli_report(tmp_path, sng_file):
+    cmd = [sys.executable, "-m", "sng_parser", "verify", "--hash", "md5", str(sng_file)]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    report = json.loads(proc.stdout)
+    assert (report["verified"], report["failed"]) == (1, 0)
+    assert report["files"][0]["hashes"]["album.png"] == hashlib.md5(member_contents()["album.png"]).hexdigest()
+
+    (tmp_path / "bad.sng").write_bytes(b"SNGPKG")
+    proc = subprocess.run(
+        [*cmd[:-1], "-o", str(tmp_path / "report.json"), str(tmp_path)], capture_output=True, text=True
+    )
+    assert proc.returncode == 1
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert (report["verified"], report["failed"]) == (2, 1)